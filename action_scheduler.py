@@ -0,0 +1,126 @@
+"""Timer heap for deferred robot actions.
+Primitives such as Robot.step_forward() send their command straight
+away and queue the follow-up (stop, gripper_stop ...) here instead of
+sleeping on the caller's thread. One daemon thread runs every action
+when it falls due.
+Actions can be given a key: queueing a new action with the same key
+cancels the pending one, so e.g. a new step supersedes the previous
+step's stop rather than stacking them.
+Cancelling and running are serialised: once cancel() returns, the
+action has either already finished or will never run, so a new nudge
+can't be followed by the previous step's stop.
+"""
+
+import heapq
+import logging
+from itertools import count
+from threading import Condition, RLock, Thread
+from time import monotonic
+
+log = logging.getLogger(__name__)
+
+
+class Action:
+    """Handle for a queued action"""
+    __slots__ = ('due', 'fn', 'args', 'key', 'cancelled', 'running')
+
+    def __init__(self, due, fn, args, key):
+        self.due = due
+        self.fn = fn
+        self.args = args
+        self.key = key
+        self.cancelled = False
+        self.running = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ActionScheduler:
+    def __init__(self):
+        self._cond = Condition()
+        # held while an action runs, and by cancel, so the two never overlap
+        # (reentrant: an action may cancel or queue others)
+        self._run_lock = RLock()
+        self._heap = []  # (due, sequence, action)
+        self._keys = {}  # key -> pending action
+        self._sequence = count()
+        self._closed = False
+        self._thread = None
+
+    def call_later(self, delay, fn, *args, key=None):
+        """Runs fn(*args) after delay secs, returns the Action.
+        A pending action with the same key is cancelled."""
+        action = Action(monotonic() + delay, fn, args, key)
+        with self._cond:
+            if key is not None:
+                previous = self._keys.get(key)
+                if previous is not None:
+                    previous.cancel()
+                self._keys[key] = action
+            heapq.heappush(self._heap, (action.due, next(self._sequence), action))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return action
+
+    def cancel(self, key):
+        """Cancels the pending action with this key, returns True if there was one"""
+        with self._run_lock, self._cond:
+            action = self._keys.pop(key, None)
+            if action is None:
+                return False
+            action.cancel()
+            return True
+
+    def cancel_all(self):
+        with self._run_lock, self._cond:
+            for _, _, action in self._heap:
+                action.cancel()
+            self._heap.clear()
+            self._keys.clear()
+
+    def pending(self):
+        with self._cond:
+            return sum(1 for _, _, action in self._heap if not action.cancelled)
+
+    def close(self):
+        self.cancel_all()
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    # drop cancelled actions off the top
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if self._heap:
+                        wait = self._heap[0][0] - monotonic()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+                # stays in _keys (cancellable) until it runs
+                _, _, action = heapq.heappop(self._heap)
+
+            with self._run_lock:
+                with self._cond:
+                    # cancelled since it was popped
+                    if action.cancelled:
+                        continue
+                    action.running = True
+                    if action.key is not None and self._keys.get(action.key) is action:
+                        del self._keys[action.key]
+
+                # _cond is released so actions can queue more actions
+                try:
+                    action.fn(*action.args)
+                except Exception:
+                    log.exception('deferred action %s failed', action.fn)
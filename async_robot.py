@@ -0,0 +1,324 @@
+"""asyncio versions of the Comms and Robot classes.
+Everything runs on one event loop: the serial file descriptor is read
+and written through loop.add_reader/add_writer, the heartbeat is a task
+and timed primitives (steps, gripper moves) use asyncio.sleep, so motion,
+telemetry and heartbeat need no extra threads.
+The thread based Comms/Motor/Robot layer is untouched and can be used
+alongside (on a different port).
+
+    async with AsyncRobot('/dev/ttyUSB0') as robot:
+        await robot.nudge(10)
+        await robot.gripper_up()
+        async for sip in robot.sips():  # SIPRecords
+            print(sip.x, sip.y, sip.heading)
+"""
+
+import asyncio
+import os
+from time import monotonic
+
+import serial
+
+from comms import Comms
+from motor import Motor
+from frame_encoder import FrameEncoder, vel2_arg
+from handshake import Handshake
+from sip_parser import SIPParser
+from sip_record import decode_standard_sip, is_standard_sip
+
+
+class AsyncComms:
+    """Non-blocking serial connection to the robot driven by an event loop."""
+
+    HEARTBEAT_INTERVAL = 0.5  # secs
+
+    def __init__(self, port=None, baudrate=9600):
+        self.port = port or Comms.default_port()
+        self.baudrate = baudrate
+        self.ser = None
+        self.sip_parser = SIPParser()
+        self.handshake = None
+        self.sip = None  # latest decoded standard SIP (SIPRecord)
+
+        self._loop = None
+        self._fd = None
+        self._out = bytearray()
+        self._writing = False
+        self._drained = None
+        self._packet_event = None
+        self._subscribers = []
+        self._heartbeat_task = None
+
+    async def open(self, heartbeat=True):
+        """Opens the port and runs the connection handshake,
+        raises HandshakeError if the robot does not answer in time"""
+        self._loop = asyncio.get_running_loop()
+        # pyserial keeps the descriptor in non-blocking mode
+        self.ser = serial.Serial(port=self.port,
+                                 baudrate=self.baudrate,
+                                 parity=serial.PARITY_NONE,
+                                 stopbits=serial.STOPBITS_ONE,
+                                 bytesize=serial.EIGHTBITS,
+                                 timeout=0)
+        self._fd = self.ser.fileno()
+        self._packet_event = asyncio.Event()
+        try:
+            self._loop.add_reader(self._fd, self._on_readable)
+
+            self.handshake = Handshake(Motor.connect_codes())
+            for msg in self.handshake.start(monotonic()):
+                self.write(msg)
+            while not self.handshake.finished:
+                self._packet_event.clear()
+                try:
+                    await asyncio.wait_for(self._packet_event.wait(),
+                                           max(self.handshake.deadline - monotonic(), 0))
+                except asyncio.TimeoutError:
+                    pass
+                for msg in self.handshake.poll(monotonic()):
+                    self.write(msg)
+            if self.handshake.failed:
+                raise self.handshake.error
+        except BaseException:
+            # failed, cancelled or interrupted: don't leave the port open
+            self._close_port()
+            raise
+
+        if heartbeat:
+            self._heartbeat_task = self._loop.create_task(self._heartbeat())
+
+    async def close(self):
+        """Stops the robot, sends the close down code and closes the port"""
+        if self.ser is None:
+            return
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        self.write(Comms.STOP_COMMAND)
+        self.write(Comms.CLOSE_DOWN_CODE)
+        try:
+            await asyncio.wait_for(self.drain(), 1)
+        except asyncio.TimeoutError:
+            pass
+        for queue in self._subscribers:
+            self._offer(queue, None)
+        self._close_port()
+
+    def _close_port(self):
+        self._loop.remove_reader(self._fd)
+        if self._writing:
+            self._loop.remove_writer(self._fd)
+            self._writing = False
+        self.ser.close()
+        self.ser = None
+        # the number can be reused by an unrelated file
+        self._fd = None
+        self._out.clear()
+        if self._drained is not None:
+            self._drained.set_result(None)
+            self._drained = None
+
+    # writing
+    def write(self, msg):
+        """Sends a message straight away; whatever the port
+        can't take yet is written when it becomes writable"""
+        if self._fd is None:
+            raise serial.SerialException(f'{self.port} is closed')
+        self._out += bytes(msg)
+        self._flush()
+
+    async def drain(self):
+        """Waits until every written message is on the wire"""
+        if not self._out:
+            return
+        if self._drained is None:
+            self._drained = self._loop.create_future()
+        await asyncio.shield(self._drained)
+
+    def _flush(self):
+        try:
+            n = os.write(self._fd, self._out)
+        except BlockingIOError:
+            n = 0
+        del self._out[:n]
+
+        if self._out and not self._writing:
+            self._loop.add_writer(self._fd, self._flush)
+            self._writing = True
+        elif not self._out:
+            if self._writing:
+                self._loop.remove_writer(self._fd)
+                self._writing = False
+            if self._drained is not None:
+                self._drained.set_result(None)
+                self._drained = None
+
+    # reading
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        for packet in self.sip_parser.feed(data):
+            self._dispatch(packet)
+
+    def _dispatch(self, packet):
+        if not self.handshake.finished:
+            for msg in self.handshake.on_packet(packet, monotonic()):
+                self.write(msg)
+            self._packet_event.set()
+            return
+
+        if not is_standard_sip(packet):
+            return
+        record = decode_standard_sip(packet, monotonic())
+        if record is None:
+            return
+        self.sip = record
+        for queue in self._subscribers:
+            self._offer(queue, record)
+
+    @staticmethod
+    def _offer(queue, item):
+        # slow consumers lose the oldest SIPs rather than blocking the reader
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
+
+    async def sips(self, maxsize=32):
+        """Async iterator of every standard SIP (as a SIPRecord) after connecting"""
+        queue = asyncio.Queue(maxsize)
+        self._subscribers.append(queue)
+        try:
+            while True:
+                record = await queue.get()
+                if record is None:
+                    return
+                yield record
+        finally:
+            self._subscribers.remove(queue)
+
+    async def _heartbeat(self):
+        # monotonic schedule so a slow callback doesn't push every later pulse back
+        next_pulse = monotonic()
+        while True:
+            self.write(Comms.HEARTBEAT)
+            next_pulse += self.HEARTBEAT_INTERVAL
+            await asyncio.sleep(max(next_pulse - monotonic(), 0))
+
+
+class AsyncRobot:
+    """Awaitable version of Robot. Each command returns once it is on the wire."""
+
+    ACTION_TIME = 0.5  # secs a step or gripper move runs before stopping
+
+    def __init__(self, port=None, baudrate=9600):
+        self.comms = AsyncComms(port, baudrate)
+        self.encoder = FrameEncoder()
+        # last VEL2 wheel velocities [left, right] in 20mm/sec units
+        self.wheel_vels = [0, 0]
+
+    async def connect(self):
+        await self.comms.open()
+        return self
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.terminate()
+
+    async def cmd(self, cmd, value=None):
+        self.comms.write(self.encoder.encode(cmd, value))
+        await self.comms.drain()
+
+    def sips(self, maxsize=32):
+        return self.comms.sips(maxsize)
+
+    # ReRoBot specific commands (selection)
+    async def nudge(self, dist=10):
+        """Translate (+) forward or (-) back mm distance at SETV speed"""
+        await self.cmd(Comms.MOVE, dist)
+
+    async def move(self, speed=10):
+        """Move forward (+) or reverse (-) at millimeters per second"""
+        await self.cmd(Comms.VEL, speed)
+
+    async def rvel(self, speed=10):
+        """Rotate robot at (+) counter- or (–) clockwise; degrees/sec (SETRV limit)."""
+        await self.cmd(Comms.RVEL, speed)
+
+    async def head(self, degree=0):
+        """Turn at SETRV speed to absolute heading; ±degrees (+ = ccw )"""
+        await self.cmd(Comms.HEAD, degree)
+
+    async def rotate(self, degrees=10):
+        """Rotate (+) counter- or (-) clockwise degrees/sec."""
+        await self.cmd(Comms.ROTATE, degrees)
+
+    async def stop(self):
+        await self.cmd(Comms.STOP)
+
+    async def terminate(self):
+        await self.comms.close()
+
+    # gripper commands (see Robot for the argument list)
+    async def gripper_up(self):
+        await self.cmd(Comms.GRIPPER, 4)
+        await asyncio.sleep(self.ACTION_TIME)
+        await self.gripper_stop()
+
+    async def gripper_down(self):
+        await self.cmd(Comms.GRIPPER, 5)
+        await asyncio.sleep(self.ACTION_TIME)
+        await self.gripper_stop()
+
+    async def gripper_stop(self):
+        await self.cmd(Comms.GRIPPER, 6)
+
+    async def paddle_open(self):
+        await self.cmd(Comms.GRIPPER, 1)
+        await asyncio.sleep(self.ACTION_TIME)
+        await self.paddle_stop()
+
+    async def paddle_close(self):
+        await self.cmd(Comms.GRIPPER, 2)
+        await asyncio.sleep(self.ACTION_TIME)
+        await self.paddle_stop()
+
+    async def paddle_stop(self):
+        await self.cmd(Comms.GRIPPER, 3)
+
+    async def all_halt(self):
+        await self.cmd(Comms.GRIPPER, 15)
+
+    # useful UI commands
+    async def step_forward(self):
+        await self.nudge(10)
+        await asyncio.sleep(self.ACTION_TIME)
+        await self.stop()
+
+    async def step_backward(self):
+        await self.nudge(-10)
+        await asyncio.sleep(self.ACTION_TIME)
+        await self.stop()
+
+    async def step_left(self):
+        await self.rvel(20)
+        await asyncio.sleep(self.ACTION_TIME)
+        await self.stop()
+
+    async def step_right(self):
+        await self.rvel(-20)
+        await asyncio.sleep(self.ACTION_TIME)
+        await self.stop()
+
+    # Jetbot shared commands
+    async def set_motors(self, left_speed, right_speed):
+        self.wheel_vels = [left_speed, right_speed]
+        await self.cmd(Comms.VEL2, vel2_arg(left_speed, right_speed))
+
+    async def forward(self, speed=10):
+        await self.move(speed)
+
+    async def backward(self, speed=10):
+        await self.move(-speed)
@@ -10,20 +10,59 @@ cd ReRoRos_v1
 python3 basic_motion_UI.py
 """
 
+import logging
 from time import sleep
 from rerobot import Robot
 import tkinter as tk
 
+class TelemetryPanel(tk.Frame):
+    """SIP readouts built once; refreshed from the motor's latest SIP
+    snapshot (filled in by its reader thread) at most REDRAW_RATE times
+    a second, and only the labels whose text changed are touched."""
+
+    REDRAW_RATE = 10  # per sec
+
+    # label, SIPRecord field, format
+    FIELDS = (('Battery Level', 'battery', '{:.1f} V'),
+              ('Bumpers', 'bumpers', '{:#06x}'),
+              ('Actual Heading', 'heading', '{:.1f}'),
+              ('Left Wheel Vel', 'l_vel', '{:.0f} mm/s'),
+              ('Right Wheel Vel', 'r_vel', '{:.0f} mm/s'),
+              ('Position', None, '{:.0f}, {:.0f} mm'))
+
+    def __init__(self, master, comms):
+        tk.Frame.__init__(self, master)
+        self.comms = comms
+        self._last_sip = None
+        self._values = []
+        for row, (label, _, _) in enumerate(self.FIELDS):
+            value = tk.StringVar(self, '-')
+            tk.Label(master=self, text=f'{label} =').grid(row=row, column=0, sticky='e')
+            tk.Label(master=self, textvariable=value, width=12, anchor='w').grid(row=row, column=1, sticky='w')
+            self._values.append(value)
+        self.after(0, self.redraw)
+
+    def redraw(self):
+        sip = self.comms.sip
+        if sip is not None and sip is not self._last_sip:
+            self._last_sip = sip
+            for value, (_, field, fmt) in zip(self._values, self.FIELDS):
+                text = fmt.format(sip.x, sip.y) if field is None else fmt.format(getattr(sip, field))
+                if value.get() != text:
+                    value.set(text)
+        self.after(1000 // self.REDRAW_RATE, self.redraw)
+
+
 class GUI(tk.Frame):
     """ GUI & main """
 
     # defining global vars
-    UPDATE_RATE = 100 # millisecs
     SIPS_LOGGING = False
 
-    def __init__(self):
+    def __init__(self, robot=None):
         # Create robot move object and Comms inheritance
-        self.robot = Robot()
+        # (or drive one that is already connected, e.g. from runtime.py)
+        self.robot = robot or Robot()
 
         # Build GUI
         print('building GUI')
@@ -43,9 +82,6 @@ class GUI(tk.Frame):
         if self.SIPS_LOGGING:
             self.create_sips()
 
-        # Start the updating cycle
-        self.updater()
-
     def on_press(self, event):
         # self.log("button was pressed")
         print(event)
@@ -123,37 +159,11 @@ class GUI(tk.Frame):
 
 
     def create_sips(self):
-        label_battery = tk.Label(master=self, text=f"Battery Level = {self.robot.motor.sips_dict.value['BATTERY']}")
-        label_battery.grid(row=0, column=6)
-
-        label_compass = tk.Label(master=self, text=f"Bumpers = {self.robot.motor.sips_dict.value['BUMPERS']}")
-        label_compass.grid(row=1, column=6)
-
-        label_heading = tk.Label(master=self, text=f"Actual Heading = {self.robot.motor.sips_dict.value['THPOS']}")
-        label_heading.grid(row=2, column=6)
-
-        label_left_wheel = tk.Label(master=self, text=f"Left Wheel Vel = {self.robot.motor.sips_dict.value['L_VEL']}")
-        label_left_wheel.grid(row=3, column=6)
-
-        label_right_wheel = tk.Label(master=self, text=f"Right Wheel Vel = {self.robot.motor.sips_dict.value['R_VEL']}")
-        label_right_wheel.grid(row=4, column=6)
-
-    def updater(self):
-        if self.SIPS_LOGGING:
-            # send SIP request
-            self.robot.motor.send_sip_request()
-
-            # read incoming SIPS from client robot
-            self.robot.motor.parse_sip()
-
-            # refresh SIPS windows
-            self.create_sips()
-
-        # send a heartbeat pulse
-        self.robot.motor.pulse()
-
-        # "... and start all over again"
-        self.after(self.UPDATE_RATE, self.updater)
+        """SIPS reporting panel, built once and kept up to date by itself"""
+        # SIPs are parsed off the Tk thread
+        self.robot.motor.start_reader()
+        self.telemetry = TelemetryPanel(self, self.robot.motor)
+        self.telemetry.grid(row=0, column=6, rowspan=5, sticky='n')
 
     def terminate(self):
         print ('terminator!!!')
@@ -165,5 +175,6 @@ class GUI(tk.Frame):
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
     window = GUI()
     window.mainloop()
@@ -0,0 +1,106 @@
+"""Host baud rate upgrade after the connection handshake.
+P2OS always connects at 9600 baud; HOSTBAUD (code 50) then switches the
+controller to one of BAUD_RATES by index. upgrade_baud() asks for the
+fastest rate, moves the host side of the port over once the command is
+on the wire and checks the link by requesting a config SIP. If nothing
+valid comes back both sides are put back to 9600 and the next rate down
+is tried; if the link is dead even at 9600, BaudRateError is raised.
+The rate that worked is remembered per port in a small JSON
+file, so later connections go straight to it.
+
+    rate = upgrade_baud(motor)      # Motor does this while connecting
+"""
+
+import json
+import logging
+import os
+from time import monotonic, sleep
+
+log = logging.getLogger(__name__)
+
+# HOSTBAUD argument is the index into this
+BAUD_RATES = (9600, 19200, 38400, 57600, 115200)
+DEFAULT_RATE = 9600
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.rerobot_baud.json')
+
+VERIFY_TIMEOUT = 0.5  # secs to wait for a valid packet at the new rate
+SETTLE_TIME = 0.02  # secs for the controller to switch its UART
+
+
+class BaudRateError(ConnectionError):
+    """The controller stopped answering, even back at DEFAULT_RATE."""
+
+
+def load_cache(path=CACHE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def remember(port, rate, path=CACHE_PATH):
+    """Stores the working rate for port (None forgets it)"""
+    cache = load_cache(path)
+    if rate is None:
+        cache.pop(port, None)
+    else:
+        cache[port] = rate
+    try:
+        with open(path, 'w') as f:
+            json.dump(cache, f, indent=1)
+    except OSError as e:
+        log.warning('could not save baud rate cache %s: %s', path, e)
+
+
+def upgrade_baud(comms, max_rate=BAUD_RATES[-1], cache_path=CACHE_PATH):
+    """Switches a connected Motor to the fastest rate up to max_rate that
+    the link carries, returns the rate in use. Raises BaudRateError if
+    nothing answers after falling back to DEFAULT_RATE.
+    Call before the heartbeat starts so nothing else is writing."""
+    port = comms.ser.port
+    candidates = [rate for rate in reversed(BAUD_RATES) if DEFAULT_RATE < rate <= max_rate]
+    cached = load_cache(cache_path).get(port) if cache_path else None
+    if cached in candidates:
+        # known good rate first, the rest only if it has stopped working
+        candidates.remove(cached)
+        candidates.insert(0, cached)
+
+    for rate in candidates:
+        if _switch(comms, rate) and _verify(comms):
+            if cache_path and rate != cached:
+                remember(port, rate, cache_path)
+            return rate
+        log.warning('%s did not answer at %d baud, falling back to %d', port, rate, DEFAULT_RATE)
+        # the controller may have switched even though we can't hear it,
+        # so tell it to go back at both rates
+        _switch(comms, DEFAULT_RATE)
+        _switch(comms, DEFAULT_RATE)
+        if rate == cached and cache_path:
+            remember(port, None, cache_path)
+        if not _verify(comms):
+            raise BaudRateError(f'{port} is not answering at {DEFAULT_RATE} baud either')
+    return comms.ser.baudrate
+
+
+def _switch(comms, rate):
+    """Sends HOSTBAUD for rate at the current rate, then moves the host over"""
+    comms.write(comms.encoder.encode(comms.HOSTBAUD, BAUD_RATES.index(rate)))
+    if not comms.command_scheduler.wait_empty(timeout=1):
+        return False
+    comms.ser.flush()  # wait for the UART to finish sending it
+    sleep(SETTLE_TIME)
+    comms.ser.baudrate = rate
+    comms.ser.reset_input_buffer()
+    comms.sip_parser.reset()
+    return True
+
+
+def _verify(comms, timeout=VERIFY_TIMEOUT):
+    """True once any packet with a good checksum arrives"""
+    comms.write(comms.encoder.encode(comms.CONFIG, 1))
+    end = monotonic() + timeout
+    while monotonic() < end:
+        if comms.read_packets(end - monotonic()):
+            return True
+    return False
@@ -0,0 +1,322 @@
+"""Benchmarks for the command and telemetry hot paths, no robot needed.
+Everything runs in process over a loopback transport (see transport.py),
+with the simulator on the robot's end where a controller is needed, and
+the results come out as JSON so runs can be compared:
+
+    python benchmarks.py --out before.json
+    ... change something ...
+    python benchmarks.py --out after.json --compare before.json
+
+Benchmarks:
+    encode     FrameEncoder.encode / encode_many, Motor.cmd and checksum (per sec)
+    write      enqueue to bytes on the wire through Comms.write and the
+               writer thread, one at a time and in bursts (usecs)
+    decode     Comms.process_incoming on a clean and a corrupted SIP stream
+    handshake  Motor connecting to the simulator (secs)
+    memory     bytes held per 10k SIPs as SIPRecords, in a TelemetryHistory,
+               and the peak while streaming them (tracemalloc)
+"""
+
+import argparse
+import gc
+import json
+import logging
+import platform
+import random
+import sys
+import tracemalloc
+from threading import Thread
+from time import monotonic, perf_counter, sleep, time
+
+from comms import Comms
+from frame_encoder import FrameEncoder
+from sip_parser import SIPParser, checksum
+from transport import loopback_pair
+
+log = logging.getLogger(__name__)
+
+BENCHMARKS = ('encode', 'write', 'decode', 'handshake', 'memory')
+
+
+def _percentiles(samples, scale=1.0):
+    ordered = sorted(samples)
+    n = len(ordered)
+    if not n:
+        return {'count': 0}
+    pick = lambda q: ordered[min(int(q * n), n - 1)] * scale
+    return {'count': n,
+            'min': ordered[0] * scale,
+            'mean': sum(ordered) / n * scale,
+            'p50': pick(0.50),
+            'p95': pick(0.95),
+            'p99': pick(0.99),
+            'max': ordered[-1] * scale}
+
+
+def _rate(fn, n):
+    # calls per sec of fn() over n calls, best of three
+    best = float('inf')
+    for _ in range(3):
+        started = perf_counter()
+        for _ in range(n):
+            fn()
+        best = min(best, perf_counter() - started)
+    return n / best
+
+
+class _Bench:
+    """A bare Comms on the host end of a loopback pair; the robot's end
+    is read by a thread that timestamps every frame as it arrives"""
+
+    def __init__(self):
+        self.host, self.robot = loopback_pair()
+        self.comms = Comms(transport=self.host)
+        self.arrivals = []  # (arrival time, frame)
+        self._parser = SIPParser()
+        self._running = True
+        self._thread = Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while self._running:
+            data = self.robot.read(65536)
+            if data:
+                now = perf_counter()
+                self.arrivals.extend((now, frame) for frame in self._parser.feed(data))
+
+    def close(self):
+        self.comms.close_sequence(Comms.CLOSE_DOWN_CODE)
+        self._running = False
+        self.robot.close()
+        self._thread.join(timeout=1)
+
+
+def bench_encode(n=100000):
+    from motor import Motor
+    encoder = FrameEncoder()
+    batch = [(Comms.VEL, 100), (Comms.RVEL, -20), (Comms.HEAD, 90), (Comms.STOP, None)]
+    frame = encoder.encode(Comms.VEL, 100)
+
+    # Motor.cmd without a connection under it: write() does nothing
+    writer = Motor.__new__(Motor)
+    writer.encoder = encoder
+    writer.wheel_vels = [0, 0]
+    writer.write = lambda msg, key=None, urgent=False, timeout=None, sent=None: None
+
+    return {'encode_per_sec': _rate(lambda: encoder.encode(Comms.VEL, -250), n),
+            'encode_short_per_sec': _rate(lambda: encoder.encode(Comms.STOP), n),
+            'encode_many_commands_per_sec': _rate(lambda: encoder.encode_many(batch), n // 4) * len(batch),
+            'motor_cmd_per_sec': _rate(lambda: writer.cmd(Comms.VEL2, 5, wheel='left'), n),
+            'checksum_per_sec': _rate(lambda: checksum(frame[3:-2]), n)}
+
+
+def bench_write(n=2000, gap=0.0005, burst=50):
+    """Unpaced loopback, so this is the software path only"""
+    bench = _Bench()
+    comms = bench.comms
+    encoder = FrameEncoder()
+    try:
+        frames = [encoder.encode(Comms.VEL, i % 0x7FFF) for i in range(n)]
+
+        def run(groups, pause):
+            bench.arrivals.clear()
+            sent = {}
+            for group in groups:
+                for frame in group:
+                    sent[frame] = perf_counter()
+                    comms.write(frame)
+                sleep(pause)
+            comms.command_scheduler.wait_empty(timeout=5)
+            end = perf_counter() + 1
+            while len(bench.arrivals) < len(sent) and perf_counter() < end:
+                sleep(0.001)
+            # frames repeat every 0x7FFF, n is well below that
+            return [arrived - sent[bytes(frame)] for arrived, frame in bench.arrivals
+                    if bytes(frame) in sent]
+
+        single = run([[frame] for frame in frames], gap)
+        writes = comms.ser.writes.value
+        bursts = run([frames[i:i + burst] for i in range(0, n, burst)], gap * burst)
+        return {'single_usecs': _percentiles(single, 1e6),
+                'burst_usecs': _percentiles(bursts, 1e6),
+                'burst_size': burst,
+                # how well the writer batches a burst into one write
+                'burst_frames_per_write': n / max(comms.ser.writes.value - writes, 1)}
+    finally:
+        bench.close()
+
+
+def _sip_stream(n, seed=0):
+    # n standard SIPs from the simulator, moving and with sonar, as one byte string
+    from simulator import P2OSSimulator
+    sim = P2OSSimulator(seed=seed)
+    sim.vel, sim.rvel = 300.0, 20.0
+    packets = []
+    for _ in range(n):
+        sim._integrate(0.1)
+        packets.append(sim.standard_sip())
+    return b''.join(packets)
+
+
+def _corrupt(data, rate, seed=0):
+    # flips or drops bytes, rate per byte
+    rng = random.Random(seed)
+    out = bytearray()
+    for byte in data:
+        roll = rng.random()
+        if roll < rate / 2:
+            continue
+        out.append(byte ^ 0xFF if roll < rate else byte)
+    return bytes(out)
+
+
+def bench_decode(n=20000, corrupt_rate=0.002, chunk=64):
+    clean = _sip_stream(n)
+    results = {}
+    bench = _Bench()
+    try:
+        comms = bench.comms
+        for name, stream in (('clean', clean), ('corrupt', _corrupt(clean, corrupt_rate))):
+            comms.sip_parser.reset()
+            decoded = 0
+            chunks = [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+            started = perf_counter()
+            for data in chunks:
+                decoded += len(comms.process_incoming(data))
+            secs = perf_counter() - started
+            results[name] = {'sips': decoded,
+                             'sips_per_sec': decoded / secs,
+                             'mbytes_per_sec': len(stream) / secs / 1e6,
+                             'usecs_per_sip': secs / max(decoded, 1) * 1e6}
+        parser = comms.sip_parser
+        results['corrupt'].update({'corrupt_rate': corrupt_rate,
+                                   'lost': n - results['corrupt']['sips'],
+                                   'checksum_errors': parser.checksum_errors,
+                                   'resyncs': parser.resyncs})
+    finally:
+        bench.close()
+    return results
+
+
+def bench_handshake(runs=5, sip_interval=0.1):
+    """Motor against the simulator over loopback; the CONNECT step waits
+    for the first SIP, so it includes up to one sip_interval"""
+    from motor import Motor
+    from simulator import P2OSSimulator
+    durations, totals = [], []
+    for _ in range(runs):
+        host, link = loopback_pair()
+        sim = P2OSSimulator(sip_interval=sip_interval)
+        sim.start(link)
+        started = monotonic()
+        motor = Motor(transport=host, max_baud=None)
+        totals.append(monotonic() - started)
+        durations.append(motor.handshake.duration)
+        motor.terminate()
+        sim.stop()
+    return {'runs': runs,
+            'sip_interval': sip_interval,
+            'handshake_secs': _percentiles(durations),
+            'motor_init_secs': _percentiles(totals)}
+
+
+def bench_memory(n=10000):
+    from sip_record import decode_standard_sip
+    from telemetry_history import TelemetryHistory
+    from sip_parser import SIPParser as Parser
+    packets = Parser().feed(_sip_stream(n))
+    results = {}
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        records = [decode_standard_sip(packet, 0.0) for packet in packets]
+        results['sip_records_bytes'] = tracemalloc.get_traced_memory()[0] - before
+
+        history = TelemetryHistory(n)  # allocated up front
+        before = tracemalloc.get_traced_memory()[0]
+        for record in records:
+            history.append(record)
+        results['history_growth_bytes'] = tracemalloc.get_traced_memory()[0] - before
+        results['history_buffer_bytes'] = history._data.nbytes
+        del records, history
+
+        # nothing kept: what the reader path churns through
+        bench = _Bench()
+        stream = b''.join(packets)
+        gc.collect()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(0, len(stream), 64):
+            bench.comms.process_incoming(stream[i:i + 64])
+        current, peak = tracemalloc.get_traced_memory()
+        results['streaming_peak_bytes'] = peak - before
+        results['streaming_retained_bytes'] = current - before
+        bench.close()
+    finally:
+        tracemalloc.stop()
+    results['sips'] = n
+    return results
+
+
+def run(names=BENCHMARKS, quick=False):
+    scale = 10 if quick else 1
+    kwargs = {'encode': {'n': 100000 // scale},
+              'write': {'n': 2000 // scale},
+              'decode': {'n': 20000 // scale},
+              'handshake': {'runs': 5 if not quick else 2},
+              'memory': {'n': 10000}}
+    results = {'meta': {'time': time(),
+                        'python': sys.version.split()[0],
+                        'implementation': platform.python_implementation(),
+                        'machine': platform.machine(),
+                        'platform': platform.platform(),
+                        'quick': quick},
+               'results': {}}
+    for name in names:
+        log.info('running %s', name)
+        started = perf_counter()
+        results['results'][name] = globals()[f'bench_{name}'](**kwargs[name])
+        results['results'][name]['wall_secs'] = perf_counter() - started
+    return results
+
+
+def compare(new, old, path=''):
+    """Lines of 'path: old -> new (change %)' for every number in both runs"""
+    lines = []
+    for key, value in new.items():
+        if key not in old or key in ('meta', 'wall_secs'):
+            continue
+        where = f'{path}.{key}' if path else key
+        if isinstance(value, dict) and isinstance(old[key], dict):
+            lines += compare(value, old[key], where)
+        elif isinstance(value, (int, float)) and isinstance(old[key], (int, float)) \
+                and not isinstance(value, bool):
+            change = (value - old[key]) / old[key] * 100 if old[key] else 0.0
+            lines.append(f'{where}: {old[key]:.6g} -> {value:.6g} ({change:+.1f}%)')
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the command and telemetry hot paths')
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help='comma separated: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--quick', action='store_true', help='smaller runs, for a smoke test')
+    parser.add_argument('--out', default=None, help='write the JSON here as well as to stdout')
+    parser.add_argument('--compare', default=None, help='an earlier JSON run to compare against')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(name)s %(message)s')
+
+    names = [name.strip() for name in args.only.split(',') if name.strip()]
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+    output = run(names, args.quick)
+    text = json.dumps(output, indent=1)
+    print(text)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(output['results'], json.load(f)['results'])), file=sys.stderr)
@@ -0,0 +1,343 @@
+"""Choreography scores compiled to pre-encoded frames and played in real time.
+A score is a list of timed cues, written as text (one cue per line):
+
+    # ReRo dance, times in beats at 120 bpm
+    bpm 120
+    length 16            # loop length (default: the last cue)
+    0     nudge 100
+    2     head 90
+    4     set_motors 5 -5
+    6     stop
+    6     gripper_up     # cues at the same time go out in one write
+    7     gripper_stop
+
+or as JSON: {"bpm": 120, "length": 16, "cues": [[0, "nudge", 100], ...]}.
+Without bpm, times are in secs. Actions are the Robot command names
+(nudge, move, rvel, head, rotate, stop, set_motors, the gripper and
+paddle calls) plus 'gripper N' and 'raw CMD [VALUE]'. Timed Robot
+primitives (gripper_up etc.) don't stop themselves here; the score says
+when to stop.
+
+compile_score() encodes every cue up front, so playing is just sending
+bytes. ChoreographyPlayer sends each frame at its deadline on a monotonic
+clock (a short sleep, then a spin for the last SPIN secs) and records how
+late every cue went on the wire (stamped by the Comms writer thread, so
+time queued behind other commands counts). Deadlines come from one anchor, so error never
+accumulates across a long piece or between loops. Tempo and position can
+be changed while playing.
+
+    score = compile_score(load_score('dance.txt'))
+    player = ChoreographyPlayer(robot.motor, score, loop=True)
+    player.start()
+    player.tempo = 1.1
+    player.seek(32.0)
+    print(player.lateness_stats())
+"""
+
+import argparse
+import json
+import logging
+from bisect import bisect_left
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic, perf_counter, sleep
+
+from comms import Comms
+from frame_encoder import FrameEncoder, vel2_arg
+from metrics import Histogram
+
+log = logging.getLogger(__name__)
+
+# action: (command code, fixed value or None to take the cue's argument)
+ACTIONS = {'nudge': (Comms.MOVE, None),
+           'move': (Comms.VEL, None),
+           'forward': (Comms.VEL, None),
+           'rvel': (Comms.RVEL, None),
+           'head': (Comms.HEAD, None),
+           'rotate': (Comms.ROTATE, None),
+           'gripper': (Comms.GRIPPER, None),
+           'paddle_open': (Comms.GRIPPER, 1),
+           'paddle_close': (Comms.GRIPPER, 2),
+           'paddle_stop': (Comms.GRIPPER, 3),
+           'gripper_up': (Comms.GRIPPER, 4),
+           'gripper_down': (Comms.GRIPPER, 5),
+           'gripper_stop': (Comms.GRIPPER, 6),
+           'all_halt': (Comms.GRIPPER, 15)}
+
+
+class Score:
+    """Parsed cues: (time, action, args, source line), times in score units"""
+
+    def __init__(self, cues, bpm=None, length=None):
+        self.cues = sorted(cues, key=lambda cue: cue[0])
+        self.bpm = bpm
+        self.length = length
+
+    def seconds(self, t):
+        return t * 60.0 / self.bpm if self.bpm else float(t)
+
+
+class CompiledScore:
+    """Frames ready to send: frames[i] goes out at times[i] secs and
+    carries the cues (source lines) in cue_lines[i]"""
+
+    def __init__(self, times, frames, cue_lines, duration):
+        self.times = times
+        self.frames = frames
+        self.cue_lines = cue_lines
+        self.duration = duration
+
+    def __len__(self):
+        return len(self.frames)
+
+    def index_at(self, t):
+        """First frame due at or after t secs"""
+        return bisect_left(self.times, t)
+
+
+def parse_score(text):
+    """Score from the text format"""
+    cues = []
+    bpm = length = None
+    for line_no, line in enumerate(text.splitlines(), 1):
+        words = line.split('#', 1)[0].split()
+        if not words:
+            continue
+        try:
+            if words[0] == 'bpm':
+                bpm = float(words[1])
+            elif words[0] == 'length':
+                length = float(words[1])
+            else:
+                cues.append((float(words[0]), words[1], [int(w, 0) for w in words[2:]], line_no))
+        except (IndexError, ValueError) as e:
+            raise ValueError(f'score line {line_no}: {line.strip()!r} ({e})') from None
+    return Score(cues, bpm, length)
+
+
+def load_score(path):
+    """Score from a .json or text file"""
+    with open(path) as f:
+        if path.endswith('.json'):
+            data = json.load(f)
+            cues = [(float(cue[0]), cue[1], [int(arg) for arg in cue[2:]], n)
+                    for n, cue in enumerate(data['cues'], 1)]
+            return Score(cues, data.get('bpm'), data.get('length'))
+        return parse_score(f.read())
+
+
+def compile_score(score, encoder=None):
+    """Encodes every cue, raises ValueError naming the bad cue"""
+    encoder = encoder or FrameEncoder()
+    times, frames, cue_lines = [], [], []
+    for t, action, args, line in score.cues:
+        try:
+            frame = _encode_cue(encoder, action, args)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            raise ValueError(f'cue at line {line}: {action} {args} ({e})') from None
+        secs = score.seconds(t)
+        if times and times[-1] == secs:
+            # same deadline, same write
+            frames[-1] += frame
+            cue_lines[-1].append(line)
+        else:
+            times.append(secs)
+            frames.append(frame)
+            cue_lines.append([line])
+
+    if score.length is not None:
+        duration = score.seconds(score.length)
+    else:
+        duration = times[-1] if times else 0.0
+    return CompiledScore(times, [bytes(frame) for frame in frames], cue_lines, duration)
+
+
+def _encode_cue(encoder, action, args):
+    if action == 'stop':
+        return bytes(Comms.STOP_COMMAND)
+    if action == 'set_motors':
+        left, right = args
+        return encoder.encode(Comms.VEL2, vel2_arg(left, right))
+    if action == 'backward':
+        return encoder.encode(Comms.VEL, -args[0])
+    if action == 'raw':
+        return encoder.encode(args[0], args[1] if len(args) > 1 else None)
+    cmd, value = ACTIONS[action]
+    return encoder.encode(cmd, value if value is not None else args[0])
+
+
+class ChoreographyPlayer:
+    SPIN = 0.002  # secs before a deadline to stop sleeping and spin
+
+    def __init__(self, comms, score, tempo=1.0, loop=False, stop_on_end=True):
+        """comms: a connected Comms/Motor (frames go through its writer)
+        score: a CompiledScore
+        tempo: playback speed (2.0 = twice as fast)
+        loop: start again from 0 at the score's length
+        stop_on_end: send STOP when playing finishes or is stopped"""
+        self.comms = comms
+        self.score = score
+        self.loop = loop
+        self.stop_on_end = stop_on_end
+        self.loops = 0
+
+        # how late (secs) each frame went on the wire, observed on the
+        # writer thread; a frame dropped unsent (preempted by a STOP) isn't counted
+        self.lateness = Histogram()
+        self.recent = deque(maxlen=10000)  # (score secs, cue lines, lateness)
+
+        self._cond = Condition()
+        self._tempo = tempo
+        self._index = 0
+        self._anchor_wall = 0.0  # wall clock time ...
+        self._anchor_score = 0.0  # ... of this score position
+        self._running = False
+        self._thread = None
+
+    # control (any thread)
+    def start(self, at=0.0):
+        """Starts playing from at secs into the score"""
+        self.stop()
+        with self._cond:
+            self._running = True
+            self._anchor(at, perf_counter())
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            was_running, self._running = self._running, False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+        if was_running and self.stop_on_end:
+            self.comms.write(Comms.STOP_COMMAND, urgent=True)
+
+    def wait(self, timeout=None):
+        """Blocks until the score ends (never, when looping)"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def position(self):
+        """Current position in the score in secs"""
+        with self._cond:
+            return self._position(perf_counter())
+
+    def seek(self, t):
+        """Jumps to t secs into the score; cues before t are skipped"""
+        with self._cond:
+            self._anchor(t, perf_counter())
+            self._cond.notify()
+
+    @property
+    def tempo(self):
+        return self._tempo
+
+    @tempo.setter
+    def tempo(self, tempo):
+        if tempo <= 0:
+            raise ValueError('tempo must be positive')
+        with self._cond:
+            # keep the current position, change the speed from here on
+            now = perf_counter()
+            position = self._position(now)
+            self._tempo = tempo
+            self._anchor_wall, self._anchor_score = now, position
+            self._cond.notify()
+
+    def lateness_stats(self):
+        """Cue lateness on the wire, summary in millisecs"""
+        return self.lateness.summary(scale=1000)
+
+    # the loop (called with the lock held)
+    def _position(self, now):
+        return self._anchor_score + (now - self._anchor_wall) * self._tempo
+
+    def _anchor(self, t, now):
+        self._anchor_wall, self._anchor_score = now, t
+        self._index = self.score.index_at(t)
+
+    def _deadline(self, t):
+        return self._anchor_wall + (t - self._anchor_score) / self._tempo
+
+    def _on_sent(self, i, deadline):
+        def sent(at):
+            late = at - deadline
+            self.lateness.observe(late)
+            self.recent.append((self.score.times[i], self.score.cue_lines[i], late))
+        return sent
+
+    def _run(self):
+        score = self.score
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                i = self._index
+                if i >= len(score):
+                    if not self.loop or score.duration <= 0:
+                        break
+                    # next lap starts exactly where this one ends
+                    end = self._deadline(score.duration)
+                    self._anchor_wall, self._anchor_score = end, 0.0
+                    self._index = 0
+                    self.loops += 1
+                    continue
+                deadline = self._deadline(score.times[i])
+                wait = deadline - perf_counter() - self.SPIN
+                if wait > 0:
+                    # woken early by seek, tempo or stop
+                    self._cond.wait(wait)
+                    continue
+
+            while perf_counter() < deadline:
+                sleep(0)  # spin, but let the writer and reader threads run
+
+            with self._cond:
+                if not self._running or self._index != i:
+                    continue  # seeked (or stopped) while spinning
+                # the writer stamps with monotonic(), deadlines are perf_counter()
+                wire_deadline = deadline + monotonic() - perf_counter()
+                self.comms.write(score.frames[i], sent=self._on_sent(i, wire_deadline))
+                self._index = i + 1
+
+        with self._cond:
+            finished, self._running = self._running, False
+        log.info('score finished, cue lateness (ms) %s', self.lateness_stats())
+        if finished and self.stop_on_end:
+            self.comms.write(Comms.STOP_COMMAND, urgent=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compile and play a choreography score')
+    parser.add_argument('score', help='score file (.json or text)')
+    parser.add_argument('--port', default=None, help='serial port of the robot')
+    parser.add_argument('--tempo', type=float, default=1.0)
+    parser.add_argument('--seek', type=float, default=0.0, help='start this many secs in')
+    parser.add_argument('--loop', action='store_true')
+    parser.add_argument('--check', action='store_true', help='only compile and summarise')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+
+    compiled = compile_score(load_score(args.score))
+    print(f'{len(compiled)} frames, {compiled.duration:.3f} secs, '
+          f'{sum(len(frame) for frame in compiled.frames)} bytes')
+    if not args.check:
+        from motor import Motor
+        motor = Motor(args.port)
+        player = ChoreographyPlayer(motor, compiled, tempo=args.tempo, loop=args.loop)
+        try:
+            player.start(args.seek)
+            player.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            player.stop()
+            print(f'cue lateness (ms): {player.lateness_stats()}')
+            motor.terminate()
@@ -0,0 +1,136 @@
+"""Outgoing command scheduler used by the Comms writer thread.
+Commands are held in two lanes:
+    urgent  - STOP, E_STOP and the close down code. Always sent first and
+              any unsent motion commands (preempt_codes, keyed or not)
+              are dropped, so a stale velocity or move can never follow
+              a stop onto the wire. Everything else stays, in order.
+    pending - everything else, in arrival order. Commands given a key
+              (e.g. VEL, RVEL, HEAD or VEL2 per wheel) are coalesced:
+              a newer value overwrites the unsent older one in place.
+              Commands without a key are never dropped.
+Depth is bounded: keyed commands take at most one slot per key and
+put() blocks (back pressure) when the unkeyed backlog reaches maxsize.
+A command can carry a sent callback for the writer to call once it is on
+the wire; it goes with the command, so one that is coalesced away or
+preempted is dropped uncalled.
+"""
+
+from collections import OrderedDict
+from itertools import count
+from queue import Full
+from threading import Condition
+from time import monotonic
+
+# unkeyed commands are stored under (_UNKEYED, n), which no caller's key can equal
+_UNKEYED = object()
+
+
+def _codes(msg):
+    # command codes of every packet in msg (encode_many packs several)
+    i = 0
+    while i + 3 < len(msg):
+        yield msg[i + 3]
+        i += 3 + msg[i + 2]
+
+
+class CommandScheduler:
+    def __init__(self, maxsize=64, preempt_codes=()):
+        """maxsize: unkeyed backlog before put() blocks
+        preempt_codes: command codes an urgent command drops from the backlog"""
+        self.maxsize = maxsize
+        self.preempt_codes = frozenset(preempt_codes)
+        self._cond = Condition()
+        self._urgent = OrderedDict()  # msg -> (enqueue time, sent callback)
+        self._pending = OrderedDict()  # key -> (enqueue time, msg, sent callback)
+        self._sequence = count()
+        self._in_flight = 0
+        self._closed = False
+
+        # running stats
+        self.coalesced = 0  # commands overwritten before being sent
+        self.preempted = 0  # commands dropped by an urgent command
+
+    def qsize(self):
+        with self._cond:
+            return len(self._urgent) + len(self._pending)
+
+    def put(self, msg, key=None, urgent=False, timeout=None, sent=None):
+        """Queue a message (bytes) to send.
+        key: coalescing key, a newer message with the same key replaces this one
+        urgent: send ahead of everything else
+        timeout: how long to wait for room in the backlog before raising queue.Full
+        sent: handed back with the message by get_batch, for the writer to call"""
+        now = monotonic()
+        with self._cond:
+            if urgent:
+                # pending motion commands are now stale
+                stale = [k for k, (_, pending, _) in self._pending.items() if self._is_motion(pending)]
+                for k in stale:
+                    del self._pending[k]
+                self.preempted += len(stale)
+                self._urgent[msg] = (now, sent)
+
+            elif key is not None and key in self._pending:
+                # overwrite the unsent value, keeping its place in the line
+                self._pending[key] = (now, msg, sent)
+                self.coalesced += 1
+
+            else:
+                if key is None:
+                    # unkeyed commands get a unique slot of their own
+                    key = (_UNKEYED, next(self._sequence))
+                if not self._cond.wait_for(self._has_room, timeout):
+                    raise Full
+                self._pending[key] = (now, msg, sent)
+
+            self._cond.notify_all()
+
+    def room(self):
+        """Commands that can be queued before put() would block"""
+        with self._cond:
+            return max(self.maxsize - len(self._pending), 0)
+
+    def get_batch(self, timeout=None):
+        """Block until there is something to send, then take everything.
+        Returns a list of (enqueue time, msg, sent callback or None), urgent first.
+        Returns an empty list once closed (or on timeout)."""
+        with self._cond:
+            self._cond.wait_for(self._has_work, timeout)
+            batch = [(t, msg, sent) for msg, (t, sent) in self._urgent.items()]
+            batch.extend(self._pending.values())
+            self._urgent.clear()
+            self._pending.clear()
+            self._in_flight = len(batch)
+            if batch:
+                # room has been freed for blocked callers
+                self._cond.notify_all()
+            return batch
+
+    def task_done(self):
+        """Called by the writer once the last batch is on the wire."""
+        with self._cond:
+            self._in_flight = 0
+            self._cond.notify_all()
+
+    def wait_empty(self, timeout=None):
+        """Wait until every queued command has been written."""
+        with self._cond:
+            return self._cond.wait_for(self._is_empty, timeout)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _is_motion(self, msg):
+        return any(code in self.preempt_codes for code in _codes(msg))
+
+    # conditions (called with the lock held)
+    def _has_room(self):
+        return self._closed or len(self._pending) < self.maxsize
+
+    def _has_work(self):
+        return self._closed or bool(self._urgent) or bool(self._pending)
+
+    def _is_empty(self):
+        return not self._urgent and not self._pending and self._in_flight == 0
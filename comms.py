@@ -3,12 +3,21 @@ It also parses the Server Information Packages from the robot
 and assigns relevent info to a variable.
 """
 
-import serial
 import sys
 import atexit
-from threading import Thread
-from queue import Queue
-from time import sleep
+import logging
+import os
+from threading import Event, Thread
+from time import monotonic
+from sip_parser import SIPParser
+from metrics import MetricsRegistry
+from command_scheduler import CommandScheduler
+from heartbeat import HeartbeatService
+from recorder import SerialRecorder, INBOUND, OUTBOUND
+from sip_record import decode_standard_sip, is_standard_sip, SIPS_DICT_KEYS
+from transport import open_transport
+
+log = logging.getLogger(__name__)
 
 class Comms:
     # Full codes and info:
@@ -63,76 +72,154 @@ class Comms:
     STOP_COMMAND = [HEADER1, HEADER2, SHORTCOUNT, STOP, 00, 29]
     SIP_REQUEST = [HEADER1, HEADER2, BYTECOUNT, ENCODER, POSITIVE, 1, 20, 59]
 
-    # Dictionary made from SIPS for UI reporting variables
-    sips_dict = {'TYPE': 0,
-                 'XPOS': 0,
-                 'YPOS': 0,
-                 'THPOS': 0,
-                 'L_VEL': 0,
-                 'R_VEL': 0,
-                 'BATTERY': 0,
-                 'BUMPERS': 0,
-                 'CONTROL': 0,
-                 'FLAGS': 0,
-                 'COMPASS': 0,
-                 'GRIP_STATE': 0,
-                 'ANPORT': 0,
-                 'ANALOG': 0,
-                 'DIGIN': 0,
-                 'DIGOUT': 0,
-                 'ANALOGUE': 0}
-
-    def __init__(self):
-        print(f'initialise connection to host\n'
-              f'opens up the serial port as an object called "ser"{id}')
+    # commands where only the latest unsent value matters
+    # (VEL2 is coalesced per wheel)
+    COALESCE_CODES = (VEL, RVEL, VEL2, HEAD, DHEAD, ROTATE)
+    # commands that preempt everything else in the write queue
+    URGENT_CODES = (CLOSE, STOP, E_STOP)
+    # unsent commands an urgent one drops (anything that moves the robot)
+    MOTION_CODES = COALESCE_CODES + (MOVE,)
+
+    # longest a read waits for the first byte (secs)
+    READ_TIMEOUT = 0.05
+
+    def __init__(self, port=None, baudrate=9600, transport=None):
+        """port: serial device (or simulator pty) path, or tcp://host:port for
+             a serial-over-network bridge, defaults to default_port()
+        baudrate: host side baud rate
+        transport: an already open Transport to use instead of port"""
+        if transport is None:
+            if port is None:
+                port = self.default_port()
+            log.info('opening %s at %d baud', port, baudrate)
+            transport = open_transport(port, baudrate, self.READ_TIMEOUT)
+        # the transport (serial, TCP or loopback, see transport.py)
+        self.ser = transport
+
+        # streaming decoder for incoming server information packets
+        self.sip_parser = SIPParser()
+        # latest decoded standard SIP, swapped whole so readers never see a half update
+        self.sip = None
+        # optional TelemetryHistory ring buffer (see enable_history)
+        self.history = None
+        # optional SIPStreams pushing packets to subscribers (see enable_streams)
+        self.streams = None
+        # optional shared memory copy for other processes (see enable_shared_telemetry)
+        self.shared = None
+        # optional raw serial log (see start_recording)
+        self.recorder = None
+
+        # start a thread to wait for commands to write
+        self.command_scheduler = CommandScheduler(preempt_codes=self.MOTION_CODES)
+
+        # when anything last went on the wire (resets the server watchdog)
+        self.last_write = 0.0
+
+        # counters, gauges and histograms for the whole stack (see metrics.py)
+        # the hot path ones are kept as attributes to save the lookups
+        self.metrics = MetricsRegistry()
+        self._frames_out = self.metrics.counter('frames_out')
+        self._bytes_out = self.metrics.counter('bytes_out')
+        self._frames_in = self.metrics.counter('frames_in')
+        self._bytes_in = self.metrics.counter('bytes_in')
+        self._write_latency = self.metrics.histogram('write_latency')
+        self._sip_interval = self.metrics.histogram('sip_interarrival')
+        self.metrics.gauge('queue_depth', self.command_scheduler.qsize)
+        self.metrics.gauge('coalesced', lambda: self.command_scheduler.coalesced)
+        self.metrics.gauge('preempted', lambda: self.command_scheduler.preempted)
+        self.metrics.gauge('checksum_errors', lambda: self.sip_parser.checksum_errors)
+        self.metrics.gauge('resyncs', lambda: self.sip_parser.resyncs)
+        self.metrics.gauge('parser_overflows', lambda: self.sip_parser.overflows)
+        self.metrics.gauge('transport', self.ser.stats)
+
+        # watchdog pulses, started once the connection is made
+        self.heartbeat = HeartbeatService(self)
 
+        self.listeningThread = Thread(target=self.listening, args=(self.command_scheduler,), daemon=True)
+        self.listeningThread.start()
+
+        # optional background SIP reader (see start_reader)
+        self.readerThread = None
+        self._reader_stop = Event()
+
+        # close the robot down if the program exits without terminating
+        self.closed = False
+        atexit.register(self.close_sequence, self.CLOSE_DOWN_CODE)
+
+    @staticmethod
+    def default_port():
+        """Serial port the Jetson/laptop usually sees the robot on,
+        the REROBOT_PORT environment variable overrides it"""
+        if os.environ.get('REROBOT_PORT'):
+            return os.environ['REROBOT_PORT']
         if sys.platform.startswith('win'):
-            port = 'COM1'
+            return 'COM1'
         elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
             # this excludes your current terminal "/dev/tty"
-            port = '/dev/ttyUSB0'
+            return '/dev/ttyUSB0'
         elif sys.platform.startswith('darwin'):
-            port = '/dev/cu.usbserial-FT5ADV3R'
+            return '/dev/cu.usbserial-FT5ADV3R'
         else:
             raise EnvironmentError('Unsupported platform')
 
-        self.ser = serial.Serial(port=port,
-            baudrate=9600,
-            parity=serial.PARITY_NONE,
-            stopbits=serial.STOPBITS_ONE,
-            bytesize=serial.EIGHTBITS,
-            timeout=1
-            )
-        self.ser.isOpen()
-
-        # start a thread to wait for commands to write
-        self.incoming_commands_queue = Queue()
-
-        listeningThread = Thread(target=self.listening, args=(self.incoming_commands_queue,), daemon=True)
-        listeningThread.start()
-
-        atexit.register(self.close_sequence)
-
-    def listening(self, inputQueue):
+    def listening(self, scheduler):
+        # blocks until there is something to send, then drains
+        # everything pending into a single write
         while self.ser.isOpen():
-            if inputQueue.qsize() > 0:
-                input_str = inputQueue.get()
-                print("input_str = {}".format(input_str))
+            batch = scheduler.get_batch()
+            if not batch:
+                # close_sequence asked us to stop
+                break
 
-                # write message to Toshiba
-                self.ser.write(input_str)
+            # write message to Toshiba
+            outgoing = b''.join(msg for _, msg, _ in batch)
+            try:
+                self.ser.write(outgoing)
+            except OSError as e:
+                log.warning('writer stopped: %s', e)
+                break
+            sent = monotonic()
+            if self.recorder is not None:
+                self.recorder.record(OUTBOUND, outgoing, sent)
+            self.last_write = sent
+            self._notify_sent(batch, sent)
+            self._frames_out.inc(len(batch))
+            self._bytes_out.inc(len(outgoing))
+            for enqueued, _, _ in batch:
+                self._write_latency.observe(sent - enqueued)
+            scheduler.task_done()
 
-            # pause to let other threads work
-            sleep(0.01)
+    # tells write(sent=...) callers their message is on the wire
+    def _notify_sent(self, batch, sent):
+        for _, _, callback in batch:
+            if callback is not None:
+                try:
+                    callback(sent)
+                except Exception:
+                    log.exception('sent callback failed')
 
     # writes to server
-    def write(self, msg):
-        msg_hx = bytearray(msg)
-        print(f'sending hex message: {msg_hx} to {self.ser.port}')
-        # self.ser.write(msg_hx)
+    def write(self, msg, key=None, urgent=False, timeout=None, sent=None):
+        """Queue a message for the writer thread.
+        key: coalescing key, an unsent message with the same key is replaced
+        urgent: send ahead of the backlog (STOP, E_STOP and close down)
+        timeout: secs to wait for room in a full backlog before raising
+                 queue.Full (None waits, 0 never blocks)
+        sent: called on the writer thread with the monotonic time the
+              message went on the wire (never, if it is coalesced away
+              or preempted unsent)"""
+        msg_hx = bytes(msg)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('queueing %s', msg_hx.hex())
+        if msg_hx[3] in self.URGENT_CODES:
+            urgent = True
 
-        # put this into the Queue
-        self.incoming_commands_queue.put(msg_hx)
+        # put this into the scheduler
+        self.command_scheduler.put(msg_hx, key=key, urgent=urgent, timeout=timeout, sent=sent)
+
+    # enqueue-to-wire latency summary in millisecs
+    def latency_stats(self):
+        return self._write_latency.summary(scale=1000)
 
     # flush buffer
     def flush(self):
@@ -140,58 +227,182 @@ class Comms:
 
     # read from server buffer
     def read(self):
-        # Read incoming SIP
-        incoming = self.ser.read(255)
-        print (f'READING = {incoming}')
-        self.flush()
+        # Read whatever has arrived, waiting up to READ_TIMEOUT for the first byte
+        incoming = self.ser.read(self.ser.in_waiting or 1)
+        self._bytes_in.inc(len(incoming))
+        if self.recorder is not None:
+            self.recorder.record(INBOUND, incoming)
         return incoming
 
+    # keep parsing SIPs on a background thread
+    def start_reader(self):
+        """Reads and decodes everything the robot sends on its own thread.
+        Consumers pick up the latest snapshot from self.sip whenever they
+        like (it is replaced whole, never updated in place), so nothing
+        else needs to poll; parse_sip() does nothing while this runs."""
+        if self.reader_running:
+            return
+        self._reader_stop.clear()
+        self.readerThread = Thread(target=self.reading, daemon=True)
+        self.readerThread.start()
+
+    def stop_reader(self):
+        self._reader_stop.set()
+        if self.readerThread is not None:
+            self.readerThread.join(timeout=1)
+            self.readerThread = None
+
+    @property
+    def reader_running(self):
+        return self.readerThread is not None and self.readerThread.is_alive()
+
+    def reading(self):
+        # each read waits at most READ_TIMEOUT, so a stop is seen quickly
+        while not self._reader_stop.is_set() and self.ser.isOpen():
+            try:
+                incoming = self.read()
+            except OSError as e:
+                log.warning('SIP reader stopped: %s', e)
+                return
+            if incoming:
+                self.process_incoming(incoming)
+
+    # read complete packets, waiting up to timeout secs for any to arrive
+    def read_packets(self, timeout):
+        end = monotonic() + max(timeout, 0)
+        while True:
+            packets = self.sip_parser.feed(self.read())
+            self._frames_in.inc(len(packets))
+            if packets or monotonic() >= end:
+                return packets
+
     def send_sip_request(self):
         # Send ENCODE SIP request (might need IO SIP request!!)
+        # one-off; enable_streams() keeps them coming instead
         self.write(self.SIP_REQUEST)
 
+    # read whatever is waiting in the server buffer (never blocks)
+    def read_available(self):
+        waiting = self.ser.in_waiting
+        if not waiting:
+            return b''
+        incoming = self.ser.read(waiting)
+        self._bytes_in.inc(len(incoming))
+        if self.recorder is not None:
+            self.recorder.record(INBOUND, incoming)
+        return incoming
+
     # parse SIPS codes
     def parse_sip(self):
-        # Read incoming SIP
-        read_data = self.read()
-        print(f'return message is {read_data}')
-
-        # parse sips
-        decode_array = list(read_data)
-        for i, bytes in enumerate(decode_array):
-            if bytes == self.HEADER1 and decode_array[i+1] == self.HEADER2:
-
-                # assign relevant bytes to robots vars
-                length_string = decode_array[i + 2]
-                self.sips_dict['TYPE'] = decode_array[i + 3]
-                self.sips_dict['XPOS'] = decode_array[i + 4: i + 5]
-                self.sips_dict['YPOS'] = decode_array[i + 6: i + 7]
-                self.sips_dict['THPOS'] = decode_array[i + 8: i + 9]
-                self.sips_dict['L_VEL'] = decode_array[i + 10: i + 11]
-                self.sips_dict['R_VEL'] = decode_array[i + 12: i + 13]
-                self.sips_dict['BATTERY'] = decode_array[i + 14]
-                self.sips_dict['BUMPERS'] = decode_array[i + 15: i + 16]
-                self.sips_dict['CONTROL'] = decode_array[i + 17: i + 18]
-                self.sips_dict['FLAGS'] = decode_array[i + 19: i + 20]
-                self.sips_dict['COMPASS'] = decode_array[i + 21]
-
-                self.sips_dict['GRIP_STATE'] = decode_array[length_string - 10]
-                self.sips_dict['ANPORT'] = decode_array[length_string - 9]
-                self.sips_dict['ANALOG'] = decode_array[length_string - 8]
-                self.sips_dict['DIGIN'] = decode_array[length_string - 7]
-                self.sips_dict['DIGOUT'] = decode_array[length_string - 6]
-                self.sips_dict['ANALOGUE'] = decode_array[length_string - 5: length_string - 4]
+        """Feeds any waiting bytes through the SIP parser and returns the
+        list of complete packets. Partial packets are kept for the next call.
+        The most recent standard SIP is decoded into self.sip"""
+        if self.reader_running:
+            # the reader thread owns the port and the parser
+            return []
+        return self.process_incoming(self.read_available())
+
+    # run incoming bytes (from the port or a replayed log) through the parser
+    def process_incoming(self, data):
+        packets = self.sip_parser.feed(data)
+        self._frames_in.inc(len(packets))
+        streams = self.streams
+        for packet in packets:
+            # standard motor SIPs are type 0x3s (0x32 stopped, 0x33 moving)
+            if is_standard_sip(packet):
+                record = self.assign_sip(packet)
+                if streams is not None and record is not None:
+                    streams.standard(packet, record)
+            elif streams is not None:
+                streams.dispatch(packet, monotonic())
+        return packets
+
+    # decode a standard SIP and publish it as the latest snapshot
+    def assign_sip(self, packet):
+        record = decode_standard_sip(packet, monotonic())
+        if record is not None:
+            if self.sip is not None:
+                self._sip_interval.observe(record.time - self.sip.time)
+            self.sip = record
+            if self.history is not None:
+                self.history.append(record)
+            if self.shared is not None:
+                self.shared.publish(record)
+        return record
+
+    # push standard, IO and encoder SIPs to subscribers as they arrive
+    def enable_streams(self, io=True, encoder=True):
+        """Turns on continuous IO and/or encoder SIPs (renewed automatically)
+        and the background reader, returns the SIPStreams to subscribe to"""
+        from sip_stream import SIPStreams
+        if self.streams is None:
+            self.streams = SIPStreams(self)
+        self.streams.start(io, encoder)
+        self.start_reader()
+        return self.streams
+
+    # keep a NumPy ring buffer of recent SIPs for window queries
+    def enable_history(self, capacity=2048):
+        # imported here so NumPy is only needed when history is used
+        from telemetry_history import TelemetryHistory
+        if self.history is None:
+            self.history = TelemetryHistory(capacity)
+        return self.history
+
+    # publish the latest SIP (and a short history) to other local processes
+    def enable_shared_telemetry(self, name=None, history=0):
+        """Starts writing each decoded SIP to a shared memory block that
+        shared_telemetry.TelemetryReader(name) can read from other processes"""
+        from shared_telemetry import SharedTelemetry, DEFAULT_NAME
+        if self.shared is None:
+            self.shared = SharedTelemetry(name or DEFAULT_NAME, history)
+        return self.shared
+
+    # log every serial chunk in and out to a binary file
+    def start_recording(self, path):
+        self.stop_recording()
+        self.recorder = SerialRecorder(path)
+        return self.recorder
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    # latest SIP values for UI reporting variables
+    @property
+    def sips_dict(self):
+        if self.sip is None:
+            return dict.fromkeys(SIPS_DICT_KEYS, 0)
+        return self.sip.as_dict()
 
     # closes down server robot and serial port
     def close_sequence(self, terminate_code):
-        terminate_code = bytearray(terminate_code)
-        self.ser.write(terminate_code)
-        print ('Robot closing down')
+        # safe to call again (terminate, then atexit)
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close_sequence)
+        self.heartbeat.stop()
+        self.stop_reader()
+
+        # close down goes out ahead of anything still queued,
+        # then wait for the writer to put it on the wire
+        self.write(terminate_code, urgent=True)
+        self.command_scheduler.wait_empty(timeout=1)
+        self.command_scheduler.close()
+        self.listeningThread.join(timeout=1)
+        log.info('robot closing down')
+        self.metrics.stop_dump()
+        self.stop_recording()
+        shared, self.shared = self.shared, None
+        if shared is not None:
+            shared.close()
         self.ser.close()
-        print("All closed - see ya!!")
+        log.info('all closed - see ya!!')
 
     # Heartbeat pulse
     def pulse(self):
-        # writes a pulse (as raw Hex for now)
-        # self.ser.write(b"\xFA\xFB\x03\x00\x00\x00")
-        self.ser.write(self.HEARTBEAT)
+        # queues a pulse through the writer (only the latest unsent one is kept)
+        # b"\xFA\xFB\x03\x00\x00\x00"
+        self.write(self.HEARTBEAT, key='pulse')
@@ -0,0 +1,392 @@
+"""Network control server so remote processes (ML models etc.) can drive a Robot.
+Exposes the Robot command set and the SIP stream over a compact binary
+protocol on TCP and UDP. Everything is little-endian:
+    message:  op (uint8), flags (uint8), seq (uint16), payload
+    TCP frames each message with a uint16 length; UDP sends one per datagram.
+Requests (each answered with op | 0x80, same seq, status uint8 0 = ok):
+    CMD       cmd code (uint8), value (int16); flag NO_ARG for short commands
+    BATCH     count (uint8), count x (cmd code, value)
+    CALL      method id (uint8, see METHODS), value (int16)
+    SUBSCRIBE rate in Hz (float32), 0 to unsubscribe
+    PING      any payload, echoed back
+Telemetry is pushed as TELEMETRY messages (see TELEMETRY struct) at each
+client's rate, only when the SIP has changed. A UDP subscription is a
+lease: it lapses LEASE secs after the client's last request, so a UDP
+subscriber renews it by re-sending SUBSCRIBE (or any request, e.g. PING).
+TCP subscriptions last as long as the connection. Requests can be
+pipelined, and a BATCH is all or nothing: it is checked in full (length
+and room in the backlog) before any of its commands are queued.
+Commands only queue on the robot's writer so clients can never stall the
+serial link: when its backlog is full a request is answered ERROR rather
+than waiting. Slow TCP subscribers have telemetry dropped (back pressure)
+once their send buffer passes MAX_BUFFERED, and a client that pipelines
+requests without reading the replies is not read from until it catches up.
+
+    python control_server.py --robot-port /dev/ttyUSB0 --host 0.0.0.0
+"""
+
+import argparse
+import asyncio
+import logging
+import socket
+import struct
+from queue import Full
+from time import monotonic
+
+HEADER = struct.Struct('<BBH')
+LENGTH = struct.Struct('<H')
+COMMAND = struct.Struct('<Bh')
+STATUS = struct.Struct('<B')
+RATE = struct.Struct('<f')
+# time, x, y, heading, l vel, r vel, battery, bumpers, flags, type
+TELEMETRY = struct.Struct('<dffffffHHB')
+
+CMD, BATCH, CALL, SUBSCRIBE, PING = 0x01, 0x02, 0x03, 0x04, 0x05
+REPLY = 0x80
+TELEMETRY_OP = 0x90
+NO_ARG = 0x01
+OK, ERROR = 0, 1
+
+# Robot methods callable with CALL; value is passed to the ones that take one
+METHODS = ('nudge', 'move', 'rvel', 'head', 'rotate', 'stop',
+           'step_forward', 'step_backward', 'step_left', 'step_right',
+           'gripper_up', 'gripper_down', 'gripper_stop',
+           'paddle_open', 'paddle_close', 'paddle_stop', 'all_halt',
+           'forward', 'backward')
+TAKES_VALUE = ('nudge', 'move', 'rvel', 'head', 'rotate', 'forward', 'backward')
+
+DEFAULT_TCP_PORT = 9750
+DEFAULT_UDP_PORT = 9751
+
+log = logging.getLogger(__name__)
+
+
+def pack_message(op, seq, payload=b'', flags=0):
+    return HEADER.pack(op, flags, seq & 0xFFFF) + payload
+
+
+def pack_telemetry(sip):
+    return TELEMETRY.pack(sip.time, sip.x, sip.y, sip.heading, sip.l_vel, sip.r_vel,
+                          sip.battery, sip.bumpers, sip.flags, sip.type)
+
+
+class ControlServer:
+    MAX_BUFFERED = 64 * 1024  # bytes queued to a TCP client before telemetry is dropped
+    MAX_RATE = 100.0  # Hz
+    LEASE = 10.0  # secs a UDP subscription lasts without hearing from the client
+
+    def __init__(self, robot, host='127.0.0.1', tcp_port=DEFAULT_TCP_PORT, udp_port=DEFAULT_UDP_PORT):
+        self.robot = robot
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+
+        self.commands = 0
+        self.rejected = 0  # requests refused because the robot's backlog was full
+        self.telemetry_sent = 0
+        self.telemetry_dropped = 0
+
+        self._tcp_server = None
+        self._udp_transport = None
+        self._subscriptions = {}  # client -> task
+        self._leases = {}  # UDP client -> when its subscription lapses
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._tcp_server = await asyncio.start_server(self._serve_tcp, self.host, self.tcp_port)
+        for sock in self._tcp_server.sockets:
+            if sock.family in (socket.AF_INET, socket.AF_INET6):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.udp_port is not None:
+            self._udp_transport, _ = await loop.create_datagram_endpoint(
+                lambda: _UDPProtocol(self), local_addr=(self.host, self.udp_port))
+        # keeps robot.motor.sip fresh off the event loop
+        self.robot.motor.start_reader()
+
+    async def close(self):
+        for task in list(self._subscriptions.values()):
+            task.cancel()
+        if self._udp_transport:
+            self._udp_transport.close()
+        if self._tcp_server:
+            self._tcp_server.close()
+            await self._tcp_server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._tcp_server.serve_forever()
+        finally:
+            await self.close()
+
+    # requests
+    def handle(self, message, client):
+        """Runs one request, returns the reply message"""
+        op, flags, seq = HEADER.unpack_from(message)
+        payload = memoryview(message)[HEADER.size:]
+        if client in self._leases:
+            self._leases[client] = monotonic() + self.LEASE
+        status = OK
+        reply = b''
+        try:
+            if op == CMD:
+                cmd, value = COMMAND.unpack_from(payload)
+                self._cmd(cmd, None if flags & NO_ARG else value)
+            elif op == BATCH:
+                count = payload[0]
+                # all or nothing: nothing is queued from a short payload
+                if len(payload) != 1 + count * COMMAND.size:
+                    raise ValueError(f'BATCH of {count} needs {count * COMMAND.size} bytes, '
+                                     f'got {len(payload) - 1}')
+                commands = [COMMAND.unpack_from(payload, 1 + i * COMMAND.size) for i in range(count)]
+                if self.robot.motor.command_scheduler.room() < count:
+                    raise Full
+                for cmd, value in commands:
+                    self._cmd(cmd, value)
+            elif op == CALL:
+                method, value = COMMAND.unpack_from(payload)
+                name = METHODS[method]
+                # Robot methods queue with a blocking put, only call them with room
+                if self.robot.motor.command_scheduler.room() < 1:
+                    raise Full
+                if name in TAKES_VALUE:
+                    getattr(self.robot, name)(value)
+                else:
+                    getattr(self.robot, name)()
+                self.commands += 1
+            elif op == SUBSCRIBE:
+                rate, = RATE.unpack_from(payload)
+                self._subscribe(client, rate)
+            elif op == PING:
+                reply = bytes(payload)
+            else:
+                status = ERROR
+        except (struct.error, IndexError, ValueError) as e:
+            log.warning('bad request %#x from %s: %s', op, client, e)
+            status = ERROR
+        except Full:
+            # the robot's write backlog is full; never block the event loop
+            self.rejected += 1
+            status = ERROR
+        if op == PING:
+            return pack_message(op | REPLY, seq, reply)
+        return pack_message(op | REPLY, seq, STATUS.pack(status))
+
+    def _cmd(self, cmd, value):
+        motor = self.robot.motor
+        if cmd == motor.STOP:
+            self.robot.stop()  # also cancels any pending timed stop
+        elif value is None:
+            motor.write(motor.encoder.encode(cmd), timeout=0)
+        else:
+            motor.cmd(cmd, value, timeout=0)
+        self.commands += 1
+
+    # telemetry
+    def _subscribe(self, client, rate):
+        task = self._subscriptions.pop(client, None)
+        if task:
+            task.cancel()
+        self._leases.pop(client, None)
+        if rate > 0:
+            rate = min(rate, self.MAX_RATE)
+            if client.leased:
+                self._leases[client] = monotonic() + self.LEASE
+            self._subscriptions[client] = asyncio.get_running_loop().create_task(
+                self._publish(client, 1 / rate))
+
+    def unsubscribe(self, client):
+        self._subscribe(client, 0)
+
+    async def _publish(self, client, interval):
+        last = None
+        next_send = monotonic()
+        while True:
+            lapses = self._leases.get(client)
+            if lapses is not None and monotonic() > lapses:
+                # the client went quiet; stop sending into the void
+                log.info('telemetry subscription for %s lapsed', client)
+                if self._subscriptions.get(client) is asyncio.current_task():
+                    del self._subscriptions[client]
+                    del self._leases[client]
+                return
+            sip = self.robot.motor.sip
+            if sip is not None and sip is not last:
+                if client.send(pack_message(TELEMETRY_OP, 0, pack_telemetry(sip))):
+                    self.telemetry_sent += 1
+                    last = sip
+                else:
+                    self.telemetry_dropped += 1
+            next_send += interval
+            await asyncio.sleep(max(next_send - monotonic(), 0))
+
+    # TCP
+    async def _serve_tcp(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = _TCPClient(writer, self.MAX_BUFFERED)
+        try:
+            while True:
+                length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+                message = await reader.readexactly(length)
+                client.send(self.handle(message, client), force=True)
+                # replies always go out, so stop reading until they are taken
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.unsubscribe(client)
+            writer.close()
+
+
+class _TCPClient:
+    leased = False  # subscriptions end with the connection
+
+    def __init__(self, writer, max_buffered):
+        self.writer = writer
+        self.max_buffered = max_buffered
+
+    def send(self, message, force=False):
+        """Queues a message, returns False (dropped) if the client is too far behind"""
+        transport = self.writer.transport
+        if transport.is_closing():
+            return False
+        if not force and transport.get_write_buffer_size() > self.max_buffered:
+            return False
+        self.writer.write(LENGTH.pack(len(message)) + message)
+        return True
+
+    def __repr__(self):
+        return f'tcp {self.writer.get_extra_info("peername")}'
+
+
+class _UDPClient:
+    leased = True  # nothing tells us a UDP client has gone
+
+    def __init__(self, transport, addr):
+        self.transport = transport
+        self.addr = addr
+
+    def send(self, message, force=False):
+        # datagrams are never queued, the OS drops them if it must
+        self.transport.sendto(message, self.addr)
+        return True
+
+    def __hash__(self):
+        return hash(self.addr)
+
+    def __eq__(self, other):
+        return isinstance(other, _UDPClient) and other.addr == self.addr
+
+    def __repr__(self):
+        return f'udp {self.addr}'
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < HEADER.size:
+            return
+        client = _UDPClient(self.transport, addr)
+        client.send(self.server.handle(data, client))
+
+
+class ControlClient:
+    """Minimal blocking TCP client for the control server.
+    Requests can be pipelined: send several, then read the replies."""
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_TCP_PORT):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._seq = 0
+        self._buf = bytearray()
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, op, payload=b'', flags=0):
+        """Sends a request without waiting, returns its seq"""
+        self._seq = (self._seq + 1) & 0xFFFF
+        message = pack_message(op, self._seq, payload, flags)
+        self.sock.sendall(LENGTH.pack(len(message)) + message)
+        return self._seq
+
+    def receive(self):
+        """Next message from the server as (op, seq, payload)"""
+        length, = LENGTH.unpack(self._recv_exactly(LENGTH.size))
+        message = self._recv_exactly(length)
+        op, _, seq = HEADER.unpack_from(message)
+        return op, seq, message[HEADER.size:]
+
+    def request(self, op, payload=b'', flags=0):
+        """Sends a request and waits for its reply (telemetry in between is skipped)"""
+        seq = self.send(op, payload, flags)
+        while True:
+            reply_op, reply_seq, reply = self.receive()
+            if reply_op == op | REPLY and reply_seq == seq:
+                return reply
+
+    def cmd(self, cmd, value=None):
+        flags = NO_ARG if value is None else 0
+        return self.request(CMD, COMMAND.pack(cmd, value or 0), flags)[0] == OK
+
+    def batch(self, commands):
+        payload = bytes([len(commands)]) + b''.join(COMMAND.pack(c, v) for c, v in commands)
+        return self.request(BATCH, payload)[0] == OK
+
+    def call(self, method, value=0):
+        return self.request(CALL, COMMAND.pack(METHODS.index(method), value))[0] == OK
+
+    def subscribe(self, rate):
+        return self.request(SUBSCRIBE, RATE.pack(rate))[0] == OK
+
+    def ping(self):
+        """Round trip time in secs"""
+        start = monotonic()
+        self.request(PING, struct.pack('<d', start))
+        return monotonic() - start
+
+    def telemetry(self):
+        """Yields telemetry tuples as they arrive (see TELEMETRY)"""
+        while True:
+            op, _, payload = self.receive()
+            if op == TELEMETRY_OP:
+                yield TELEMETRY.unpack(payload)
+
+    def _recv_exactly(self, n):
+        while len(self._buf) < n:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError('control server closed the connection')
+            self._buf += chunk
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Network control server for a ReRo robot')
+    parser.add_argument('--robot-port', default=None, help='serial port of the robot')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--tcp-port', type=int, default=DEFAULT_TCP_PORT)
+    parser.add_argument('--udp-port', type=int, default=DEFAULT_UDP_PORT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+
+    from rerobot import Robot
+    robot = Robot(port=args.robot_port)
+    server = ControlServer(robot, args.host, args.tcp_port, args.udp_port)
+    print(f'control server on tcp {args.host}:{args.tcp_port} udp {args.udp_port}')
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        robot.terminate()
@@ -0,0 +1,97 @@
+"""Builds P2OS command packets.
+Command packet layout (pg 37 of the Pioneer 2 manual):
+    0xFA 0xFB | byte count | command | arg type | arg lo | arg hi | checksum hi | checksum lo
+arg type is 0x3B for a positive integer and 0x1B for a negative one,
+the argument itself is the absolute value, least significant byte first.
+Commands without an argument are sent as a short (byte count 3) packet.
+"""
+
+import struct
+
+from sip_parser import HEADER1, HEADER2
+
+POSITIVE = 0x3B
+NEGATIVE = 0x1B
+BYTECOUNT = 6
+SHORTCOUNT = 3
+MIN_ARG = -0x8000
+MAX_ARG = 0x7FFF
+
+# header x2, byte count, command, arg type, argument (LSB first), checksum hi, checksum lo
+_FRAME = struct.Struct('<BBBBBHBB')
+# header x2, byte count, command, checksum hi (always 0), checksum lo
+_SHORT_FRAME = struct.Struct('<BBBBBB')
+
+
+class FrameEncoder:
+    """Encodes commands with precompiled structs.
+    encode() returns a ready to send packet (a single bytes allocation).
+    encode_many() packs a list of commands into one preallocated buffer
+    so a whole batch goes to the writer as one message."""
+
+    def __init__(self, capacity=256):
+        self._buf = bytearray(capacity)
+        # per command checksum templates: first data word for +/- arguments
+        self._templates = {}
+
+    def _template(self, cmd):
+        template = self._templates.get(cmd)
+        if template is None:
+            template = ((cmd << 8) | POSITIVE, (cmd << 8) | NEGATIVE)
+            self._templates[cmd] = template
+        return template
+
+    def encode(self, cmd, value=None):
+        """Packet for command cmd with a signed 16 bit argument
+        (or a short packet if value is None)."""
+        if value is None:
+            return _SHORT_FRAME.pack(HEADER1, HEADER2, SHORTCOUNT, cmd, 0, cmd)
+        argtype, arg, cs = self._arg(cmd, value)
+        return _FRAME.pack(HEADER1, HEADER2, BYTECOUNT, cmd, argtype, arg, cs >> 8, cs & 0xFF)
+
+    def encode_into(self, buf, offset, cmd, value=None):
+        """Packs a packet into buf at offset, returns the offset after it."""
+        if value is None:
+            _SHORT_FRAME.pack_into(buf, offset, HEADER1, HEADER2, SHORTCOUNT, cmd, 0, cmd)
+            return offset + _SHORT_FRAME.size
+        argtype, arg, cs = self._arg(cmd, value)
+        _FRAME.pack_into(buf, offset, HEADER1, HEADER2, BYTECOUNT, cmd, argtype, arg, cs >> 8, cs & 0xFF)
+        return offset + _FRAME.size
+
+    def encode_many(self, commands):
+        """Packs an iterable of (cmd, value) pairs into one message."""
+        commands = list(commands)
+        needed = len(commands) * _FRAME.size
+        if needed > len(self._buf):
+            self._buf = bytearray(needed)
+        offset = 0
+        for cmd, value in commands:
+            offset = self.encode_into(self._buf, offset, cmd, value)
+        return bytes(memoryview(self._buf)[:offset])
+
+    def _arg(self, cmd, value):
+        value = int(value)
+        if value < MIN_ARG or value > MAX_ARG:
+            raise ValueError(f'argument {value} does not fit a signed 16 bit integer')
+        positive, negative = self._template(cmd)
+        if value >= 0:
+            argtype, word = POSITIVE, positive
+        else:
+            argtype, word = NEGATIVE, negative
+            value = -value
+        # second data word is the argument bytes read big-endian
+        cs = (word + (((value & 0xFF) << 8) | (value >> 8))) & 0xFFFF
+        return argtype, value, cs
+
+
+def vel2_arg(left, right):
+    """Argument for VEL2: left wheel in bits 8-15, right wheel in bits 0-7,
+    each a signed byte (20mm/sec units). Returned as the signed 16 bit
+    value whose two's complement has exactly those bytes."""
+    for speed in (left, right):
+        if speed < -128 or speed > 127:
+            raise ValueError(f'wheel velocity {speed} does not fit a signed byte')
+    value = ((left & 0xFF) << 8) | (right & 0xFF)
+    if value > MAX_ARG:
+        value -= 0x10000
+    return value
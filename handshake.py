@@ -0,0 +1,142 @@
+"""Client-server connection handshake as a state machine.
+The handshake does no I/O itself, so the same machine can be driven
+by the blocking Motor, the asyncio layer or a selector loop:
+    msgs = hs.start(now)          # send these
+    msgs = hs.on_packet(pkt, now) # for every packet read, send these
+    msgs = hs.poll(now)           # when hs.deadline passes, send these
+until hs.finished; then check hs.failed / hs.error.
+
+Steps (pg 37 of the Pioneer 2 manual):
+    SYNC0, SYNC1 - the server echoes the packet back
+    SYNC2        - the server replies with its name, class and subclass
+    CONNECT      - opening and motor setup codes are sent in one go
+                   (pipelined), then we wait for the first SIP to confirm
+Each step has its own deadline and a bounded number of resends.
+"""
+
+from sip_parser import HEADER1, HEADER2
+
+SYNC0, SYNC1, SYNC2, CONNECT, DONE, FAILED = 'SYNC0', 'SYNC1', 'SYNC2', 'CONNECT', 'DONE', 'FAILED'
+
+SYNC_CODES = (bytes([HEADER1, HEADER2, 3, 0, 0, 0]),
+              bytes([HEADER1, HEADER2, 3, 1, 0, 1]),
+              bytes([HEADER1, HEADER2, 3, 2, 0, 2]))
+CLOSE_CODE = bytes([HEADER1, HEADER2, 3, 2, 0, 2])
+
+
+class HandshakeError(ConnectionError):
+    """The robot did not complete the connection handshake in time."""
+
+
+class Handshake:
+    def __init__(self, connect_codes, step_timeout=0.25, confirm_timeout=0.5, retries=3):
+        """connect_codes: list of opening and motor setup packets (bytes)
+        step_timeout: secs to wait for each SYNC reply before resending
+        confirm_timeout: secs to wait for the first SIP after connecting
+        retries: resends allowed per step before giving up"""
+        self.connect_codes = b''.join(bytes(code) for code in connect_codes)
+        self.step_timeout = step_timeout
+        self.confirm_timeout = confirm_timeout
+        self.retries = retries
+
+        self.state = None
+        self.deadline = None
+        self.error = None
+        self.robot_info = None  # (name, class, subclass) from the SYNC2 reply
+        self.started = None
+        self.finished_at = None
+        self._attempts = 0
+        self._restarts = 0
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED)
+
+    @property
+    def failed(self):
+        return self.state == FAILED
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started
+
+    def start(self, now):
+        self.started = now
+        return self._enter(SYNC0, now)
+
+    def on_packet(self, packet, now):
+        if self.finished:
+            return []
+        code = packet[3]
+
+        if self.state in (SYNC0, SYNC1, SYNC2):
+            step = (SYNC0, SYNC1, SYNC2).index(self.state)
+            if code == step:
+                # matches the packet we sent (by its command byte prefix)
+                if self.state == SYNC2:
+                    self.robot_info = self._parse_id(packet)
+                    return self._enter(CONNECT, now)
+                return self._enter((SYNC1, SYNC2)[step], now)
+            if code & 0xF0 == 0x30:
+                # SIPs mean the server is still connected to an old client;
+                # close it down and start again
+                return self._restart(now)
+            return []
+
+        if self.state == CONNECT:
+            # any standard (0x3s) or config (0x20) SIP confirms the connection
+            if code & 0xF0 == 0x30 or code == 0x20:
+                self.state = DONE
+                self.deadline = None
+                self.finished_at = now
+        return []
+
+    def poll(self, now):
+        if self.finished or self.deadline is None or now < self.deadline:
+            return []
+        if self._attempts > self.retries:
+            return self._fail(now, f'no reply to {self.state} after {self._attempts} attempts')
+        return self._send(now)
+
+    def abort(self, now, reason):
+        """Gives up (e.g. the port has gone), if not already finished"""
+        if not self.finished:
+            self._fail(now, reason)
+
+    # internals
+    def _enter(self, state, now):
+        self.state = state
+        self._attempts = 0
+        return self._send(now)
+
+    def _send(self, now):
+        self._attempts += 1
+        if self.state == CONNECT:
+            self.deadline = now + self.confirm_timeout
+            return [self.connect_codes]
+        self.deadline = now + self.step_timeout
+        return [SYNC_CODES[(SYNC0, SYNC1, SYNC2).index(self.state)]]
+
+    def _restart(self, now):
+        self._restarts += 1
+        if self._restarts > self.retries:
+            return self._fail(now, 'server would not drop its previous connection')
+        return [CLOSE_CODE] + self._enter(SYNC0, now)
+
+    def _fail(self, now, reason):
+        self.state = FAILED
+        self.deadline = None
+        self.finished_at = now
+        self.error = HandshakeError(reason)
+        return []
+
+    @staticmethod
+    def _parse_id(packet):
+        # name, class and subclass as NUL terminated strings
+        fields = bytes(packet[4:-2]).split(b'\x00')
+        fields = [f.decode('ascii', 'replace') for f in fields[:3]]
+        while len(fields) < 3:
+            fields.append('')
+        return tuple(fields)
@@ -0,0 +1,77 @@
+"""Heartbeat service that keeps the P2OS watchdog fed.
+Runs on its own thread on a fixed monotonic schedule (tick k is due at
+start + k * interval, so one late tick doesn't push the rest back) and
+sends the pulse through Comms.write, i.e. the same ordered write path
+as every other command.
+Any packet the server receives resets its watchdog, so a tick is
+skipped when other traffic went out within the last half interval
+(the longest gap on the wire is then 1.5 intervals).
+"""
+
+from threading import Event, Thread
+from time import monotonic
+
+
+class HeartbeatService:
+    def __init__(self, comms, interval=0.5):
+        """comms: the Comms to pulse (needs pulse(), last_write and metrics)
+        interval: secs between pulses, well inside the 2 sec watchdog"""
+        self.comms = comms
+        self.interval = interval
+
+        # how late (secs) each tick woke up against its schedule
+        self.jitter = comms.metrics.histogram('heartbeat_jitter')
+        self.pulses = comms.metrics.counter('heartbeat_pulses')
+        # ticks not needed thanks to other traffic
+        self.skipped = comms.metrics.counter('heartbeat_skipped')
+        # ticks that were overrun completely
+        self.missed = comms.metrics.counter('heartbeat_missed')
+
+        self._stop = Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self):
+        due = monotonic() + self.interval
+        while not self._stop.wait(max(due - monotonic(), 0)):
+            now = monotonic()
+            self.jitter.observe(now - due)
+
+            if now - self.comms.last_write < self.interval / 2:
+                self.skipped.inc()
+            else:
+                self.comms.pulse()
+                self.pulses.inc()
+
+            due += self.interval
+            if due <= now:
+                # overran whole ticks; don't burst to catch up
+                late = int((now - due) // self.interval) + 1
+                self.missed.inc(late)
+                due += late * self.interval
+
+    def stats(self):
+        """Pulse counts and tick jitter in millisecs"""
+        stats = {'pulses': self.pulses.value,
+                 'skipped': self.skipped.value,
+                 'missed': self.missed.value}
+        if self.jitter.count:
+            stats['jitter_mean'] = self.jitter.total / self.jitter.count * 1000
+            stats['jitter_max'] = self.jitter.max * 1000
+        return stats
@@ -0,0 +1,161 @@
+"""Lightweight metrics registry for the comms stack.
+Counters, gauges and histograms are plain Python objects updated in
+place, cheap enough for the write and read hot paths (each metric is
+only updated from one thread, so there are no locks). Gauges can also
+be callables that are only read when a snapshot is taken.
+
+    metrics = robot.motor.metrics
+    metrics.snapshot()          # dict of every value, counter rates included
+    metrics.start_dump(5.0)     # log a snapshot every 5 secs
+
+Histogram buckets double from 10 usecs to about 10 secs, so percentiles
+are upper bounds within a factor of two; min, max and mean are exact.
+"""
+
+import json
+import logging
+from bisect import bisect_left
+from threading import Event, Thread
+from time import monotonic
+
+log = logging.getLogger(__name__)
+
+# 10 usecs .. ~10.5 secs
+DEFAULT_BOUNDS = tuple(1e-5 * 2 ** i for i in range(21))
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge:
+    __slots__ = ('value', 'fn')
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn  # read at snapshot time instead of value
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class Histogram:
+    __slots__ = ('bounds', 'buckets', 'count', 'total', 'min', 'max')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)  # last one is overflow
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q (0-1) quantile"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self, scale=1.0):
+        """count, min, mean, p50, p95, p99 and max, values multiplied by scale"""
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'min': self.min * scale,
+                'mean': self.total / self.count * scale,
+                'p50': self.percentile(0.5) * scale,
+                'p95': self.percentile(0.95) * scale,
+                'p99': self.percentile(0.99) * scale,
+                'max': self.max * scale}
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._last_snapshot = None  # (time, counter values) for rates
+        self._dump_stop = None
+        self.started = monotonic()
+
+    def _get(self, name, kind, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = kind(*args)
+        elif not isinstance(metric, kind):
+            raise TypeError(f'metric {name} is a {type(metric).__name__}')
+        return metric
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name, fn=None):
+        gauge = self._get(name, Gauge)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, bounds=DEFAULT_BOUNDS):
+        return self._get(name, Histogram, bounds)
+
+    def snapshot(self):
+        """Every metric as a dict. Counters also get a '<name>_per_sec'
+        rate over the time since the previous snapshot (or since start).
+        Histograms are summarised in millisecs."""
+        now = monotonic()
+        previous_time, previous = self._last_snapshot or (self.started, {})
+        elapsed = now - previous_time
+        snap = {}
+        counters = {}
+        for name, metric in sorted(self._metrics.items()):
+            if isinstance(metric, Counter):
+                counters[name] = value = metric.value
+                snap[name] = value
+                if elapsed > 0:
+                    snap[f'{name}_per_sec'] = (value - previous.get(name, 0)) / elapsed
+            elif isinstance(metric, Gauge):
+                snap[name] = metric.read()
+            else:
+                snap[name] = metric.summary(scale=1000)
+        self._last_snapshot = (now, counters)
+        return snap
+
+    # periodic dump
+    def start_dump(self, interval=5.0, output=None):
+        """Logs a snapshot every interval secs (or passes it to output)"""
+        self.stop_dump()
+        self._dump_stop = stop = Event()
+        output = output or (lambda snap: log.info('metrics %s', json.dumps(snap)))
+
+        def dump():
+            while not stop.wait(interval):
+                output(self.snapshot())
+
+        Thread(target=dump, daemon=True).start()
+
+    def stop_dump(self):
+        if self._dump_stop is not None:
+            self._dump_stop.set()
+            self._dump_stop = None
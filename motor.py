@@ -10,34 +10,108 @@ write_cmd() = sends command to server
 
 """
 
-from time import sleep
+import logging
+from threading import Lock
+from time import monotonic
 from comms import Comms
+from handshake import Handshake
+from frame_encoder import FrameEncoder, vel2_arg
+from baud_rate import upgrade_baud
+from sip_parser import checksum
 
-class Motor(Comms):
-    def __init__(self):
-        super().__init__()
+log = logging.getLogger(__name__)
+
+# connected Motors by port, shared through Motor.acquire
+_shared = {}
+_shared_lock = Lock()
 
-        # define all start-up code sequences (inherited from Comms class)
-        # b"\xFA\xFB\x03\x00\x00\x00", b"\xFA\xFB\x03\x01\x00\x01", b"\xFA\xFB\x03\x02\x00\x02"
-        init_string = [self.HEADER1, self.HEADER2, self.SHORTCOUNT, self.SYNC0, 0, 0], \
-                      [self.HEADER1, self.HEADER2, self.SHORTCOUNT, self.SYNC1, 0, 1], \
-                      [self.HEADER1, self.HEADER2, self.SHORTCOUNT, self.SYNC2, 0, 2]
+class Motor(Comms):
+    def __init__(self, port=None, baudrate=9600, max_baud=115200, transport=None):
+        """max_baud: fastest host baud rate to switch up to once connected
+        (None or baudrate keeps the link at baudrate)
+        transport: an open Transport to use instead of port (see transport.py)"""
+        # users of a Motor shared by acquire(), the last release() terminates it
+        self._users = 1
+        self._shared_key = None
+        super().__init__(port, baudrate, transport)
+
+        # precompiled command packet builder
+        self.encoder = FrameEncoder()
+        # last VEL2 wheel velocities [left, right] in 20mm/sec units
+        self.wheel_vels = [0, 0]
 
+        # start up sequence
+        # SYNC0-2 are sent in lock-step (the server has to echo each one)
+        # then the opening and motor codes go out pipelined in one write
+        log.info('1.....Sending start-up codes SYNC0, SYNC1 and SYNC2, '
+                 'then opening and motor setup codes')
+        self.handshake = Handshake(self.connect_codes())
+        try:
+            self.connect(self.handshake)
+            log.info('2.....Connected to %s in %.3f secs',
+                     self.handshake.robot_info, self.handshake.duration)
+
+            # P2OS always connects at 9600, then we ask for something faster
+            # (a TCP bridge's serial side is set on the bridge)
+            if max_baud and max_baud > baudrate and self.ser.adjustable_baud:
+                rate = upgrade_baud(self, max_baud)
+                log.info('3.....Link running at %d baud', rate)
+        except Exception:
+            # don't leave the port, the writer and the atexit hook behind
+            # for a caller that retries
+            self.close_sequence(self.CLOSE_DOWN_CODE)
+            raise
+
+        # keep sending pulse heartbeats to maintain conns
+        self.heartbeat.start()
+        log.info('REROBOT READY')
+
+    @classmethod
+    def acquire(cls, port=None, baudrate=9600, max_baud=115200):
+        """The connected Motor for port, shared: another caller for the same
+        port (e.g. two Robots on one TCP bridge) gets the same Motor, so the
+        controller sees one handshake, one reader and one close down.
+        Give it back with release()."""
+        if port is None:
+            port = cls.default_port()
+        with _shared_lock:
+            motor = _shared.get(port)
+            if motor is None or motor.closed:
+                motor = cls(port, baudrate, max_baud)
+                motor._shared_key = port
+                _shared[port] = motor
+            else:
+                motor._users += 1
+            return motor
+
+    def release(self):
+        """Gives back a Motor from acquire(); the last user terminates it"""
+        with _shared_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            if _shared.get(self._shared_key) is self:
+                del _shared[self._shared_key]
+        self.terminate()
+
+    @classmethod
+    def connect_codes(cls):
+        """Opening and motor setup packets sent once SYNC0-2 are done"""
         # 2. Initialise sequence
         # sets up server connection on pg37
         # and send motors ON cmd
         # 1. #' Open ArRobot Connection #code 40, +, 1 (IOconfig request = once)
         # 2. #code 18, + (request config SIP
         # 3. #code 50, + (set baud rate to setting 2 )  #pulse
+        #    HOSTBAUD is now negotiated after connecting (see baud_rate.py)
         # opening_codes = b"\xFA\xFB\x06\x01\x3B\x01\x00\x02\x3B\xFA\xFB\x06\x28\x3B\x02\x00\x2a\x3B",
         #                      b"\xFA\xFB\x06\x12\x3B\x01\x00\x13\x3B",
         #                      b"\xFA\xFB\x06\x32\x3B\x02\x00\x34\x3B\xFA\xFB\x03\x00\x00\x00"
-        opening_codes = [self.HEADER1, self.HEADER2, self.BYTECOUNT, self.OPEN, self.POSITIVE, 1, 0, 2, 59,
-                         self.HEADER1, self.HEADER2, self.BYTECOUNT, self.IOREQUEST, self.POSITIVE, 1, 0, 41, 59,
-                         self.HEADER1, self.HEADER2, self.BYTECOUNT, self.ENCODER, self.POSITIVE, 0, 0, 19, 59], \
-                        [self.HEADER1, self.HEADER2, self.BYTECOUNT, self.CONFIG, self.POSITIVE, 1, 0, 19, 59], \
-                        [self.HEADER1, self.HEADER2, self.BYTECOUNT, self.HOSTBAUD, self.POSITIVE, 2, 0, 52, 59,
-                         self.HEADER1, self.HEADER2, self.SHORTCOUNT, self.SYNC0, 0, 0]
+        opening_codes = [cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.OPEN, cls.POSITIVE, 1, 0, 2, 59,
+                         cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.IOREQUEST, cls.POSITIVE, 1, 0, 41, 59,
+                         cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.ENCODER, cls.POSITIVE, 0, 0, 19, 59], \
+                        [cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.CONFIG, cls.POSITIVE, 1, 0, 19, 59], \
+                        [cls.HEADER1, cls.HEADER2, cls.SHORTCOUNT, cls.SYNC0, 0, 0]
 
         # 3. initialises all the motor params
         # fa fb 06 25 3b 02 00 27 3b = init gripper IO stop
@@ -57,92 +131,56 @@ class Motor(Comms):
         # \xFA\xFB\x06\x0A\x3B\x64\x00\x6E\x3B\
         # xFA\xFB\x06\x17\x3B\x64\x00\x7B\x3B\
         # xFA\xFB\x06\x17\x1B\x64\x00\x7B\x1B"
-        motor_codes = [self.HEADER1, self.HEADER2, self.BYTECOUNT, self.GRIPPERIOREQUEST, self.POSITIVE, 0, 0, 37, 59, # new gripper insert
-                       self.HEADER1, self.HEADER2, self.BYTECOUNT, 62, self.POSITIVE, 1, 0, 63, 59, # dont know code 62
-                       self.HEADER1, self.HEADER2, self.BYTECOUNT, self.ENABLE, self.POSITIVE, 1, 0, 5, 59], \
-                      [self.HEADER1, self.HEADER2, self.BYTECOUNT, self.SETV, self.POSITIVE, 244, 1, 250, 60,
-                       self.HEADER1, self.HEADER2, self.BYTECOUNT, self.SETA, self.POSITIVE, 44, 1, 49, 60,
-                       self.HEADER1, self.HEADER2, self.BYTECOUNT, self.SETA, self.NEGATIVE, 44, 1, 49, 28,
-                       self.HEADER1, self.HEADER2, self.BYTECOUNT, self.VEL, self.POSITIVE, 0, 0, 11, 59,
-                       self.HEADER1, self.HEADER2, self.BYTECOUNT, self.SETRV, self.POSITIVE, 100, 0, 110, 59,
-                       self.HEADER1, self.HEADER2, self.BYTECOUNT, self.SETRA, self.POSITIVE, 100, 0, 123, 59,
-                       self.HEADER1, self.HEADER2, self.BYTECOUNT, self.SETRA, self.NEGATIVE, 100, 0, 123, 27]
-
-        # start up sequence
-        print('1.....Sending three start-up codes SYNC0, SYNC1 and SYNC2')
-        # send the 3 init codes to initialise connection
-        for i, inits in enumerate(init_string):
-            msg_match = False
-
-            # send the data
-            print(f'sending SYNC{i}: {inits} to robot')
-            self.write(inits)
-
-            # check if returning message is same as send
-            while msg_match == False and i < 2: # the last message return the id of the robot
-                # read server and check if a match
-                msg_match = self.sipps_match(inits)
-                sleep(0.1)  # wait for a bit
-
-        print('2.....Sending open server-client connection and initialising conditions')
-        for codes in opening_codes:
-            msg_match = False
-            self.write(codes)
-
-            # check if returning message is same as send
-            while msg_match == False:
-                msg_match = self.sipps_match(codes)
-                sleep(0.1)  # wait for a bit
-
-        print('3.......Sending motor setup and params')
-        for motors in motor_codes:
-            msg_match = False
-            self.write(motors)
-
-            # check if returning message is same as send
-            while msg_match == False:
-                msg_match = self.sipps_match(motors)
-                sleep(0.1)  # wait for a bit
-
-        # send a pulse heartbeat to maintain conns
-        self.pulse()
-
-        for i in range (5):
-            print(f'REROBOT READY ... {5 - i}\n\n\t\t')
-            sleep(0.5)
-
-    def sipps_match(self, send_msg):
-        rtn_msg = self.read()  # read server info packets as incoming messages
-        print('listening')
-        decode = list(rtn_msg)
-        if send_msg == decode:
-            print(f'return message is  ... {rtn_msg}')
-            return True
+        motor_codes = [cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.GRIPPERIOREQUEST, cls.POSITIVE, 0, 0, 37, 59, # new gripper insert
+                       cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, 62, cls.POSITIVE, 1, 0, 63, 59, # dont know code 62
+                       cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.ENABLE, cls.POSITIVE, 1, 0, 5, 59], \
+                      [cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.SETV, cls.POSITIVE, 244, 1, 250, 60,
+                       cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.SETA, cls.POSITIVE, 44, 1, 49, 60,
+                       cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.SETA, cls.NEGATIVE, 44, 1, 49, 28,
+                       cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.VEL, cls.POSITIVE, 0, 0, 11, 59,
+                       cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.SETRV, cls.POSITIVE, 100, 0, 110, 59,
+                       cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.SETRA, cls.POSITIVE, 100, 0, 123, 59,
+                       cls.HEADER1, cls.HEADER2, cls.BYTECOUNT, cls.SETRA, cls.NEGATIVE, 100, 0, 123, 27]
+        return list(opening_codes) + list(motor_codes)
+
+    def connect(self, handshake):
+        """Runs a handshake over the streaming reader,
+        raises HandshakeError if the robot does not answer in time"""
+        for msg in handshake.start(monotonic()):
+            self.write(msg)
+
+        while not handshake.finished:
+            for packet in self.read_packets(handshake.deadline - monotonic()):
+                for msg in handshake.on_packet(packet, monotonic()):
+                    self.write(msg)
+            for msg in handshake.poll(monotonic()):
+                self.write(msg)
+
+        if handshake.failed:
+            raise handshake.error
 
     # builds and sends a movement instruction
-    # 1st creates checksum from bytes after byte-count
-    def cmd(self, cmd, value, wheel=None):
-        command_array = [cmd] # adds command code
-        if value > 0: # + or - integer to follow
-            command_array.append(self.POSITIVE)
-        else:
-            command_array.append(self.NEGATIVE)
-            value *= -1
-
-        if wheel == 'right':
-            command_array.append(0)  # 2 byte integer Least 1st
-            command_array.append(value)  # 2 byte integer Least 1st = right
-        else:
-            command_array.append(value) # 2 byte integer Least 1st
-            command_array.append(0) # 2 byte integer Least 1st
-
-        # calculate checksum
-        checksum = self.checksum(command_array)
-        command_array += checksum # add it to end of arra
-
-        # finally adds header x2 & bytecount (which is always 6) to the front
-        command_array[:0] = [self.HEADER1, self.HEADER2, self.BYTECOUNT]
-        self.write(command_array)
+    # signed 16 bit value, checksum calculated by the frame encoder
+    def cmd(self, cmd, value, wheel=None, timeout=None):
+        if cmd == self.VEL2 and wheel is not None:
+            # VEL2 always carries both wheels, so keep the other one going
+            if wheel == 'right':
+                self.wheel_vels[1] = value
+            else:
+                self.wheel_vels[0] = value
+            value = vel2_arg(*self.wheel_vels)
+
+        command = self.encoder.encode(cmd, value)
+
+        # newer motion values replace any unsent older ones
+        key = ('cmd', cmd) if cmd in self.COALESCE_CODES else None
+        self.write(command, key=key, timeout=timeout)
+
+    # builds a list of (cmd, value) instructions and sends them as one message
+    def cmd_many(self, commands):
+        if not commands:
+            return
+        self.write(self.encoder.encode_many(commands))
 
     def set(self):
         # sets parameters such as max vel speed
@@ -152,16 +190,12 @@ class Motor(Comms):
 
     def stop(self):
         # self.send_cmd(b'\xFA\xFB\x03\x1D\x00\x1D')   # all stop command
-        self.write(self.STOP_COMMAND)   # all stop command
+        self.write(self.STOP_COMMAND, urgent=True)   # all stop command
 
     def checksum(self, code):
-        # TODO will need to amend when large number come through
-        #  e.g. set vel speed as these will use both bytes for the value
-        ls_a = code[::2]
-        ls_b = code[1::2]
-        cs_a = sum(ls_a)
-        cs_b = sum(ls_b)
-        return [cs_a, cs_b]
+        # P2OS checksum of the bytes after the byte-count, high byte first
+        cs = checksum(code)
+        return [cs >> 8, cs & 0xFF]
 
     # Set independent wheel velocities;
     #  bits 0-7 for right wheel,
@@ -173,7 +207,9 @@ class Motor(Comms):
         self.cmd(self.VEL2, speed, 'right')
 
     def terminate(self):
-        print ('Closing down all connections')
+        if self.closed:
+            return
+        log.info('closing down all connections')
         # close_down_code = b"\xFA\xFB\x03\x02\x00\x02"
-        self.write(self.STOP_COMMAND)
+        self.write(self.STOP_COMMAND, urgent=True)
         self.close_sequence(self.CLOSE_DOWN_CODE)
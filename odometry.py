@@ -0,0 +1,167 @@
+"""Dead reckoning pose from the SIP stream.
+The controller's XPOS/YPOS are 15 bit counters and THPOS wraps every
+revolution, so the positions in a SIPRecord jump every 32.8 m or so and
+the heading at +/-180. Odometry unwraps each packet's step against the
+last one and accumulates it, O(1) per SIP, into a continuous pose. The
+current Pose is swapped whole, so any thread can read it without locks
+or looking at history.
+
+    odometry = Odometry().attach(robot.motor)   # follows the SIP stream
+    odometry.pose                                # Pose(time, x, y, heading, v, omega)
+    odometry.rezero()                            # here is now (0, 0, 0)
+    odometry.rebase()                            # after a reconnect, carry on
+
+trajectory() does the same unwrapping over a whole recorded array of
+SIPs (e.g. from TelemetryHistory) with NumPy.
+"""
+
+import math
+from threading import Lock
+from typing import NamedTuple
+
+from sip_record import DIST_CONV
+
+X_PERIOD = 0x8000 * DIST_CONV  # mm before XPOS/YPOS wrap
+HEADING_PERIOD = 360.0
+
+
+class Pose(NamedTuple):
+    time: float  # monotonic secs of the SIP it came from
+    x: float  # mm
+    y: float  # mm
+    heading: float  # degrees ccw, continuous (not wrapped)
+    v: float  # mm/sec forward, mean of the wheel velocities
+    omega: float  # degrees/sec ccw
+
+    @property
+    def wrapped_heading(self):
+        """heading in -180..180"""
+        return (self.heading + 180) % 360 - 180
+
+
+def _step(new, old, period):
+    # shortest signed step between two wrapped readings
+    return (new - old + period / 2) % period - period / 2
+
+
+class Odometry:
+    def __init__(self):
+        self._lock = Lock()  # update (reader thread) against reset
+        self._subscription = None
+        self.clear()
+
+    def attach(self, comms):
+        """Follows a Comms' standard SIPs (starts its reader if needed)"""
+        streams = comms.enable_streams(io=False, encoder=False)
+        self._subscription = streams.subscribe(lambda kind, sip: self.update(sip), kinds=('standard',))
+        return self
+
+    def detach(self, comms):
+        if self._subscription is not None and comms.streams is not None:
+            comms.streams.unsubscribe(self._subscription)
+            self._subscription = None
+
+    def update(self, sip):
+        """Adds one SIPRecord, returns the new Pose"""
+        with self._lock:
+            return self._update(sip)
+
+    def _update(self, sip):
+        reading = (sip.x, sip.y, sip.heading)
+        if self._last is None:
+            # first packet, or the first after rebase(): start from this
+            # reading, at the pose reset() asked for or continuing from
+            # the current one if there is either
+            self._unwrapped = reading
+            if self._anchor is not None:
+                self._origin, self._target = reading, self._anchor
+                self._anchor = None
+            elif self.pose is not None:
+                self._origin, self._target = reading, self.pose[1:4]
+            omega = 0.0
+        else:
+            ux, uy, uth = self._unwrapped
+            dth = _step(sip.heading, self._last[2], HEADING_PERIOD)
+            self._unwrapped = (ux + _step(sip.x, self._last[0], X_PERIOD),
+                               uy + _step(sip.y, self._last[1], X_PERIOD),
+                               uth + dth)
+            dt = sip.time - self.pose.time
+            omega = dth / dt if dt > 0 else self.pose.omega
+        self._last = reading
+
+        x, y, heading = self._transform(self._unwrapped)
+        self.pose = Pose(sip.time, x, y, heading, (sip.l_vel + sip.r_vel) / 2, omega)
+        self.updates += 1
+        return self.pose
+
+    def _transform(self, unwrapped):
+        ox, oy, oth = self._origin
+        tx, ty, tth = self._target
+        turn = math.radians(tth - oth)
+        dx, dy = unwrapped[0] - ox, unwrapped[1] - oy
+        return (tx + dx * math.cos(turn) - dy * math.sin(turn),
+                ty + dx * math.sin(turn) + dy * math.cos(turn),
+                tth + unwrapped[2] - oth)
+
+    def reset(self, x=0.0, y=0.0, heading=0.0):
+        """Declares the current position to be (x, y, heading), e.g. a
+        known spot on stage; later motion is measured from there"""
+        with self._lock:
+            if self._last is None:
+                # no reading yet to anchor to: the next SIP is (x, y, heading)
+                self._anchor = (x, y, heading)
+            else:
+                self._origin = self._unwrapped
+                self._target = (x, y, heading)
+            if self.pose is not None:
+                self.pose = self.pose._replace(x=x, y=y, heading=heading)
+
+    def rezero(self):
+        self.reset(0.0, 0.0, 0.0)
+
+    def rebase(self):
+        """Call when the controller's counters restart (e.g. a reconnect):
+        the next SIP continues from the current pose instead of jumping"""
+        with self._lock:
+            self._last = None
+
+    def clear(self):
+        """Forgets everything; the next SIP starts again in the controller's frame"""
+        with self._lock:
+            self.pose = None
+            self.updates = 0
+            self._last = None  # last wrapped (x, y, heading) reading
+            self._unwrapped = (0.0, 0.0, 0.0)  # controller frame, continuous
+            # frame transform applied to the unwrapped pose (see reset)
+            self._origin = (0.0, 0.0, 0.0)  # unwrapped pose that maps to ...
+            self._target = (0.0, 0.0, 0.0)  # ... this pose
+            self._anchor = None  # pose for the next SIP, from reset() before it
+
+
+def trajectory(sips, start=None):
+    """Unwrapped poses for a whole array of SIPs in one go.
+    sips: structured array with time, x, y and heading fields
+          (e.g. numpy.concatenate(history.segments()))
+    start: (x, y, heading) for the first sample, default the controller's frame
+    Returns a structured array with time, x, y and heading (continuous)."""
+    import numpy as np
+
+    out = np.empty(len(sips), dtype=[('time', 'f8'), ('x', 'f8'), ('y', 'f8'), ('heading', 'f8')])
+    if len(sips) == 0:
+        return out
+    out['time'] = sips['time']
+    for field, period in (('x', X_PERIOD), ('y', X_PERIOD), ('heading', HEADING_PERIOD)):
+        values = np.asarray(sips[field], dtype='f8')
+        column = out[field]
+        column[0] = values[0]
+        np.cumsum(_step(np.diff(values), 0.0, period), out=column[1:])
+        column[1:] += values[0]
+
+    if start is not None:
+        x0, y0, th0 = out['x'][0], out['y'][0], out['heading'][0]
+        turn = math.radians(start[2] - th0)
+        dx, dy = out['x'] - x0, out['y'] - y0
+        out['x'] = start[0] + dx * math.cos(turn) - dy * math.sin(turn)
+        out['y'] = start[1] + dx * math.sin(turn) + dy * math.cos(turn)
+        out['heading'] += start[2] - th0
+    return out
@@ -0,0 +1,373 @@
+"""Multi-robot controller for the Recycled Robot Orchestra.
+One selectors based loop on one thread services every robot's reads,
+writes, handshakes and heartbeats, so the thread count stays flat
+however many Pioneers are on the host.
+
+    orchestra = Orchestra(['/dev/ttyUSB0', '/dev/ttyUSB1', '/dev/ttyUSB2'])
+    orchestra.start()                # handshakes all run in parallel
+    orchestra.wait_connected()
+    orchestra.head(90)               # every robot, sent back to back
+    orchestra[1].move(100)           # just one robot
+    print(orchestra.skew_stats())
+    orchestra.close()
+
+Each member keeps its own CommandScheduler, so commands to one robot are
+coalesced and prioritised exactly as they are for a single Comms.
+"""
+
+import logging
+import os
+import selectors
+import socket
+from collections import deque
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter
+
+import serial
+
+from comms import Comms
+from motor import Motor
+from command_scheduler import CommandScheduler
+from frame_encoder import FrameEncoder, vel2_arg
+from handshake import Handshake, HandshakeError, DONE
+from sip_parser import SIPParser
+from sip_record import decode_standard_sip, is_standard_sip
+
+_HEARTBEAT = bytes(Comms.HEARTBEAT)
+
+log = logging.getLogger(__name__)
+
+
+class OrchestraMember:
+    """One robot's serial link, driven by the Orchestra loop.
+    Command methods can be called from any thread."""
+
+    def __init__(self, orchestra, port, baudrate=9600):
+        self.orchestra = orchestra
+        self.port = port
+        self.baudrate = baudrate
+        self.ser = None
+        self.fd = None
+        self.sip_parser = SIPParser()
+        self.command_scheduler = CommandScheduler(preempt_codes=Comms.MOTION_CODES)
+        self.handshake = Handshake(Motor.connect_codes())
+        self.sip = None  # latest decoded standard SIP
+        self.last_write = 0.0
+        self.wheel_vels = [0, 0]
+        self._out = bytearray()
+
+    @property
+    def connected(self):
+        return self.handshake.state == DONE and self.ser is not None
+
+    def open(self):
+        # pyserial keeps the descriptor in non-blocking mode
+        self.ser = serial.Serial(port=self.port,
+                                 baudrate=self.baudrate,
+                                 parity=serial.PARITY_NONE,
+                                 stopbits=serial.STOPBITS_ONE,
+                                 bytesize=serial.EIGHTBITS,
+                                 timeout=0)
+        self.fd = self.ser.fileno()
+
+    def close(self):
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
+        # the number can be reused by an unrelated file
+        self.fd = None
+
+    # commands (any thread)
+    def write(self, msg, key=None, urgent=False):
+        msg = bytes(msg)
+        if msg[3] in Comms.URGENT_CODES:
+            urgent = True
+        self.command_scheduler.put(msg, key=key, urgent=urgent)
+        self.orchestra._wake()
+
+    def cmd(self, cmd, value=None):
+        self.write_cmd(self.orchestra.encoder.encode(cmd, value))
+
+    def write_cmd(self, msg):
+        # newer motion values replace any unsent older ones
+        key = ('cmd', msg[3]) if msg[3] in Comms.COALESCE_CODES else None
+        self.write(msg, key=key)
+
+    def nudge(self, dist=10):
+        self.cmd(Comms.MOVE, dist)
+
+    def move(self, speed=10):
+        self.cmd(Comms.VEL, speed)
+
+    def rvel(self, speed=10):
+        self.cmd(Comms.RVEL, speed)
+
+    def head(self, degree=0):
+        self.cmd(Comms.HEAD, degree)
+
+    def rotate(self, degrees=10):
+        self.cmd(Comms.ROTATE, degrees)
+
+    def gripper(self, value):
+        self.cmd(Comms.GRIPPER, value)
+
+    def set_motors(self, left_speed, right_speed):
+        self.wheel_vels = [left_speed, right_speed]
+        self.cmd(Comms.VEL2, vel2_arg(left_speed, right_speed))
+
+    def stop(self):
+        self.write(Comms.STOP_COMMAND, urgent=True)
+
+    # loop side
+    def _send_now(self, data, now):
+        """Writes straight to the port (loop thread only), buffering the rest"""
+        if self._out:
+            self._out += data
+            return
+        try:
+            n = os.write(self.fd, data)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            self.orchestra._drop(self, now, e)
+            return
+        if n < len(data):
+            self._out += data[n:]
+        self.last_write = now
+
+    def _flush(self, now):
+        """Moves queued commands onto the wire, returns True if output is still pending"""
+        batch = self.command_scheduler.get_batch(timeout=0)
+        if batch:
+            self._out += b''.join(msg for _, msg, _ in batch)
+        if self._out:
+            try:
+                n = os.write(self.fd, self._out)
+            except BlockingIOError:
+                n = 0
+            except OSError as e:
+                self.orchestra._drop(self, now, e)
+                return False
+            del self._out[:n]
+            if n:
+                self.last_write = now
+        if batch:
+            self.command_scheduler.task_done()
+        return bool(self._out)
+
+    def _on_readable(self, now):
+        """Reads and handles incoming packets, returns False if the port has gone"""
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        if not data:
+            return False
+        for packet in self.sip_parser.feed(data):
+            if not self.handshake.finished:
+                for msg in self.handshake.on_packet(packet, now):
+                    self._send_now(msg, now)
+            elif is_standard_sip(packet):
+                self.sip = decode_standard_sip(packet, now) or self.sip
+        return True
+
+
+class Orchestra:
+    HEARTBEAT_INTERVAL = 0.5  # secs
+
+    def __init__(self, ports, baudrate=9600):
+        self.encoder = FrameEncoder()
+        self.members = [OrchestraMember(self, port, baudrate) for port in ports]
+
+        # send skew (secs) between the first and last robot for each broadcast
+        self.skews = deque(maxlen=1000)
+
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._broadcast_pending = False
+        self._lock = Lock()
+        self._connected = Event()
+        self._running = False
+        self._thread = None
+
+    def __getitem__(self, index):
+        return self.members[index]
+
+    def __len__(self):
+        return len(self.members)
+
+    # lifecycle
+    def start(self):
+        """Opens every port and starts the loop; handshakes run in parallel"""
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        now = monotonic()
+        for member in self.members:
+            member.open()
+            self._selector.register(member.fd, selectors.EVENT_READ, member)
+            for msg in member.handshake.start(now):
+                member._send_now(msg, now)
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def wait_connected(self, timeout=None):
+        """Blocks until every handshake has finished,
+        raises HandshakeError naming the robots that failed"""
+        if not self._connected.wait(timeout):
+            raise HandshakeError('orchestra handshakes did not finish in time')
+        failed = [member.port for member in self.members if member.handshake.failed]
+        if failed:
+            raise HandshakeError(f'no connection to {", ".join(failed)}')
+
+    def close(self):
+        """Stops every robot, sends the close down code and closes the ports"""
+        for member in self.members:
+            if member.connected:
+                member.write(Comms.STOP_COMMAND, urgent=True)
+                member.write(Comms.CLOSE_DOWN_CODE, urgent=True)
+        for member in self.members:
+            member.command_scheduler.wait_empty(timeout=1)
+        self._running = False
+        self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        for member in self.members:
+            member.close()
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    # broadcast commands
+    def broadcast(self, cmd, value=None):
+        """Sends the same command to every connected robot. The loop then
+        writes to every robot in one pass so they go out back to back."""
+        self.broadcast_raw(self.encoder.encode(cmd, value))
+
+    def broadcast_raw(self, msg):
+        msg = bytes(msg)
+        with self._lock:
+            for member in self.members:
+                if member.connected:
+                    member.write_cmd(msg)
+            self._broadcast_pending = True
+        self._wake()
+
+    def nudge(self, dist=10):
+        self.broadcast(Comms.MOVE, dist)
+
+    def move(self, speed=10):
+        self.broadcast(Comms.VEL, speed)
+
+    def rvel(self, speed=10):
+        self.broadcast(Comms.RVEL, speed)
+
+    def head(self, degree=0):
+        self.broadcast(Comms.HEAD, degree)
+
+    def rotate(self, degrees=10):
+        self.broadcast(Comms.ROTATE, degrees)
+
+    def gripper(self, value):
+        self.broadcast(Comms.GRIPPER, value)
+
+    def set_motors(self, left_speed, right_speed):
+        self.broadcast(Comms.VEL2, vel2_arg(left_speed, right_speed))
+
+    def stop(self):
+        self.broadcast_raw(Comms.STOP_COMMAND)
+
+    def skew_stats(self):
+        """Inter-robot send skew of recent broadcasts in millisecs"""
+        samples = sorted(self.skews)
+        if not samples:
+            return {}
+        return {'count': len(samples),
+                'mean': sum(samples) / len(samples) * 1000,
+                'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+                'max': samples[-1] * 1000}
+
+    # the loop
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\x00')
+        except (BlockingIOError, OSError):
+            pass  # a wake up is already pending
+
+    def _run(self):
+        next_pulse = monotonic() + self.HEARTBEAT_INTERVAL
+        while self._running:
+            now = monotonic()
+            deadlines = [next_pulse]
+            deadlines += [m.handshake.deadline for m in self.members
+                          if not m.handshake.finished and m.handshake.deadline is not None]
+            events = self._selector.select(max(min(deadlines) - now, 0))
+
+            now = monotonic()
+            for key, mask in events:
+                member = key.data
+                if member is None:
+                    try:
+                        self._wake_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                elif member.ser is None:
+                    continue  # dropped earlier in this pass
+                elif mask & selectors.EVENT_READ and not member._on_readable(now):
+                    self._drop(member, now, 'port closed')
+
+            self._poll_handshakes(now)
+            if now >= next_pulse:
+                self._pulse(now)
+                next_pulse += self.HEARTBEAT_INTERVAL
+                if next_pulse <= now:
+                    next_pulse = now + self.HEARTBEAT_INTERVAL
+
+            with self._lock:
+                broadcast, self._broadcast_pending = self._broadcast_pending, False
+            sent = []
+            for member in self.members:
+                if member.ser is None:
+                    continue
+                pending = member._flush(now)
+                sent.append(perf_counter())
+                if member.ser is None:
+                    continue  # dropped by the write
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0)
+                if self._selector.get_key(member.fd).events != events:
+                    self._selector.modify(member.fd, events, member)
+            if broadcast and len(sent) > 1:
+                self.skews.append(sent[-1] - sent[0])
+
+    def _drop(self, member, now, reason):
+        # unplugged: stop servicing it, the others carry on
+        log.warning('lost connection to %s (%s)', member.port, reason)
+        if member.fd is not None:
+            try:
+                self._selector.unregister(member.fd)
+            except (KeyError, ValueError):
+                pass  # not registered yet (start) or already gone
+        member.close()
+        member.handshake.abort(now, f'{member.port} went away during the handshake')
+
+    def _poll_handshakes(self, now):
+        if self._connected.is_set():
+            return
+        for member in self.members:
+            if member.ser is None:
+                continue
+            for msg in member.handshake.poll(now):
+                member._send_now(msg, now)
+        if all(member.handshake.finished for member in self.members):
+            self._connected.set()
+
+    def _pulse(self, now):
+        # only robots that have been quiet need a pulse to feed the watchdog
+        for member in self.members:
+            if member.ser is None:
+                continue
+            if member.connected and now - member.last_write >= self.HEARTBEAT_INTERVAL / 2:
+                member._send_now(_HEARTBEAT, now)
@@ -0,0 +1,162 @@
+"""Raw serial recorder and replay engine.
+SerialRecorder appends every inbound and outbound serial chunk to a
+memory-mapped binary log with monotonic timestamps:
+    header:  b'RRLOG1\\0\\0', end offset (uint64)
+    records: time (float64), direction (uint8, 0 = in, 1 = out),
+             length (uint16), data
+The file grows by doubling and is trimmed to size on close.
+replay() feeds a log back through the SIP parser and decoding pipeline
+(or a live Comms) either in real time or as fast as possible, and
+reports how fast it went.
+
+    robot.motor.start_recording('show.rrlog')
+    ...
+    python recorder.py show.rrlog            # max speed replay benchmark
+"""
+
+import argparse
+import mmap
+import os
+import struct
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+
+from sip_parser import SIPParser
+from sip_record import decode_standard_sip, is_standard_sip
+
+MAGIC = b'RRLOG1\x00\x00'
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<dBH')
+INBOUND = 0
+OUTBOUND = 1
+
+
+class SerialRecorder:
+    def __init__(self, path, initial_size=1 << 20):
+        self.path = path
+        self._lock = Lock()
+        self._file = open(path, 'w+b')
+        self._size = max(initial_size, HEADER.size + RECORD.size)
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+        self._end = HEADER.size
+        HEADER.pack_into(self._map, 0, MAGIC, self._end)
+        self.records = 0
+
+    def record(self, direction, data, t=None):
+        """Appends one chunk; direction is INBOUND or OUTBOUND"""
+        if not data:
+            return
+        if t is None:
+            t = monotonic()
+        with self._lock:
+            if self._map is None:
+                return
+            # chunks longer than a record can hold are split
+            for start in range(0, len(data), 0xFFFF):
+                chunk = data[start:start + 0xFFFF]
+                needed = self._end + RECORD.size + len(chunk)
+                if needed > self._size:
+                    self._grow(needed)
+                RECORD.pack_into(self._map, self._end, t, direction, len(chunk))
+                data_start = self._end + RECORD.size
+                self._map[data_start:data_start + len(chunk)] = chunk
+                self._end = data_start + len(chunk)
+                self.records += 1
+            # publish the new end last so a partial record is never read
+            HEADER.pack_into(self._map, 0, MAGIC, self._end)
+
+    def _grow(self, needed):
+        size = self._size
+        while size < needed:
+            size *= 2
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._size = size
+
+    def close(self):
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.truncate(self._end)
+            self._file.close()
+
+
+def read_log(path):
+    """Yields (time, direction, data) for every record in a log"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            magic, end = HEADER.unpack_from(log, 0)
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a serial log')
+            offset = HEADER.size
+            while offset + RECORD.size <= end:
+                t, direction, length = RECORD.unpack_from(log, offset)
+                offset += RECORD.size
+                yield t, direction, log[offset:offset + length]
+                offset += length
+
+
+def replay(path, realtime=False, comms=None):
+    """Feeds the inbound chunks of a log back through the parsing pipeline.
+    realtime: keep the recorded gaps between chunks (otherwise max speed)
+    comms: a Comms to feed (its process_incoming), otherwise a standalone
+           parser and SIP decoder are used
+    Returns benchmark stats as a dict."""
+    parser = SIPParser()
+    chunks = nbytes = packets = sips = 0
+    first = last = None
+    start = perf_counter()
+
+    for t, direction, data in read_log(path):
+        if direction != INBOUND:
+            continue
+        if first is None:
+            first = t
+        elif realtime:
+            wait = (t - first) - (perf_counter() - start)
+            if wait > 0:
+                sleep(wait)
+        last = t
+        chunks += 1
+        nbytes += len(data)
+
+        if comms is not None:
+            found = comms.process_incoming(data)
+            packets += len(found)
+            sips += sum(1 for packet in found if is_standard_sip(packet))
+        else:
+            for packet in parser.feed(data):
+                packets += 1
+                if decode_standard_sip(packet) is not None:
+                    sips += 1
+
+    wall = perf_counter() - start
+    span = (last - first) if first is not None else 0.0
+    checker = comms.sip_parser if comms is not None else parser
+    return {'chunks': chunks,
+            'bytes': nbytes,
+            'packets': packets,
+            'sips': sips,
+            'checksum_errors': checker.checksum_errors,
+            'recorded_secs': span,
+            'replay_secs': wall,
+            'speedup': span / wall if wall > 0 else float('inf'),
+            'bytes_per_sec': nbytes / wall if wall > 0 else float('inf'),
+            'packets_per_sec': packets / wall if wall > 0 else float('inf')}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a raw serial log through the SIP parser')
+    parser.add_argument('log', help='log written by SerialRecorder')
+    parser.add_argument('--realtime', action='store_true', help='keep the recorded timing')
+    args = parser.parse_args()
+    for key, value in replay(args.log, realtime=args.realtime).items():
+        print(f'{key:>16} = {value}')
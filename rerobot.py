@@ -3,37 +3,57 @@ It translates all the basic commands into motor-class based code.
 """
 
 from motor import Motor
-from time import sleep
+from action_scheduler import ActionScheduler
 
 class Robot:
 
-    def __init__(self):
+    # secs a step or gripper move runs before its stop is sent
+    ACTION_TIME = 0.5
+
+    def __init__(self, port=None, baudrate=9600, max_baud=115200, transport=None):
         # initiates the motor class for comms with the Pioneer OS
-        self.motor = Motor()
+        # port defaults to the usual USB serial device for the platform,
+        # tcp://host:port reaches it through a serial-over-network bridge
+        # the link is switched up to max_baud once connected
+        # Robots on the same port share one connected Motor
+        if transport is None:
+            self.motor = Motor.acquire(port, baudrate, max_baud)
+        else:
+            self.motor = Motor(port, baudrate, max_baud, transport)
+
+        # deferred follow-ups (stop, gripper_stop ...) for timed primitives
+        # keys: 'motion', 'lift' and 'paddle'
+        self.actions = ActionScheduler()
 
     # ReRoBot specific commands (selection)
     def nudge(self, dist=10):
         """Translate (+) forward or (-) back mm distance at SETV speed"""
+        self.actions.cancel('motion')
         self.motor.cmd(self.motor.MOVE, value=dist)
 
     def move(self, speed=10):
         """Move forward (+) or reverse (-) at millimeters per second"""
+        self.actions.cancel('motion')
         self.motor.cmd(self.motor.VEL, value=speed)
 
     def rvel(self, speed=10):
         """Rotate robot at (+) counter- or (–) clockwise; degrees/sec (SETRV limit)."""
+        self.actions.cancel('motion')
         self.motor.cmd(self.motor.RVEL, value=speed)
 
     def head(self, degree=0):
         """Turn at SETRV speed to absolute heading; ±degrees (+ = ccw )"""
+        self.actions.cancel('motion')
         self.motor.cmd(self.motor.HEAD, value=degree)
 
     def rotate(self, degrees=10):
         """Rotate (+) counter- or (-) clockwise degrees/sec."""
+        self.actions.cancel('motion')
         self.motor.cmd(self.motor.ROTATE, value=degrees)
 
     def terminate(self):
-        self.motor.terminate()
+        self.actions.close()
+        self.motor.release()
 
     # gripper commands
     # https://www.macalester.edu/research/fox/pioneer/gripmanP2.pdf
@@ -47,58 +67,63 @@ class Robot:
         # 6 - stop lift
         # 15 - Halts both Gripper paddles and Lift
 
+    # timed primitives return straight away, their stop is deferred
     def gripper_up(self):
         self.motor.cmd(self.motor.GRIPPER, value=4)
-        sleep(0.5)
-        self.gripper_stop()
+        self.actions.call_later(self.ACTION_TIME, self._lift_stop, key='lift')
 
     def gripper_down(self):
         self.motor.cmd(self.motor.GRIPPER, value=5)
-        sleep(0.5)
-        self.gripper_stop()
+        self.actions.call_later(self.ACTION_TIME, self._lift_stop, key='lift')
 
     def gripper_stop(self):
+        self.actions.cancel('lift')
+        self._lift_stop()
+
+    def _lift_stop(self):
         self.motor.cmd(self.motor.GRIPPER, value=6)
 
     def paddle_open(self):
         self.motor.cmd(self.motor.GRIPPER, value=1)
-        sleep(0.5)
-        self.paddle_stop()
+        self.actions.call_later(self.ACTION_TIME, self._paddle_stop, key='paddle')
 
     def paddle_close(self):
         self.motor.cmd(self.motor.GRIPPER, value=2)
-        sleep(0.5)
-        self.paddle_stop()
+        self.actions.call_later(self.ACTION_TIME, self._paddle_stop, key='paddle')
 
     def paddle_stop(self):
+        self.actions.cancel('paddle')
+        self._paddle_stop()
+
+    def _paddle_stop(self):
         self.motor.cmd(self.motor.GRIPPER, value=3)
 
     def all_halt(self):
+        self.actions.cancel('lift')
+        self.actions.cancel('paddle')
         self.motor.cmd(self.motor.GRIPPER, value=15)
 
     # useful UI commands
+    # each step supersedes the previous step's pending stop
     def step_forward(self):
         self.nudge(10)
-        sleep(0.5)
-        self.stop()
+        self.actions.call_later(self.ACTION_TIME, self.motor.stop, key='motion')
 
     def step_backward(self):
         self.nudge(-10)
-        sleep(0.5)
-        self.stop()
+        self.actions.call_later(self.ACTION_TIME, self.motor.stop, key='motion')
 
     def step_left(self):
         self.rvel(20)
-        sleep(0.5)
-        self.stop()
+        self.actions.call_later(self.ACTION_TIME, self.motor.stop, key='motion')
 
     def step_right(self):
         self.rvel(-20)
-        sleep(0.5)
-        self.stop()
+        self.actions.call_later(self.ACTION_TIME, self.motor.stop, key='motion')
 
     # Jetbot shared commands
     def set_motors(self, left_speed, right_speed):
+        self.actions.cancel('motion')
         self.motor.left(left_speed)
         self.motor.right(right_speed)
 
@@ -113,6 +138,7 @@ class Robot:
         self.move(-speed)
 
     def stop(self):
+        self.actions.cancel('motion')
         self.motor.stop()
 
     def left(self, speed=1):
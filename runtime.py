@@ -0,0 +1,166 @@
+"""Headless runtime for running the robot without the GUI (e.g. as a boot
+service on the Jetson). Only the serial stack is imported up front; the
+GUI, the control server and anything needing NumPy are imported when
+their option is used. SIGINT and SIGTERM stop the robot and close the
+port cleanly.
+
+    python runtime.py --port /dev/ttyUSB0 --metrics 5
+    python runtime.py --serve 0.0.0.0:9750     # network control server
+    python runtime.py --gui                    # the Tk control panel
+
+or from Python:
+
+    with Runtime(port='/dev/ttyUSB0') as runtime:
+        runtime.robot.nudge(100)
+        runtime.run(until=10)
+
+Start up is timed (see Runtime.timings); first_command is from start()
+to the first command being on the wire.
+"""
+
+import argparse
+import logging
+import signal
+from threading import Event
+from time import monotonic
+
+log = logging.getLogger(__name__)
+
+
+class Runtime:
+    def __init__(self, port=None, baudrate=9600, max_baud=115200, heartbeat_interval=0.5,
+                 history=0, metrics_interval=0.0):
+        """port: serial port (None = Comms.default_port())
+        baudrate: rate the connection is opened at
+        max_baud: fastest rate to switch up to after connecting
+        heartbeat_interval: secs between watchdog pulses
+        history: rows of TelemetryHistory to keep (0 = none, needs NumPy)
+        metrics_interval: secs between metric dumps to the log (0 = none)"""
+        self.port = port
+        self.baudrate = baudrate
+        self.max_baud = max_baud
+        self.heartbeat_interval = heartbeat_interval
+        self.history = history
+        self.metrics_interval = metrics_interval
+
+        self.robot = None
+        self.timings = {}  # secs
+        self._stop = Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Connects to the robot and puts a first command on the wire"""
+        started = monotonic()
+        from rerobot import Robot
+        self.timings['import'] = monotonic() - started
+
+        self.robot = Robot(self.port, self.baudrate, self.max_baud)
+        motor = self.robot.motor
+        self.timings['handshake'] = motor.handshake.duration
+        self.timings['connect'] = monotonic() - started
+        motor.heartbeat.interval = self.heartbeat_interval
+
+        # a stop is always safe, and proves the write path end to end
+        self.robot.stop()
+        motor.command_scheduler.wait_empty(timeout=1)
+        self.timings['first_command'] = motor.last_write - started
+        log.info('first command on the wire %.3f secs after start (connect %.3f secs)',
+                 self.timings['first_command'], self.timings['connect'])
+
+        if self.history:
+            motor.enable_history(self.history)
+        motor.start_reader()
+        if self.metrics_interval:
+            motor.metrics.start_dump(self.metrics_interval)
+        return self.robot
+
+    def run(self, until=None):
+        """Waits until request_stop() (or a signal), or for until secs;
+        the SIPs are read on the motor's reader thread meanwhile"""
+        end = None if until is None else monotonic() + until
+        while not self._stop.is_set():
+            # short waits so signal handlers get to run promptly
+            wait = 0.5 if end is None else min(0.5, end - monotonic())
+            if wait <= 0:
+                break
+            self._stop.wait(wait)
+
+    def request_stop(self, *_):
+        # safe to call from a signal handler
+        self._stop.set()
+
+    def stop(self):
+        self._stop.set()
+        if self.robot is not None:
+            self.robot.terminate()
+
+    def install_signal_handlers(self, handler=None):
+        """SIGINT and SIGTERM call handler (request_stop by default)"""
+        handler = handler or self.request_stop
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: handler())
+
+
+def _serve(runtime, address):
+    # imported here so asyncio and the server only load when asked for
+    import asyncio
+    from control_server import ControlServer, DEFAULT_TCP_PORT
+
+    host, _, port = address.partition(':')
+    server = ControlServer(runtime.robot, host or '127.0.0.1',
+                           int(port) if port else DEFAULT_TCP_PORT, udp_port=None)
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await server.start()
+        log.info('control server on %s', address)
+        await stop.wait()
+        await server.close()
+
+    asyncio.run(serve())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a ReRo robot without the GUI')
+    parser.add_argument('--port', default=None, help='serial port (default: $REROBOT_PORT or the platform usual)')
+    parser.add_argument('--baud', type=int, default=9600, help='baud rate to connect at')
+    parser.add_argument('--max-baud', type=int, default=115200, help='fastest baud rate to switch up to')
+    parser.add_argument('--heartbeat', type=float, default=0.5, help='secs between watchdog pulses')
+    parser.add_argument('--history', type=int, default=0, help='keep this many SIPs in a NumPy history')
+    parser.add_argument('--metrics', type=float, default=0.0, help='log metrics every this many secs')
+    parser.add_argument('--serve', metavar='HOST:PORT', default=None, help='run the network control server')
+    parser.add_argument('--gui', action='store_true', help='open the Tk control panel')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(message)s')
+
+    runtime = Runtime(args.port, args.baud, args.max_baud, args.heartbeat,
+                      args.history, args.metrics)
+    try:
+        runtime.start()
+        if args.gui:
+            from basic_motion_UI import GUI
+            window = GUI(runtime.robot)
+            runtime.install_signal_handlers(window.quit)
+            window.mainloop()
+        elif args.serve:
+            _serve(runtime, args.serve)
+        else:
+            runtime.install_signal_handlers()
+            runtime.run()
+    finally:
+        runtime.stop()
+    log.info('stopped cleanly')
+
+
+if __name__ == "__main__":
+    main()
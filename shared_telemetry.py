@@ -0,0 +1,275 @@
+"""Latest SIP (and optionally a short history) in shared memory, for
+other processes on the same machine (e.g. the ML models) to read without
+sockets, pickling or locks.
+
+The block is a small header, the latest record (double buffered) and an
+optional ring of past records, all laid out as NumPy structured arrays.
+The writer (Comms' reader thread, see Comms.enable_shared_telemetry)
+never waits for anyone: record n goes into the slot the readers aren't
+being pointed at, stamped with its generation n and a CRC of both, and
+only then does the header's sequence number move on to it. NumPy stores
+carry no memory ordering guarantee (on aarch64, e.g. the Jetson, another
+core can see the stores in any order), so a reader never trusts the
+order: it copies a slot and keeps it only if the generation is the one
+it wanted and the CRC matches, and tries again otherwise.
+
+A block whose writer process is still alive is never replaced; creating
+a second writer of the same name raises FileExistsError.
+
+    # robot process
+    robot.motor.enable_shared_telemetry('rerobot', history=256)
+
+    # any other process
+    telemetry = TelemetryReader('rerobot')
+    sip = telemetry.latest()             # a NumPy record: sip['x'], sip['heading'] ...
+    sip = telemetry.wait(timeout=1)      # blocks for the next one
+    recent = telemetry.history()         # oldest first
+"""
+
+import logging
+import os
+import zlib
+from multiprocessing import shared_memory
+from time import monotonic, sleep
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+DEFAULT_NAME = 'rerobot_telemetry'
+MAGIC = 0x52455231  # 'RER1'
+
+# the SIPRecord fields up to digout, in the same order
+RECORD_DTYPE = np.dtype([('time', 'f8'),
+                         ('type', 'u2'),
+                         ('x', 'f8'),
+                         ('y', 'f8'),
+                         ('heading', 'f8'),
+                         ('l_vel', 'f8'),
+                         ('r_vel', 'f8'),
+                         ('battery', 'f8'),
+                         ('bumpers', 'u2'),
+                         ('control', 'f8'),
+                         ('flags', 'u2'),
+                         ('compass', 'u2'),
+                         ('sonar_count', 'u2'),
+                         ('grip_state', 'u1'),
+                         ('anport', 'u1'),
+                         ('analog', 'u1'),
+                         ('digin', 'u1'),
+                         ('digout', 'u1')], align=True)
+_FIELDS = len(RECORD_DTYPE.names)
+
+# a record as stored: generation (1 for the first record, 0 = empty),
+# the record and a CRC32 of the two. Packed, as NumPy doesn't copy
+# padding bytes and the CRC covers the raw bytes.
+_PACKED_RECORD = np.dtype([(name, RECORD_DTYPE.fields[name][0]) for name in RECORD_DTYPE.names])
+SLOT_DTYPE = np.dtype([('gen', 'u8'),
+                       ('record', _PACKED_RECORD),
+                       ('crc', 'u4')])
+_CRC_SPAN = SLOT_DTYPE.fields['crc'][1]  # bytes covered: gen and record
+
+HEADER_DTYPE = np.dtype([('magic', 'u4'),
+                         ('capacity', 'u4'),  # rows of history
+                         ('seq', 'u8'),  # 2 x the latest generation
+                         ('pid', 'u8')], align=True)  # the writer's process
+_SLOT_OFFSET = 64  # header padded to a cache line
+
+
+def _size(capacity):
+    return _SLOT_OFFSET + SLOT_DTYPE.itemsize * (2 + capacity)
+
+
+def _views(buf, capacity):
+    header = np.ndarray(1, HEADER_DTYPE, buf)
+    latest = np.ndarray(2, SLOT_DTYPE, buf, _SLOT_OFFSET)
+    history = np.ndarray(capacity, SLOT_DTYPE, buf, _SLOT_OFFSET + 2 * SLOT_DTYPE.itemsize)
+    return header, latest, history
+
+
+def _crc(slot):
+    return zlib.crc32(slot.tobytes()[:_CRC_SPAN])
+
+
+def _valid(slot, gen):
+    # a whole, untorn copy of record gen
+    return int(slot['gen']) == gen and int(slot['crc']) == _crc(slot)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # someone else's, but running
+    return True
+
+
+class SharedTelemetry:
+    """Writer side: creates the block (replacing a stale one of the same
+    name, but never one whose writer is still running) and removes it
+    again on close()"""
+
+    def __init__(self, name=DEFAULT_NAME, history=0):
+        self.name = name
+        self.capacity = history
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=_size(history))
+        except FileExistsError:
+            self._remove_stale(name)
+            self.shm = shared_memory.SharedMemory(name, create=True, size=_size(history))
+        self._header, self._latest, self._history = _views(self.shm.buf, history)
+        self._header[0] = (MAGIC, history, 0, os.getpid())
+        self._seq = self._header['seq']  # a view, so each update is one store
+        self._slot = np.zeros(1, SLOT_DTYPE)[0]  # staged, to CRC before storing
+        self.published = 0
+        log.info('shared telemetry %s, %d bytes', name, self.shm.size)
+
+    @staticmethod
+    def _remove_stale(name):
+        # only a block left behind by a process that has gone
+        stale = _attach(name)
+        try:
+            if stale.size < HEADER_DTYPE.itemsize:
+                raise FileExistsError(f'{name} exists and is not a telemetry block')
+            header = np.ndarray(1, HEADER_DTYPE, stale.buf)[0].copy()
+            if int(header['magic']) != MAGIC:
+                raise FileExistsError(f'{name} exists and is not a telemetry block')
+            pid = int(header['pid'])
+            if _alive(pid):
+                raise FileExistsError(f'{name} is in use by process {pid}')
+        finally:
+            stale.close()
+        log.info('removing stale shared telemetry %s of process %d', name, pid)
+        # opened tracked, so unlinking balances the resource tracker
+        stale = shared_memory.SharedMemory(name)
+        stale.close()
+        stale.unlink()
+
+    def publish(self, record):
+        """Writes a SIPRecord; only one thread may publish"""
+        gen = self.published + 1
+        slot = self._slot
+        slot['gen'] = gen
+        slot['record'] = record[:_FIELDS]
+        slot['crc'] = _crc(slot)
+        # the readers are pointed at the other latest slot meanwhile
+        self._latest[gen & 1] = slot
+        if self.capacity:
+            self._history[(gen - 1) % self.capacity] = slot
+        self._seq[0] = gen * 2
+        self.published = gen
+
+    def close(self):
+        if self.shm is None:
+            return
+        # views have to go before the buffer can be released
+        self._header = self._latest = self._history = self._seq = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+def _attach(name):
+    # attach without the resource tracker unlinking the block when this
+    # process exits (the writer owns it)
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+    # Python < 3.13 has no track argument; keep the block from being
+    # registered at all (unregistering after would also drop the writer's
+    # registration when both share a tracker, as multiprocessing children do)
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None if rtype == 'shared_memory' else register(name, rtype)
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+
+class TelemetryReader:
+    POLL = 0.0005  # secs between looks at the sequence number in wait()
+    STUCK = 0.1  # secs of failed copies before the writer is taken to have died
+
+    def __init__(self, name=DEFAULT_NAME):
+        self.shm = _attach(name)
+        header = np.ndarray(1, HEADER_DTYPE, self.shm.buf)
+        if header['magic'][0] != MAGIC:
+            self.shm.close()
+            raise ValueError(f'{name} is not a telemetry block')
+        self.capacity = int(header['capacity'][0])
+        self._header, self._latest, self._history = _views(self.shm.buf, self.capacity)
+        self._seq = self._header['seq']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def seq(self):
+        """Even, and up by 2 per published record"""
+        return int(self._seq[0])
+
+    def _read(self, copy):
+        # copy(gen) returns its copy, or None if torn or overtaken: try again
+        started = None
+        while True:
+            gen = int(self._seq[0]) // 2
+            value = copy(gen)
+            if value is not None:
+                return gen, value
+            if started is None:
+                started = monotonic()
+            elif monotonic() - started > self.STUCK:
+                raise TimeoutError('telemetry writer stopped mid update')
+            sleep(0)
+
+    def latest(self):
+        """The latest record (a NumPy record, a copy), None before the first"""
+        def copy(gen):
+            if not gen:
+                return ()
+            slot = self._latest[gen & 1].copy()
+            if not _valid(slot, gen):
+                return None
+            return np.array(slot['record']).astype(RECORD_DTYPE)[()]
+        gen, row = self._read(copy)
+        return row if gen else None
+
+    def wait(self, after=None, timeout=None):
+        """Blocks until a record newer than seq after (default: now) is
+        published and returns it, or None on timeout"""
+        after = self.seq if after is None else after
+        deadline = None if timeout is None else monotonic() + timeout
+        while int(self._seq[0]) <= after:
+            if deadline is not None and monotonic() > deadline:
+                return None
+            sleep(self.POLL)
+        return self.latest()
+
+    def history(self):
+        """The history rows, oldest first (a copy)"""
+        def copy(gen):
+            count = min(gen, self.capacity)
+            if not count:
+                return np.empty(0, RECORD_DTYPE)
+            rows = self._history.copy()
+            # generations gen - count + 1 .. gen, each in its ring row
+            gens = np.arange(gen - count + 1, gen + 1)
+            slots = rows[(gens - 1) % self.capacity]
+            if any(not _valid(slot, int(g)) for slot, g in zip(slots, gens)):
+                return None
+            return slots['record'].astype(RECORD_DTYPE)
+        return self._read(copy)[1]
+
+    def close(self):
+        if self.shm is None:
+            return
+        self._header = self._latest = self._history = self._seq = None
+        self.shm.close()
+        self.shm = None
@@ -0,0 +1,410 @@
+"""Pioneer/P2OS robot simulator served over a pseudo-terminal.
+Lets the whole stack (Comms, Motor, Robot, AsyncRobot ...) run without
+a physical robot, e.g. for soak and latency testing in CI:
+
+    sim = P2OSSimulator(baud=9600, drop_rate=0.01)
+    port = sim.start()
+    robot = Robot(port=port)
+
+or in process over a loopback transport (no pty or line rate):
+
+    host, link = loopback_pair()
+    sim.start(link)
+    robot = Robot(transport=host)
+
+or from a terminal:  python simulator.py --baud 9600 --corrupt 0.01
+
+It echoes SYNC0-2 (SYNC2 replies with the robot name, class and subclass),
+accepts the opening and motor codes Motor sends, and once OPEN has been
+received streams standard SIPs whose pose follows VEL, RVEL, VEL2, HEAD,
+ROTATE, MOVE and STOP commands, plus IO and encoder SIPs when asked
+for with IOREQUEST / ENCODER (1 = one packet, >1 = continuous, 0 = stop).
+With the sonar on (SONAR 1, the default) each standard SIP carries the
+next SONARS_PER_SIP p3dx sonars, ranged against the walls of a square
+stage. Output can be paced at a baud rate, and faults injected: dropped bytes, corrupt checksums and delayed echoes.
+HOSTBAUD switches the simulated controller's rate (pacing follows it);
+while the host side of the pty is set to a different rate, input is
+ignored and output turns to noise, as on a real mismatched line.
+"""
+
+import argparse
+import math
+import os
+import random
+import struct
+import termios
+import threading
+import tty
+from collections import deque
+from time import monotonic, sleep
+
+from comms import Comms
+from sip_parser import SIPParser, checksum
+from sonar_grid import P3DX_SONARS, MAX_RANGE
+
+# standard SIP body: type, xpos, ypos, thpos, l vel, r vel, battery,
+# stall and bumpers, control, flags, compass, sonar count,
+# count x (sonar index, range),
+# grip state, anport, analog, digin, digout, battery x10
+_STANDARD_SIP = struct.Struct('<BHHhhhBHhHBB')
+_SONAR_READING = struct.Struct('<BH')
+_TRAILER = struct.Struct('<BBBBBH')
+
+TICKS_PER_REV = 4096  # THPOS units per revolution
+VEL2_UNIT = 20  # mm/sec per VEL2 step
+AXLE = 330.0  # mm between the wheels (p3dx)
+ENCODER_TICKS_PER_MM = 32.0  # roughly a p3dx
+SONARS_PER_SIP = 8  # the ring fires in turn, half of it per SIP
+BAUD_RATES = (9600, 19200, 38400, 57600, 115200)  # HOSTBAUD argument is the index
+_TERMIOS_RATES = {getattr(termios, f'B{rate}'): rate for rate in BAUD_RATES}
+
+
+def packet(data):
+    """Wraps data bytes with header, byte count and checksum"""
+    cs = checksum(data)
+    return bytes([0xFA, 0xFB, len(data) + 2]) + bytes(data) + bytes([cs >> 8, cs & 0xFF])
+
+
+class P2OSSimulator:
+    def __init__(self, baud=None, drop_rate=0.0, corrupt_rate=0.0, echo_delay=0.0,
+                 sip_interval=0.1, name=('ReRoSim', 'Pioneer', 'p3dx'), seed=None,
+                 max_baud=115200, stage=8000.0, keep_received=1000):
+        """baud: starting line rate, output is paced at the line rate
+              (None = 9600 unpaced, as fast as possible)
+        drop_rate: chance of dropping a byte from each packet sent
+        corrupt_rate: chance of corrupting the checksum of each packet sent
+        echo_delay: secs to hold back SYNC echoes
+        sip_interval: secs between standard SIPs once connected
+        max_baud: fastest rate HOSTBAUD will switch to
+        stage: side of the square stage in mm, centred on where the
+               robot starts; the sonars range against its walls
+        keep_received: packets from the client kept in received (the
+               latest), so long soak runs don't grow without bound"""
+        self.baud = baud
+        self.max_baud = max_baud
+        self.stage = stage
+        self.line_rate = baud or 9600  # the controller's side of the line
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.echo_delay = echo_delay
+        self.sip_interval = sip_interval
+        self.name = name
+        self.random = random.Random(seed)
+
+        self.port = None
+        self.link = None  # transport served instead of a pty (see start)
+        self.connected = False
+        self.received = deque(maxlen=keep_received)  # (monotonic time, packet) from the client
+        self.packets_received = 0
+        self.sips_sent = 0
+        self.io_stream = False
+        self.encoder_stream = False
+
+        self._master = None
+        self._slave = None
+        self._running = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._parser = SIPParser()
+        self._reset_motion()
+
+    def _reset_motion(self):
+        self.x = 0.0  # mm
+        self.y = 0.0  # mm
+        self.th = 0.0  # degrees, ccw
+        self.vel = 0.0  # mm/sec (VEL)
+        self.rvel = 0.0  # degrees/sec (RVEL)
+        self.wheels = None  # (left, right) mm/sec when driven by VEL2
+        self.target_heading = None  # HEAD / DHEAD goal
+        self.move_left = 0.0  # mm still to go for MOVE
+        self.max_vel = 500.0  # SETV
+        self.max_rvel = 100.0  # SETRV
+        self.motors_on = False
+        self.encoders = [0.0, 0.0]  # left, right ticks
+        self.sonar_on = True
+        self._next_sonar = 0
+        self._vels = (0.0, 0.0)  # (left, right) wheel mm/sec reported in SIPs
+
+    # lifecycle
+    def start(self, link=None):
+        """Opens the pty (or serves link, the robot's end of a transport)
+        and starts serving, returns the port path to connect to"""
+        if link is not None:
+            self.link = link
+            self.port = link.port
+        else:
+            self._master, self._slave = os.openpty()
+            tty.setraw(self._slave)
+            self.port = os.ttyname(self._slave)
+        self._running = True
+        threading.Thread(target=self._serve, daemon=True).start()
+        threading.Thread(target=self._stream, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self.link is not None:
+            self.link.close()
+        for fd in (self._master, self._slave):
+            if fd is None:
+                continue
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def pose(self):
+        with self._lock:
+            return self.x, self.y, self.th
+
+    def _host_rate(self):
+        # the rate the client has set on its end of the pty
+        if self.link is not None:
+            return self.line_rate  # no line to mismatch
+        try:
+            return _TERMIOS_RATES.get(termios.tcgetattr(self._slave)[5])
+        except (termios.error, OSError):
+            return None
+
+    # output with pacing and fault injection
+    def _send(self, data):
+        data = bytearray(data)
+        if self._host_rate() != self.line_rate:
+            data = bytearray(self.random.getrandbits(8) for _ in data)
+        if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+            data[-1] ^= 0xFF
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            del data[self.random.randrange(len(data))]
+        with self._write_lock:
+            try:
+                if self.link is not None:
+                    self.link.write(data)
+                else:
+                    os.write(self._master, data)
+            except OSError:
+                return
+            if self.baud:
+                # 10 bits per byte on an 8N1 line
+                sleep(len(data) * 10 / self.line_rate)
+
+    def _echo(self, data):
+        if self.echo_delay:
+            threading.Timer(self.echo_delay, self._send, (data,)).start()
+        else:
+            self._send(data)
+
+    # input
+    def _serve(self):
+        while self._running:
+            try:
+                if self.link is not None:
+                    data = self.link.read(1024)
+                    if not self.link.is_open:
+                        return
+                else:
+                    data = os.read(self._master, 1024)
+            except OSError:
+                return
+            now = monotonic()
+            if self._host_rate() != self.line_rate:
+                # framing errors, nothing gets through
+                self._parser.reset()
+                continue
+            for pkt in self._parser.feed(data):
+                self.received.append((now, pkt))
+                self.packets_received += 1
+                self._handle(pkt)
+
+    def _handle(self, pkt):
+        code = pkt[3]
+        if not self.connected:
+            if pkt[2] == 3 and code in (Comms.SYNC0, Comms.SYNC1):
+                self._echo(pkt)
+            elif pkt[2] == 3 and code == Comms.SYNC2:
+                ident = b''.join(field.encode('ascii') + b'\x00' for field in self.name)
+                self._echo(packet(bytes([Comms.SYNC2]) + ident))
+            elif code == Comms.OPEN:
+                self.connected = True
+            return
+
+        value = self._argument(pkt)
+        with self._lock:
+            if code == Comms.CLOSE:
+                self.connected = False
+                self.io_stream = self.encoder_stream = False
+                self.line_rate = self.baud or 9600
+                self._reset_motion()
+            elif code == Comms.HOSTBAUD:
+                if 0 <= value < len(BAUD_RATES) and BAUD_RATES[value] <= self.max_baud:
+                    self.line_rate = BAUD_RATES[value]
+            elif code == Comms.ENABLE:
+                self.motors_on = bool(value)
+            elif code in (Comms.STOP, Comms.E_STOP):
+                self.vel = self.rvel = self.move_left = 0.0
+                self.wheels = self.target_heading = None
+            elif code == Comms.VEL:
+                self.vel, self.wheels, self.move_left = float(value), None, 0.0
+            elif code == Comms.RVEL or code == Comms.ROTATE:
+                self.rvel, self.wheels, self.target_heading = float(value), None, None
+            elif code == Comms.VEL2:
+                raw = value & 0xFFFF
+                left = ((raw >> 8) ^ 0x80) - 0x80
+                right = ((raw & 0xFF) ^ 0x80) - 0x80
+                self.wheels = (left * VEL2_UNIT, right * VEL2_UNIT)
+            elif code == Comms.HEAD:
+                self.target_heading, self.rvel = float(value), 0.0
+            elif code == Comms.DHEAD:
+                self.target_heading, self.rvel = self.th + value, 0.0
+            elif code == Comms.MOVE:
+                self.move_left, self.vel, self.wheels = float(value), 0.0, None
+            elif code == Comms.SETV:
+                self.max_vel = float(value)
+            elif code == Comms.SETRV:
+                self.max_rvel = float(value)
+            elif code == Comms.SONAR:
+                self.sonar_on = bool(value)
+            elif code == Comms.IOREQUEST:
+                self.io_stream = value > 1
+            elif code == Comms.ENCODER:
+                self.encoder_stream = value > 1
+        # one-off requests are answered straight away
+        if code == Comms.IOREQUEST and value == 1:
+            self._send(self.io_sip())
+        elif code == Comms.ENCODER and value == 1:
+            self._send(self.encoder_sip())
+
+    @staticmethod
+    def _argument(pkt):
+        if pkt[2] < 6:
+            return 0
+        value = pkt[5] | (pkt[6] << 8)
+        return -value if pkt[4] == Comms.NEGATIVE else value
+
+    # SIP stream
+    def _stream(self):
+        last = next_sip = monotonic()
+        while self._running:
+            next_sip += self.sip_interval
+            sleep(max(next_sip - monotonic(), 0))
+            now = monotonic()
+            self._integrate(now - last)
+            last = now
+            if self.connected:
+                self._send(self.standard_sip())
+                self.sips_sent += 1
+                if self.io_stream:
+                    self._send(self.io_sip())
+                if self.encoder_stream:
+                    self._send(self.encoder_sip())
+
+    def _integrate(self, dt):
+        with self._lock:
+            if self.wheels is not None:
+                left, right = self.wheels
+                v = (left + right) / 2
+                w = math.degrees((right - left) / AXLE)
+            else:
+                v, w = self.vel, self.rvel
+                if self.move_left:
+                    step = math.copysign(min(abs(self.move_left), self.max_vel * dt), self.move_left)
+                    self.move_left -= step
+                    v = step / dt if dt else 0.0
+                if self.target_heading is not None:
+                    diff = (self.target_heading - self.th + 180) % 360 - 180
+                    turn = math.copysign(min(abs(diff), self.max_rvel * dt), diff)
+                    w = turn / dt if dt else 0.0
+                    if abs(diff) < 1e-6:
+                        self.target_heading = None
+
+            self.th = (self.th + w * dt + 180) % 360 - 180
+            rad = math.radians(self.th)
+            self.x += v * dt * math.cos(rad)
+            self.y += v * dt * math.sin(rad)
+            self._vels = (v - w * AXLE / 360 * math.pi, v + w * AXLE / 360 * math.pi)
+            self.encoders[0] += self._vels[0] * dt * ENCODER_TICKS_PER_MM
+            self.encoders[1] += self._vels[1] * dt * ENCODER_TICKS_PER_MM
+
+    def standard_sip(self):
+        """The standard SIP for the current state"""
+        with self._lock:
+            left, right = self._vels
+            moving = any((left, right))
+            sonars = self._next_sonars()
+            body = _STANDARD_SIP.pack(
+                0x33 if moving else 0x32,
+                int(round(self.x)) & 0x7FFF,
+                int(round(self.y)) & 0x7FFF,
+                int(round(self.th / 360 * TICKS_PER_REV)),
+                int(round(left)),
+                int(round(right)),
+                130,  # 13.0 volts
+                0,  # no stalls or bumps
+                int(round((self.target_heading or 0) / 360 * TICKS_PER_REV)),
+                1 if self.motors_on else 0,
+                int(self.th % 360) // 2,
+                len(sonars))
+            for i in sonars:
+                body += _SONAR_READING.pack(i, int(round(self._sonar_range(i))))
+        return packet(body + _TRAILER.pack(0, 0, 0, 0, 0, 130))
+
+    def _next_sonars(self):
+        # called with the lock held
+        if not self.sonar_on:
+            return []
+        first = self._next_sonar
+        self._next_sonar = (first + SONARS_PER_SIP) % len(P3DX_SONARS)
+        return [(first + i) % len(P3DX_SONARS) for i in range(SONARS_PER_SIP)]
+
+    def _sonar_range(self, i):
+        # distance from sonar i to the nearest stage wall along its beam
+        sx, sy, sth = P3DX_SONARS[i]
+        rad = math.radians(self.th)
+        x = self.x + sx * math.cos(rad) - sy * math.sin(rad)
+        y = self.y + sx * math.sin(rad) + sy * math.cos(rad)
+        beam = math.radians(self.th + sth)
+        half = self.stage / 2
+        distance = MAX_RANGE
+        for position, direction in ((x, math.cos(beam)), (y, math.sin(beam))):
+            if abs(direction) > 1e-9:
+                wall = half if direction > 0 else -half
+                distance = min(distance, max((wall - position) / direction, 0.0))
+        return distance
+
+    def io_sip(self):
+        """IO SIP: one digital in and out port, two analog inputs"""
+        return packet(bytes([0xF0, 1, 0xFF, 1, 0x00, 2]) + struct.pack('<HH', 512, 256))
+
+    def encoder_sip(self):
+        with self._lock:
+            left, right = (int(round(ticks)) for ticks in self.encoders)
+        return packet(bytes([0x90]) + struct.pack('<ii', left, right))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='P2OS robot simulator on a pseudo-terminal')
+    parser.add_argument('--baud', type=int, default=None, help='starting baud rate, paces output at the line rate')
+    parser.add_argument('--max-baud', type=int, default=115200, help='fastest rate HOSTBAUD switches to')
+    parser.add_argument('--drop', type=float, default=0.0, help='chance of dropping a byte per packet')
+    parser.add_argument('--corrupt', type=float, default=0.0, help='chance of a bad checksum per packet')
+    parser.add_argument('--echo-delay', type=float, default=0.0, help='secs to delay SYNC echoes')
+    parser.add_argument('--sip-interval', type=float, default=0.1, help='secs between SIPs')
+    parser.add_argument('--stage', type=float, default=8000.0, help='side of the square stage in mm')
+    args = parser.parse_args()
+
+    sim = P2OSSimulator(baud=args.baud, max_baud=args.max_baud, drop_rate=args.drop, corrupt_rate=args.corrupt,
+                        echo_delay=args.echo_delay, sip_interval=args.sip_interval, stage=args.stage)
+    print(f'P2OS simulator listening on {sim.start()}')
+    try:
+        while True:
+            sleep(1)
+            print(f'connected={sim.connected} pose={sim.pose} sips={sim.sips_sent}')
+    except KeyboardInterrupt:
+        sim.stop()
@@ -0,0 +1,154 @@
+"""Streaming decoder for the P2OS packet stream.
+Bytes are fed in as they arrive from the serial port (any chunk size),
+kept in a fixed size ring buffer, and complete packets are handed back
+once the header, byte count and checksum all check out.
+Packet layout (pg 37 of the Pioneer 2 manual):
+    0xFA 0xFB | byte count | data ... | checksum hi | checksum lo
+the byte count covers the data and the two checksum bytes.
+"""
+
+HEADER1 = 0xFA
+HEADER2 = 0xFB
+
+# smallest legal packet has 1 data byte (the type/command) and a 2 byte checksum
+MIN_BYTECOUNT = 3
+# P2OS packets never exceed 200 bytes
+MAX_BYTECOUNT = 200
+
+
+def checksum(data):
+    """P2OS checksum of the data bytes (everything after the byte count
+    up to, but not including, the checksum itself).
+    Sums the bytes as big-endian 16 bit words, folding to 16 bits,
+    and XORs in the last byte if there is an odd number.
+    Returns the 16 bit integer; it goes on the wire high byte first."""
+    c = 0
+    n = len(data)
+    i = 0
+    while n > 1:
+        c += (data[i] << 8) | data[i + 1]
+        c &= 0xFFFF
+        n -= 2
+        i += 2
+    if n > 0:
+        c ^= data[i]
+    return c
+
+
+class SIPParser:
+    """Incremental packet decoder with a reusable ring buffer.
+
+    feed() takes whatever bytes are available and returns every complete,
+    valid packet (as bytes, header and checksum included).
+    Partial packets stay in the buffer until the rest arrives.
+    Garbage and corrupted packets are skipped by resyncing on 0xFA 0xFB.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._buf = bytearray(capacity)
+        self._start = 0  # index of the oldest unread byte
+        self._count = 0  # number of unread bytes
+
+        # running stats
+        self.frames = 0
+        self.checksum_errors = 0
+        self.resyncs = 0  # bytes skipped while looking for a header
+        self.overflows = 0  # bytes lost because the buffer was full
+
+    def __len__(self):
+        return self._count
+
+    def reset(self):
+        self._start = 0
+        self._count = 0
+
+    def feed(self, data):
+        """Push newly read bytes and return a list of complete packets."""
+        packets = []
+        view = memoryview(data)
+        # large reads go through the ring in pieces so nothing is lost
+        while len(view) > self.capacity - self._count:
+            room = max(self.capacity - self._count, 1)
+            self._push(view[:room])
+            view = view[room:]
+            packets.extend(self._extract())
+        self._push(view)
+        packets.extend(self._extract())
+        return packets
+
+    # ring buffer helpers
+    def _push(self, data):
+        n = len(data)
+        if n == 0:
+            return
+        cap = self.capacity
+        if n > cap:
+            # only the newest bytes can fit
+            self.overflows += n - cap
+            data = data[n - cap:]
+            n = cap
+        free = cap - self._count
+        if n > free:
+            # drop the oldest bytes to make room
+            lost = n - free
+            self.overflows += lost
+            self._drop(lost)
+
+        end = (self._start + self._count) % cap
+        first = min(n, cap - end)
+        self._buf[end:end + first] = data[:first]
+        if first < n:
+            self._buf[0:n - first] = data[first:]
+        self._count += n
+
+    def _peek(self, offset):
+        return self._buf[(self._start + offset) % self.capacity]
+
+    def _copy(self, n):
+        start = self._start
+        end = start + n
+        if end <= self.capacity:
+            return bytes(self._buf[start:end])
+        end -= self.capacity
+        return bytes(self._buf[start:]) + bytes(self._buf[:end])
+
+    def _drop(self, n):
+        self._start = (self._start + n) % self.capacity
+        self._count -= n
+        if self._count == 0:
+            self._start = 0
+
+    def _extract(self):
+        packets = []
+        while self._count >= 3:
+            # look for the two header bytes
+            if self._peek(0) != HEADER1 or self._peek(1) != HEADER2:
+                self._drop(1)
+                self.resyncs += 1
+                continue
+
+            bytecount = self._peek(2)
+            if bytecount < MIN_BYTECOUNT or bytecount > MAX_BYTECOUNT:
+                # not a real header, skip it and resync
+                self._drop(1)
+                self.resyncs += 1
+                continue
+
+            length = bytecount + 3
+            if self._count < length:
+                # wait for the rest of the packet
+                break
+
+            packet = self._copy(length)
+            expected = (packet[-2] << 8) | packet[-1]
+            if checksum(packet[3:-2]) != expected:
+                # corrupt (or a false header), skip one byte and resync
+                self.checksum_errors += 1
+                self._drop(1)
+                continue
+
+            self._drop(length)
+            self.frames += 1
+            packets.append(packet)
+        return packets
@@ -0,0 +1,200 @@
+"""Decoded standard server information packet (SIP).
+A standard SIP (type 0x32 stopped, 0x33 moving) is laid out as:
+    type, XPOS, YPOS, THPOS, L VEL, R VEL, BATTERY, STALL AND BUMPERS,
+    CONTROL, FLAGS, COMPASS, SONAR COUNT, count x (sonar index, range),
+    GRIP_STATE, ANPORT, ANALOG, DIGIN, DIGOUT, BATTERYX10 ...
+all little-endian (pg 41 of the Pioneer 2 manual). The fixed part is
+decoded in one step with a precompiled struct; the trailer follows the
+variable length sonar section.
+SIPRecord is immutable, so a connection can publish the latest one by
+swapping a single reference and readers always see a consistent packet.
+
+IO SIPs (type 0xF0, streamed with IOREQUEST) and encoder SIPs (type 0x90,
+streamed with ENCODER) decode into IORecord and EncoderRecord:
+    IO:      digin count, digin bytes, digout count, digout bytes,
+             analog count, analog readings (uint16)
+    encoder: left count, right count (int32)
+"""
+
+import struct
+from typing import NamedTuple
+
+# type, xpos, ypos, thpos, l vel, r vel, battery, stall and bumpers,
+# control, flags, compass, sonar count - starts after header and byte count
+STANDARD_SIP = struct.Struct('<BHHhhhBHhHBB')
+STANDARD_OFFSET = 3
+SONAR_OFFSET = STANDARD_OFFSET + STANDARD_SIP.size
+SONAR_READING_SIZE = 3  # index byte, range uint16
+# grip state, anport, analog, digin, digout, battery x10
+TRAILER = struct.Struct('<BBBBBH')
+
+IO_SIP = 0xF0
+ENCODER_SIP = 0x90
+ENCODER_COUNTS = struct.Struct('<ii')
+
+# unit conversions (Pioneer 2/3 defaults, see the robot's ARIA params file)
+DIST_CONV = 1.0  # mm per position unit
+VEL_CONV = 1.0  # mm/sec per velocity unit
+ANGLE_CONV = 360 / 4096  # degrees per THPOS/CONTROL unit
+BATTERY_CONV = 0.1  # volts per battery unit
+COMPASS_CONV = 2  # degrees per compass unit
+
+
+class SIPRecord(NamedTuple):
+    time: float  # monotonic secs when decoded
+    type: int
+    x: float  # mm, wraps at +/-16384 (see odometry for unwrapped pose)
+    y: float  # mm
+    heading: float  # degrees, ccw, -180..180
+    l_vel: float  # mm/sec
+    r_vel: float  # mm/sec
+    battery: float  # volts
+    bumpers: int  # raw STALL AND BUMPERS word
+    control: float  # heading setpoint, degrees
+    flags: int
+    compass: int  # degrees
+    sonar_count: int
+    grip_state: int
+    anport: int
+    analog: int
+    digin: int
+    digout: int
+    # raw counters (they wrap) for odometry
+    raw_x: int
+    raw_y: int
+    raw_th: int
+
+    @property
+    def moving(self):
+        return self.type == 0x33
+
+    @property
+    def motors_on(self):
+        return bool(self.flags & 0x01)
+
+    @property
+    def stall_left(self):
+        return bool(self.bumpers & 0x0001)
+
+    @property
+    def stall_right(self):
+        return bool(self.bumpers & 0x0100)
+
+    @property
+    def front_bumpers(self):
+        return (self.bumpers >> 1) & 0x7F
+
+    @property
+    def rear_bumpers(self):
+        return (self.bumpers >> 9) & 0x7F
+
+    def as_dict(self):
+        """Values under the old sips_dict names used by the UI"""
+        return {'TYPE': self.type,
+                'XPOS': self.x,
+                'YPOS': self.y,
+                'THPOS': self.heading,
+                'L_VEL': self.l_vel,
+                'R_VEL': self.r_vel,
+                'BATTERY': self.battery,
+                'BUMPERS': self.bumpers,
+                'CONTROL': self.control,
+                'FLAGS': self.flags,
+                'COMPASS': self.compass,
+                'GRIP_STATE': self.grip_state,
+                'ANPORT': self.anport,
+                'ANALOG': self.analog,
+                'DIGIN': self.digin,
+                'DIGOUT': self.digout,
+                'ANALOGUE': self.analog}
+
+
+class IORecord(NamedTuple):
+    time: float
+    digin: tuple  # one int per 8 bit port
+    digout: tuple
+    analog: tuple  # raw A/D readings
+
+
+class EncoderRecord(NamedTuple):
+    time: float
+    left: int  # raw encoder counts
+    right: int
+
+
+SIPS_DICT_KEYS = ('TYPE', 'XPOS', 'YPOS', 'THPOS', 'L_VEL', 'R_VEL', 'BATTERY', 'BUMPERS',
+                  'CONTROL', 'FLAGS', 'COMPASS', 'GRIP_STATE', 'ANPORT', 'ANALOG', 'DIGIN',
+                  'DIGOUT', 'ANALOGUE')
+
+
+def _signed15(raw):
+    # positions are 15 bit counters, read them as -16384..16383
+    raw &= 0x7FFF
+    return raw - 0x8000 if raw & 0x4000 else raw
+
+
+def is_standard_sip(packet):
+    return packet[3] & 0xF0 == 0x30
+
+
+def decode_standard_sip(packet, time=0.0):
+    """SIPRecord from a complete standard SIP packet (header and checksum
+    included), or None if it isn't one or is too short."""
+    end = len(packet) - 2  # checksum
+    if not is_standard_sip(packet) or end < SONAR_OFFSET:
+        return None
+    (sip_type, raw_x, raw_y, raw_th, l_vel, r_vel, battery, bumpers,
+     control, flags, compass, sonar_count) = STANDARD_SIP.unpack_from(packet, STANDARD_OFFSET)
+
+    trailer = SONAR_OFFSET + sonar_count * SONAR_READING_SIZE
+    if trailer + TRAILER.size <= end:
+        grip_state, anport, analog, digin, digout, battery_x10 = TRAILER.unpack_from(packet, trailer)
+        if battery_x10:
+            # wider battery reading where the firmware has it
+            battery = battery_x10
+    else:
+        grip_state = anport = analog = digin = digout = 0
+
+    return SIPRecord(time, sip_type,
+                     _signed15(raw_x) * DIST_CONV,
+                     _signed15(raw_y) * DIST_CONV,
+                     ((raw_th * ANGLE_CONV + 180) % 360) - 180,
+                     l_vel * VEL_CONV,
+                     r_vel * VEL_CONV,
+                     battery * BATTERY_CONV,
+                     bumpers,
+                     control * ANGLE_CONV,
+                     flags,
+                     compass * COMPASS_CONV,
+                     sonar_count,
+                     grip_state, anport, analog, digin, digout,
+                     raw_x, raw_y, raw_th)
+
+
+def decode_io_sip(packet, time=0.0):
+    """IORecord from a complete IO SIP packet, or None if it isn't one or is cut short"""
+    end = len(packet) - 2
+    if packet[3] != IO_SIP:
+        return None
+    offset = 4
+    fields = []
+    for width in (1, 1, 2):
+        if offset >= end:
+            return None
+        count = packet[offset]
+        offset += 1
+        if offset + count * width > end:
+            return None
+        if width == 1:
+            fields.append(tuple(packet[offset:offset + count]))
+        else:
+            fields.append(struct.unpack_from(f'<{count}H', packet, offset))
+        offset += count * width
+    return IORecord(time, *fields)
+
+
+def decode_encoder_sip(packet, time=0.0):
+    """EncoderRecord from a complete encoder SIP packet, or None"""
+    if packet[3] != ENCODER_SIP or len(packet) - 2 < 4 + ENCODER_COUNTS.size:
+        return None
+    return EncoderRecord(time, *ENCODER_COUNTS.unpack_from(packet, 4))
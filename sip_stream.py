@@ -0,0 +1,155 @@
+"""Continuous SIP streams pushed to subscribers.
+Rather than sending a request and waiting for a reply every tick, the
+IO (IOREQUEST) and encoder (ENCODER) packets are switched to continuous
+mode (an argument above 1) and renewed every RENEW_INTERVAL, or straight
+away if one goes quiet. Standard SIPs stream anyway once connected, and
+with enable_sonar() their sonar readings are published as a SonarScan.
+Comms' reader thread hands every packet over, and each subscriber gets
+the decoded records it asked for, by callback or queue, no more often
+than its max_rate (extra records are dropped, never queued up).
+
+    streams = robot.motor.enable_streams()
+    streams.subscribe(print, kinds=('encoder',), max_rate=5)
+    q = streams.subscribe(queue=queue.Queue(16), kinds=('standard', 'io')).queue
+"""
+
+import logging
+from queue import Full, Empty
+from time import monotonic
+
+from comms import Comms
+from frame_encoder import FrameEncoder
+from sip_record import IO_SIP, ENCODER_SIP, decode_io_sip, decode_encoder_sip
+
+log = logging.getLogger(__name__)
+
+STANDARD, IO, ENCODER, SONAR = 'standard', 'io', 'encoder', 'sonar'
+CONTINUOUS = 2  # request argument: 0 stop, 1 one packet, >1 continuous
+
+_REQUESTS = {IO: Comms.IOREQUEST, ENCODER: Comms.ENCODER}
+_DECODERS = {IO_SIP: (IO, decode_io_sip), ENCODER_SIP: (ENCODER, decode_encoder_sip)}
+
+
+class Subscription:
+    __slots__ = ('kinds', 'callback', 'queue', 'min_interval', 'last', 'delivered', 'dropped')
+
+    def __init__(self, kinds, callback=None, queue=None, max_rate=None):
+        self.kinds = frozenset(kinds)
+        self.callback = callback
+        self.queue = queue
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.last = {}  # kind -> time of the last record delivered
+        self.delivered = 0
+        self.dropped = 0
+
+    def offer(self, kind, record, now):
+        if now - self.last.get(kind, -1e9) < self.min_interval:
+            self.dropped += 1
+            return
+        self.last[kind] = now
+        self.delivered += 1
+        if self.callback is not None:
+            self.callback(kind, record)
+        if self.queue is not None:
+            try:
+                self.queue.put_nowait((kind, record))
+            except Full:
+                # a slow consumer loses its oldest record, the reader never waits
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    pass
+                self.queue.put_nowait((kind, record))
+
+
+class SIPStreams:
+    RENEW_INTERVAL = 5.0  # secs between stream renewals
+    STALE_AFTER = 1.0  # secs of silence before a stream is renewed early
+
+    def __init__(self, comms):
+        self.comms = comms
+        self.encoder = FrameEncoder()
+        self.subscriptions = []
+        self.latest = {}  # kind -> latest record
+        self.streaming = set()  # IO and/or ENCODER
+        self.renewals = 0
+        self.sonar = None  # SonarScan once enable_sonar() is called
+        self._renewed = {}  # kind -> when last requested
+        self._heard = {}  # kind -> when last received
+
+    # subscribers
+    def subscribe(self, callback=None, kinds=(STANDARD, IO, ENCODER), queue=None, max_rate=None):
+        """callback(kind, record) runs on the reader thread, keep it short;
+        queue gets (kind, record) tuples. Returns the Subscription."""
+        subscription = Subscription(kinds, callback, queue, max_rate)
+        # copy on write so the reader can iterate without a lock
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+    # stream control
+    def start(self, io=True, encoder=True):
+        now = monotonic()
+        for kind, wanted in ((IO, io), (ENCODER, encoder)):
+            if wanted:
+                self.streaming.add(kind)
+                self._request(kind, CONTINUOUS, now)
+
+    def enable_sonar(self, on=True):
+        """Turns the sonar on (or off) and publishes the readings in each
+        standard SIP as a SonarScan (needs NumPy)"""
+        if on and self.sonar is None:
+            # imported here so NumPy is only needed for the sonar
+            from sonar_grid import SonarScan
+            self.sonar = SonarScan()
+        self.comms.write(self.encoder.encode(Comms.SONAR, 1 if on else 0), key='sonar')
+        return self.sonar
+
+    def stop(self):
+        for kind in list(self.streaming):
+            self._request(kind, 0, monotonic())
+        self.streaming.clear()
+
+    def _request(self, kind, value, now):
+        # keyed so a pending renewal is never sent twice
+        self.comms.write(self.encoder.encode(_REQUESTS[kind], value), key=f'{kind}_stream')
+        self._renewed[kind] = now
+
+    def _renew(self, now):
+        for kind in self.streaming:
+            since_request = now - self._renewed.get(kind, 0.0)
+            quiet = now - self._heard.get(kind, self._renewed.get(kind, now)) > self.STALE_AFTER
+            if since_request >= self.RENEW_INTERVAL or (quiet and since_request > self.STALE_AFTER):
+                self._request(kind, CONTINUOUS, now)
+                self.renewals += 1
+
+    # reader thread side
+    def publish(self, kind, record, now):
+        self.latest[kind] = record
+        self._heard[kind] = now
+        for subscription in self.subscriptions:
+            if kind in subscription.kinds:
+                try:
+                    subscription.offer(kind, record, now)
+                except Exception:
+                    log.exception('SIP subscriber %s failed', subscription.callback)
+        if self.streaming:
+            self._renew(now)
+
+    def standard(self, packet, record):
+        """Publishes a decoded standard SIP, and its sonar readings if any"""
+        self.publish(STANDARD, record, record.time)
+        if self.sonar is not None and record.sonar_count:
+            # the scan is reused for every packet, subscribers copy what they keep
+            self.publish(SONAR, self.sonar.decode(packet, record.time), record.time)
+
+    def dispatch(self, packet, now):
+        """Decodes a non standard packet and publishes it if it is IO or encoder"""
+        kind, decode = _DECODERS.get(packet[3], (None, None))
+        if decode is None:
+            return
+        record = decode(packet, now)
+        if record is not None:
+            self.publish(kind, record, now)
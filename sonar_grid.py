@@ -0,0 +1,204 @@
+"""Sonar readings and an occupancy grid built from them.
+Each standard SIP carries the sonars that fired since the last one as
+(index, range) pairs after the SONAR COUNT byte. SonarScan decodes them
+straight out of the packet with NumPy into arrays allocated once, and
+keeps the latest range of every sonar.
+
+OccupancyGrid is a fixed size log-odds grid in the odometry frame (so
+memory is bounded: cells outside it are ignored). Each update casts only
+the sonars in the latest packet, all rays at once: cells along a ray
+become more likely free and the cell at its end, if something echoed,
+more likely occupied. nearest() finds the closest occupied cell in a
+sector around the robot, for collision avoidance.
+
+    odometry = Odometry().attach(robot.motor)
+    grid = OccupancyGrid(size=10000, resolution=50).attach(robot.motor, odometry)
+    obstacle = grid.nearest(odometry.pose, bearing=0, width=60, max_range=1500)
+    if obstacle is not None and obstacle.distance < 500:
+        robot.stop()
+"""
+
+import math
+from typing import NamedTuple
+
+import numpy as np
+
+from sip_record import SONAR_OFFSET, SONAR_READING_SIZE
+
+# p3dx sonar ring: x, y (mm from the centre of rotation), heading (degrees ccw)
+# from the robot's ARIA params file
+P3DX_SONARS = ((69, 136, 90), (114, 119, 50), (148, 78, 30), (166, 27, 10),
+               (166, -27, -10), (148, -78, -30), (114, -119, -50), (69, -136, -90),
+               (-157, -136, -90), (-203, -119, -130), (-237, -78, -150), (-255, -27, -170),
+               (-255, 27, 170), (-237, 78, 150), (-203, 119, 130), (-157, 136, 90))
+MAX_RANGE = 5000.0  # mm, readings at or beyond this saw nothing
+RANGE_CONV = 1.0  # mm per range unit
+
+SONAR_READING = np.dtype([('index', 'u1'), ('range', '<u2')])
+assert SONAR_READING.itemsize == SONAR_READING_SIZE
+
+
+class Obstacle(NamedTuple):
+    distance: float  # mm from the centre of rotation
+    bearing: float  # degrees ccw from the robot's heading
+    x: float  # mm, odometry frame
+    y: float
+
+
+class SonarScan:
+    def __init__(self, geometry=P3DX_SONARS):
+        self.geometry = np.asarray(geometry, dtype='f8')
+        sonars = len(self.geometry)
+        self.ranges = np.full(sonars, np.nan, dtype='f4')  # latest range per sonar, mm
+        self.times = np.zeros(sonars, dtype='f8')  # when each was last read
+        self.time = 0.0
+        self.count = 0  # readings in the latest packet
+        # the latest packet's readings (the count byte is 8 bit)
+        self._index = np.empty(255, dtype='u1')
+        self._range = np.empty(255, dtype='f4')
+
+    @property
+    def changed(self):
+        """Sonar indices read in the latest packet"""
+        return self._index[:self.count]
+
+    @property
+    def changed_ranges(self):
+        return self._range[:self.count]
+
+    def decode(self, packet, time=0.0):
+        """Reads the sonar section of a standard SIP, returns self. The
+        changed views are overwritten by the next packet, copy to keep them."""
+        count = packet[SONAR_OFFSET - 1]
+        if SONAR_OFFSET + count * SONAR_READING_SIZE > len(packet) - 2:
+            count = 0  # cut short
+        readings = np.frombuffer(packet, SONAR_READING, count, SONAR_OFFSET)
+        known = readings[readings['index'] < len(self.ranges)]
+        count = len(known)
+        self._index[:count] = known['index']
+        np.multiply(known['range'], RANGE_CONV, out=self._range[:count])
+
+        self.count = count
+        self.time = time
+        self.ranges[self.changed] = self.changed_ranges
+        self.times[self.changed] = time
+        return self
+
+
+class OccupancyGrid:
+    L_FREE = -0.4  # log-odds added to a cell a ray passed through
+    L_OCCUPIED = 0.85  # ... and to the cell where it echoed
+    LIMIT = 5.0  # log-odds clamp, so cells can change their mind
+    OCCUPIED = 0.5  # log-odds above which nearest() counts a cell
+
+    def __init__(self, size=10000, resolution=50, centre=(0.0, 0.0),
+                 geometry=P3DX_SONARS, max_range=MAX_RANGE):
+        """size: side of the square grid in mm
+        resolution: side of a cell in mm
+        centre: odometry frame (x, y) at the middle of the grid
+        geometry: the sonars' (x, y, heading) on the robot
+        max_range: readings at or beyond this are free space only"""
+        self.resolution = float(resolution)
+        self.cells = int(math.ceil(size / resolution))
+        self.origin = (centre[0] - self.cells * self.resolution / 2,
+                       centre[1] - self.cells * self.resolution / 2)  # corner of cell (0, 0)
+        self.log_odds = np.zeros((self.cells, self.cells), dtype='f4')  # [row = y, col = x]
+        self.geometry = np.asarray(geometry, dtype='f8')
+        self.max_range = max_range
+        self.updates = 0
+        # sample points along a ray, half a cell apart so no cell is skipped
+        self._steps = np.arange(0.0, max_range, self.resolution / 2)
+        self._subscription = None
+
+    def attach(self, comms, odometry):
+        """Updates from a Comms' sonar readings at the odometry's pose
+        (turns the sonar on and starts the reader if needed)"""
+        streams = comms.enable_streams(io=False, encoder=False)
+        streams.enable_sonar()
+
+        def on_sonar(kind, scan):
+            pose = odometry.pose
+            if pose is not None:
+                self.update(pose, scan.changed, scan.changed_ranges)
+        self._subscription = streams.subscribe(on_sonar, kinds=('sonar',))
+        return self
+
+    def detach(self, comms):
+        if self._subscription is not None and comms.streams is not None:
+            comms.streams.unsubscribe(self._subscription)
+            self._subscription = None
+
+    def clear(self):
+        self.log_odds.fill(0.0)
+
+    def update(self, pose, sonars, ranges):
+        """Casts the given sonars' readings (mm) from pose (an odometry
+        Pose or anything with x, y and heading in mm and degrees)"""
+        if len(sonars) == 0:
+            return
+        sensors = self.geometry[sonars]
+        heading = math.radians(pose.heading)
+        cos_h, sin_h = math.cos(heading), math.sin(heading)
+        sx = pose.x + sensors[:, 0] * cos_h - sensors[:, 1] * sin_h
+        sy = pose.y + sensors[:, 0] * sin_h + sensors[:, 1] * cos_h
+        angle = heading + np.radians(sensors[:, 2])
+        dx, dy = np.cos(angle), np.sin(angle)
+        ranges = np.asarray(ranges, dtype='f8')
+        hit = (ranges > 0) & (ranges < self.max_range)
+        reach = np.minimum(ranges, self.max_range)
+
+        # free space: every sample short of the echo, all rays at once
+        along = self._steps[self._steps < reach.max()]
+        short = along[None, :] < (reach - self.resolution / 2)[:, None]
+        free = self._cells(sx[:, None] + along * dx[:, None], sy[:, None] + along * dy[:, None], short)
+        # fancy indexing writes a cell once however many samples land on it
+        cells = self.log_odds.reshape(-1)
+        cells[free] = np.maximum(cells[free] + self.L_FREE, -self.LIMIT)
+
+        if hit.any():
+            ends = self._cells(sx + reach * dx, sy + reach * dy, hit)
+            cells[ends] = np.minimum(cells[ends] + self.L_OCCUPIED, self.LIMIT)
+        self.updates += 1
+
+    def _cells(self, x, y, mask):
+        # flat indices of the cells under the masked points inside the grid
+        col = np.floor((x[mask] - self.origin[0]) / self.resolution).astype(np.intp)
+        row = np.floor((y[mask] - self.origin[1]) / self.resolution).astype(np.intp)
+        inside = (col >= 0) & (col < self.cells) & (row >= 0) & (row < self.cells)
+        return row[inside] * self.cells + col[inside]
+
+    def occupied(self):
+        """Boolean array of the cells believed occupied"""
+        return self.log_odds > self.OCCUPIED
+
+    def probability(self):
+        """Occupancy probability of every cell (a new array)"""
+        return 1.0 - 1.0 / (1.0 + np.exp(self.log_odds))
+
+    def nearest(self, pose, bearing=0.0, width=360.0, max_range=None):
+        """The closest occupied cell within width degrees centred on bearing
+        (degrees ccw from the robot's heading) and max_range mm of pose,
+        or None. Only the cells within max_range are looked at."""
+        max_range = self.max_range if max_range is None else max_range
+        col0, row0, col1, row1 = (int(math.floor((value - offset) / self.resolution))
+                                  for value, offset in ((pose.x - max_range, self.origin[0]),
+                                                        (pose.y - max_range, self.origin[1]),
+                                                        (pose.x + max_range, self.origin[0]),
+                                                        (pose.y + max_range, self.origin[1])))
+        col0, row0 = max(col0, 0), max(row0, 0)
+        col1, row1 = min(col1 + 1, self.cells), min(row1 + 1, self.cells)
+        if col0 >= col1 or row0 >= row1:
+            return None
+
+        rows, cols = np.nonzero(self.log_odds[row0:row1, col0:col1] > self.OCCUPIED)
+        # cell centres relative to the robot
+        x = self.origin[0] + (cols + col0 + 0.5) * self.resolution - pose.x
+        y = self.origin[1] + (rows + row0 + 0.5) * self.resolution - pose.y
+        distance = np.hypot(x, y)
+        relative = (np.degrees(np.arctan2(y, x)) - pose.heading - bearing + 180) % 360 - 180
+        candidates = (distance <= max_range) & (np.abs(relative) <= width / 2)
+        if not candidates.any():
+            return None
+        i = np.flatnonzero(candidates)[np.argmin(distance[candidates])]
+        return Obstacle(float(distance[i]), float((relative[i] + bearing + 180) % 360 - 180),
+                        float(x[i] + pose.x), float(y[i] + pose.y))
@@ -0,0 +1,140 @@
+"""Fixed capacity NumPy ring buffer of timestamped SIP fields.
+Comms appends every decoded standard SIP (enable it with
+Comms.enable_history()), memory stays bounded at capacity rows, and the
+window queries work on views of the buffer: a window that wraps round
+the end is handled as two slices rather than copying the history.
+
+    history = robot.motor.enable_history(capacity=2048)
+    left, right = history.mean_wheel_velocity(2.0)
+    turning = history.heading_rate(1.0)
+"""
+
+import numpy as np
+
+SIP_DTYPE = np.dtype([('time', 'f8'),
+                      ('x', 'f4'),
+                      ('y', 'f4'),
+                      ('heading', 'f4'),
+                      ('l_vel', 'f4'),
+                      ('r_vel', 'f4'),
+                      ('battery', 'f4'),
+                      ('bumpers', 'u2')])
+
+
+class TelemetryHistory:
+    def __init__(self, capacity=2048):
+        self.capacity = capacity
+        self._data = np.zeros(capacity, dtype=SIP_DTYPE)
+        self._next = 0  # row the next SIP goes in
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, sip):
+        """Adds a SIPRecord, overwriting the oldest row once full"""
+        self._data[self._next] = (sip.time, sip.x, sip.y, sip.heading,
+                                  sip.l_vel, sip.r_vel, sip.battery, sip.bumpers)
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def segments(self, seconds=None):
+        """The rows from the last seconds (all rows if None), oldest first,
+        as a list of one or two views of the buffer."""
+        if self._count == 0:
+            return []
+        if self._count < self.capacity:
+            parts = [self._data[:self._count]]
+        elif self._next == 0:
+            parts = [self._data]
+        else:
+            parts = [self._data[self._next:], self._data[:self._next]]
+        if seconds is None:
+            return parts
+
+        # each part is in time order, so the window start can be bisected
+        since = parts[-1]['time'][-1] - seconds
+        window = []
+        for part in parts:
+            start = np.searchsorted(part['time'], since, side='left')
+            if start < len(part):
+                window.append(part[start:])
+        return window
+
+    # window queries
+    def mean_wheel_velocity(self, seconds):
+        """Mean (left, right) wheel velocity in mm/sec"""
+        parts = self.segments(seconds)
+        n = sum(len(part) for part in parts)
+        if n == 0:
+            return 0.0, 0.0
+        left = sum(float(part['l_vel'].sum()) for part in parts)
+        right = sum(float(part['r_vel'].sum()) for part in parts)
+        return left / n, right / n
+
+    def peak_wheel_velocity(self, seconds):
+        """Largest absolute (left, right) wheel velocity in mm/sec"""
+        parts = self.segments(seconds)
+        if not parts:
+            return 0.0, 0.0
+        left = max(float(np.abs(part['l_vel']).max()) for part in parts)
+        right = max(float(np.abs(part['r_vel']).max()) for part in parts)
+        return left, right
+
+    def heading_rate(self, seconds):
+        """Mean turning rate in degrees/sec (ccw +), unwrapped across +/-180"""
+        parts = self.segments(seconds)
+        if not parts:
+            return 0.0
+        turned = 0.0
+        previous = None
+        for part in parts:
+            heading = part['heading']
+            if previous is not None:
+                turned += _wrap(heading[0] - previous)
+            turned += float(_wrap(np.diff(heading)).sum())
+            previous = heading[-1]
+        span = parts[-1]['time'][-1] - parts[0]['time'][0]
+        return turned / span if span > 0 else 0.0
+
+    def battery_trend(self, seconds):
+        """Least squares slope of the battery voltage in volts/sec"""
+        parts = self.segments(seconds)
+        if not parts:
+            return 0.0
+        t0 = parts[0]['time'][0]
+        n = st = sv = stt = stv = 0.0
+        for part in parts:
+            t = part['time'] - t0
+            v = part['battery']
+            n += len(part)
+            st += t.sum()
+            sv += v.sum()
+            stt += (t * t).sum()
+            stv += (t * v).sum()
+        denominator = n * stt - st * st
+        return float((n * stv - st * sv) / denominator) if denominator > 0 else 0.0
+
+    def bump_count(self, seconds):
+        """Number of bumper hits (a bumper going from clear to pressed)"""
+        parts = self.segments(seconds)
+        hits = 0
+        previous = None
+        for part in parts:
+            # bits 1-7 front and 9-15 rear bumpers (bits 0 and 8 are stalls)
+            pressed = (part['bumpers'] & 0xFEFE) != 0
+            if previous is not None:
+                hits += int(pressed[0] and not previous)
+            hits += int(np.count_nonzero(pressed[1:] & ~pressed[:-1]))
+            previous = pressed[-1]
+        return hits
+
+
+def _wrap(degrees):
+    # angle differences into -180..180
+    return (degrees + 180) % 360 - 180
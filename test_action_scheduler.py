@@ -0,0 +1,38 @@
+"""ActionScheduler: cancel and run never overlap."""
+
+from threading import Event, Thread
+
+from action_scheduler import ActionScheduler
+
+
+def test_cancel_waits_for_a_running_action():
+    actions = ActionScheduler()
+    started, release, done = Event(), Event(), []
+
+    def stop():
+        started.set()
+        release.wait(1)
+        done.append('stop')
+
+    actions.call_later(0, stop, key='motion')
+    assert started.wait(1)
+    # a new nudge cancels the step's stop, which is already running
+    canceller = Thread(target=lambda: done.append(actions.cancel('motion')))
+    canceller.start()
+    canceller.join(0.1)
+    assert canceller.is_alive()  # held until the stop is on its way
+    release.set()
+    canceller.join(1)
+    assert done == ['stop', False]
+    actions.close()
+
+
+def test_cancelled_action_never_runs():
+    actions = ActionScheduler()
+    ran = []
+    actions.call_later(0.05, ran.append, 'stop', key='motion')
+    assert actions.cancel('motion')
+    actions.call_later(0.01, ran.append, 'next')
+    Event().wait(0.1)
+    assert ran == ['next']
+    actions.close()
@@ -0,0 +1,65 @@
+"""AsyncComms: SIPRecords out, and no port left behind."""
+
+import asyncio
+import os
+import tty
+
+import pytest
+import serial
+
+from async_robot import AsyncComms, AsyncRobot
+from handshake import HandshakeError
+from simulator import P2OSSimulator
+from sip_record import SIPRecord
+
+
+def test_sips_are_records():
+    async def run(port):
+        async with AsyncRobot(port) as robot:
+            sips = robot.sips()
+            sip = await asyncio.wait_for(sips.__anext__(), 2)
+            await sips.aclose()
+            return sip
+
+    with P2OSSimulator() as sim:
+        assert isinstance(asyncio.run(run(sim.port)), SIPRecord)
+
+
+def test_failed_open_closes_the_port():
+    # a port nothing answers on
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    comms = AsyncComms(os.ttyname(slave))
+
+    async def run():
+        with pytest.raises(HandshakeError):
+            await comms.open()
+
+    try:
+        asyncio.run(run())
+        assert comms.ser is None
+        with pytest.raises(serial.SerialException):
+            comms.write(b'\xfa\xfb\x03\x00\x00\x00')
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def test_cancelled_open_closes_the_port():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    comms = AsyncComms(os.ttyname(slave))
+
+    async def run():
+        task = asyncio.get_running_loop().create_task(comms.open())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        asyncio.run(run())
+        assert comms.ser is None
+    finally:
+        os.close(master)
+        os.close(slave)
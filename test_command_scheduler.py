@@ -0,0 +1,78 @@
+"""Regression tests for CommandScheduler: nothing stale follows a STOP,
+and coalescing keys never collide with the unkeyed slots."""
+
+from comms import Comms
+from command_scheduler import CommandScheduler
+from frame_encoder import FrameEncoder
+
+encoder = FrameEncoder()
+
+
+def scheduler():
+    return CommandScheduler(preempt_codes=Comms.MOTION_CODES)
+
+
+def sent(s):
+    return [msg for _, msg, _ in s.get_batch(timeout=0)]
+
+
+def test_nothing_stale_follows_stop():
+    s = scheduler()
+    s.put(encoder.encode(Comms.VEL, 500), key=('cmd', Comms.VEL))
+    s.put(encoder.encode(Comms.MOVE, 1000))
+    s.put(encoder.encode_many([(Comms.GRIPPER, 4), (Comms.RVEL, 20)]))
+    s.put(bytes(Comms.STOP_COMMAND), urgent=True)
+    assert sent(s) == [bytes(Comms.STOP_COMMAND)]
+    assert s.preempted == 3
+
+
+def test_stop_keeps_non_motion_in_order():
+    s = scheduler()
+    sonar = encoder.encode(Comms.SONAR, 1)
+    gripper = encoder.encode(Comms.GRIPPER, 4)
+    s.put(sonar, key='sonar')
+    s.put(encoder.encode(Comms.VEL, 500), key=('cmd', Comms.VEL))
+    s.put(bytes(Comms.HEARTBEAT), key='pulse')
+    s.put(gripper)
+    s.put(bytes(Comms.STOP_COMMAND), urgent=True)
+    assert sent(s) == [bytes(Comms.STOP_COMMAND), sonar, bytes(Comms.HEARTBEAT), gripper]
+
+
+def test_keys_do_not_collide_with_unkeyed_slots():
+    s = scheduler()
+    unkeyed = [encoder.encode(Comms.GRIPPER, i) for i in range(12)]
+    for msg in unkeyed:
+        s.put(msg)
+    # an int key equal to an unkeyed slot number (VEL is 11)
+    vel = encoder.encode(Comms.VEL, 500)
+    s.put(vel, key=Comms.VEL)
+    s.put(encoder.encode(Comms.GRIPPER, 12))
+    assert sent(s) == unkeyed + [vel, encoder.encode(Comms.GRIPPER, 12)]
+    assert s.coalesced == 0
+
+
+def test_same_key_coalesces_in_place():
+    s = scheduler()
+    first = encoder.encode(Comms.GRIPPER, 1)
+    s.put(first)
+    s.put(encoder.encode(Comms.VEL, 100), key=('cmd', Comms.VEL))
+    s.put(encoder.encode(Comms.VEL, 200), key=('cmd', Comms.VEL))
+    assert sent(s) == [first, encoder.encode(Comms.VEL, 200)]
+    assert s.coalesced == 1
+
+
+def test_sent_callbacks_travel_with_each_write():
+    s = scheduler()
+    frame = encoder.encode(Comms.GRIPPER, 1)
+    calls = []
+    # the same bytes object twice still gets a callback per write
+    s.put(frame, sent=lambda at: calls.append('first'))
+    s.put(frame, sent=lambda at: calls.append('second'))
+    # coalesced away, then preempted: neither is ever handed to the writer
+    s.put(encoder.encode(Comms.VEL, 100), key=('cmd', Comms.VEL), sent=lambda at: calls.append('old'))
+    s.put(encoder.encode(Comms.VEL, 200), key=('cmd', Comms.VEL), sent=lambda at: calls.append('new'))
+    s.put(bytes(Comms.STOP_COMMAND), urgent=True)
+    for _, _, sent in s.get_batch(timeout=0):
+        if sent is not None:
+            sent(0.0)
+    assert calls == ['first', 'second']
@@ -0,0 +1,61 @@
+"""ControlServer: BATCH is all or nothing, UDP subscriptions lapse."""
+
+import asyncio
+import socket
+
+from comms import Comms
+from control_server import (BATCH, COMMAND, ERROR, HEADER, OK, RATE, SUBSCRIBE,
+                            ControlServer, pack_message)
+from rerobot import Robot
+from simulator import P2OSSimulator
+
+
+class _Client:
+    leased = False
+
+
+def test_short_batch_sends_nothing():
+    with P2OSSimulator() as sim:
+        robot = Robot(sim.port, max_baud=None)
+        try:
+            server = ControlServer(robot)
+            commands = COMMAND.pack(Comms.GRIPPER, 1) + COMMAND.pack(Comms.GRIPPER, 2)
+            # says three commands, carries two and a bit
+            short = pack_message(BATCH, 1, bytes([3]) + commands + b'\x21')
+            reply = server.handle(short, _Client())
+            assert reply[HEADER.size] == ERROR
+            robot.motor.command_scheduler.wait_empty(timeout=1)
+            assert robot.motor.command_scheduler.qsize() == 0
+            assert server.commands == 0
+
+            whole = pack_message(BATCH, 2, bytes([2]) + commands)
+            assert server.handle(whole, _Client())[HEADER.size] == OK
+            assert server.commands == 2
+        finally:
+            robot.terminate()
+
+
+def test_udp_subscription_lapses():
+    async def run(robot):
+        server = ControlServer(robot, tcp_port=0, udp_port=0)
+        server.LEASE = 0.2
+        await server.start()
+        port = server._udp_transport.get_extra_info('sockname')[1]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(pack_message(SUBSCRIBE, 1, RATE.pack(50)), ('127.0.0.1', port))
+            await asyncio.sleep(0.1)
+            assert len(server._subscriptions) == 1
+            # the client goes away without unsubscribing
+            await asyncio.sleep(0.3)
+            assert not server._subscriptions and not server._leases
+        finally:
+            sock.close()
+            await server.close()
+
+    with P2OSSimulator() as sim:
+        robot = Robot(sim.port, max_baud=None)
+        try:
+            asyncio.run(run(robot))
+        finally:
+            robot.terminate()
@@ -0,0 +1,56 @@
+"""FrameEncoder: byte exact packets, checked against the frames the
+original motor codes spelled out by hand."""
+
+import pytest
+
+from comms import Comms
+from frame_encoder import FrameEncoder, vel2_arg
+from sip_parser import checksum
+
+encoder = FrameEncoder()
+
+
+def test_positive_argument():
+    # SETV 500 from the motor setup codes
+    assert encoder.encode(Comms.SETV, 500) == bytes([0xFA, 0xFB, 0x06, 0x06, 0x3B, 0xF4, 0x01, 0xFA, 0x3C])
+
+
+def test_negative_argument():
+    # SETA -300: arg type 0x1B, the absolute value LSB first
+    assert encoder.encode(Comms.SETA, -300) == bytes([0xFA, 0xFB, 0x06, 0x05, 0x1B, 0x2C, 0x01, 0x31, 0x1C])
+
+
+def test_short_packet():
+    assert encoder.encode(Comms.STOP) == bytes([0xFA, 0xFB, 0x03, 0x1D, 0x00, 0x1D])
+
+
+@pytest.mark.parametrize('value', [0, 1, 255, 256, 0x7FFF, -1, -256, -0x8000])
+def test_checksum_matches_the_parser(value):
+    frame = encoder.encode(Comms.HEAD, value)
+    assert frame[4] == (0x3B if value >= 0 else 0x1B)
+    assert int.from_bytes(frame[5:7], 'little') == abs(value)
+    assert int.from_bytes(frame[-2:], 'big') == checksum(frame[3:-2])
+
+
+@pytest.mark.parametrize('value', [0x8000, -0x8001])
+def test_out_of_range_argument(value):
+    with pytest.raises(ValueError):
+        encoder.encode(Comms.VEL, value)
+
+
+def test_vel2_bytes():
+    # left wheel -1 (0xFF) in the high byte, right wheel 1 in the low byte:
+    # 0xFF01 goes out as -255, which the controller reads back as 0xFF01
+    arg = vel2_arg(-1, 1)
+    assert arg == -255
+    frame = encoder.encode(Comms.VEL2, arg)
+    assert frame[3:7] == bytes([Comms.VEL2, 0x1B, 0xFF, 0x00])
+    assert (-int.from_bytes(frame[5:7], 'little')) & 0xFFFF == 0xFF01
+    assert encoder.encode(Comms.VEL2, vel2_arg(5, 10))[4:7] == bytes([0x3B, 10, 5])
+    with pytest.raises(ValueError):
+        vel2_arg(128, 0)
+
+
+def test_encode_many_is_the_frames_back_to_back():
+    commands = [(Comms.VEL, 100), (Comms.RVEL, -20), (Comms.STOP, None)]
+    assert encoder.encode_many(commands) == b''.join(encoder.encode(c, v) for c, v in commands)
@@ -0,0 +1,102 @@
+"""Handshake state machine: retries, timeout failure and the restart
+when an old client's SIPs arrive during SYNC. No I/O, times are given."""
+
+import pytest
+
+from handshake import (CLOSE_CODE, CONNECT, DONE, SYNC0, SYNC1, SYNC_CODES,
+                       Handshake, HandshakeError)
+from simulator import packet
+
+CONNECT_CODES = [bytes([0xFA, 0xFB, 0x03, 0x01, 0x00, 0x01])]
+ECHOES = [packet(bytes([0])), packet(bytes([1])), packet(bytes([2]) + b'ReRoSim\x00Pioneer\x00p3dx\x00')]
+SIP = packet(bytes([0x32]) + bytes(20))
+
+
+def handshake():
+    return Handshake(CONNECT_CODES, step_timeout=0.25, confirm_timeout=0.5, retries=2)
+
+
+def test_connects():
+    hs = handshake()
+    assert hs.start(0.0) == [SYNC_CODES[0]]
+    assert hs.on_packet(ECHOES[0], 0.01) == [SYNC_CODES[1]]
+    assert hs.on_packet(ECHOES[1], 0.02) == [SYNC_CODES[2]]
+    assert hs.on_packet(ECHOES[2], 0.03) == [b''.join(CONNECT_CODES)]
+    assert hs.state == CONNECT and hs.robot_info == ('ReRoSim', 'Pioneer', 'p3dx')
+    assert hs.on_packet(SIP, 0.1) == []
+    assert hs.state == DONE and not hs.failed
+    assert hs.duration == pytest.approx(0.1)
+
+
+def test_resends_when_a_step_times_out():
+    hs = handshake()
+    hs.start(0.0)
+    assert hs.poll(0.2) == []  # not due yet
+    assert hs.poll(0.25) == [SYNC_CODES[0]]
+    assert hs.deadline == pytest.approx(0.5)
+    # the echo of the resend still moves it on
+    assert hs.on_packet(ECHOES[0], 0.3) == [SYNC_CODES[1]]
+    assert hs.state == SYNC1
+
+
+def test_fails_after_the_retries():
+    hs = handshake()
+    hs.start(0.0)
+    sent = [hs.poll(t) for t in (0.25, 0.5)]
+    assert sent == [[SYNC_CODES[0]], [SYNC_CODES[0]]]
+    assert hs.poll(0.75) == []
+    assert hs.finished and hs.failed and hs.deadline is None
+    assert isinstance(hs.error, HandshakeError)
+    assert hs.poll(1.0) == [] and hs.on_packet(ECHOES[0], 1.0) == []
+
+
+def test_fails_without_a_sip_after_connecting():
+    hs = handshake()
+    hs.start(0.0)
+    for i, echo in enumerate(ECHOES):
+        hs.on_packet(echo, 0.01 * i)
+    assert hs.poll(0.52) == [b''.join(CONNECT_CODES)]  # resent once due
+    for t in (1.1, 1.7):
+        hs.poll(t)
+    assert hs.failed and 'CONNECT' in str(hs.error)
+
+
+def test_sip_during_sync_restarts():
+    # the controller is still streaming to an old client
+    hs = handshake()
+    hs.start(0.0)
+    hs.on_packet(ECHOES[0], 0.01)
+    assert hs.state == SYNC1
+    assert hs.on_packet(SIP, 0.02) == [CLOSE_CODE, SYNC_CODES[0]]
+    assert hs.state == SYNC0
+    # then connects as normal
+    hs.on_packet(ECHOES[0], 0.03)
+    hs.on_packet(ECHOES[1], 0.04)
+    hs.on_packet(ECHOES[2], 0.05)
+    hs.on_packet(SIP, 0.06)
+    assert hs.state == DONE
+
+
+def test_gives_up_when_the_old_client_never_lets_go():
+    hs = handshake()
+    hs.start(0.0)
+    for i in range(2):
+        assert hs.on_packet(SIP, 0.01 * i) == [CLOSE_CODE, SYNC_CODES[0]]
+    assert hs.on_packet(SIP, 0.03) == []
+    assert hs.failed and 'previous connection' in str(hs.error)
+
+
+def test_abort():
+    hs = handshake()
+    hs.start(0.0)
+    hs.abort(0.1, 'port went away')
+    assert hs.failed and str(hs.error) == 'port went away'
+    hs.abort(0.2, 'again')
+    assert str(hs.error) == 'port went away'
+
+
+def test_unrelated_packets_are_ignored_during_sync():
+    hs = handshake()
+    hs.start(0.0)
+    assert hs.on_packet(ECHOES[2], 0.01) == []  # a SYNC2 reply while in SYNC0
+    assert hs.state == SYNC0
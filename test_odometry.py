@@ -0,0 +1,33 @@
+"""Odometry: reset() before the first SIP anchors to that SIP."""
+
+from collections import namedtuple
+
+from odometry import Odometry
+
+Sip = namedtuple('Sip', 'time x y heading l_vel r_vel')
+
+
+def test_reset_before_first_sip():
+    odometry = Odometry()
+    odometry.rezero()
+    # the controller's counters are wherever the robot was left
+    pose = odometry.update(Sip(0.0, 1000.0, 500.0, 90.0, 0, 0))
+    assert pose[1:4] == (0.0, 0.0, 0.0)
+    # 100 mm along the robot's heading is 100 mm straight ahead of the new zero
+    pose = odometry.update(Sip(0.1, 1000.0, 600.0, 90.0, 0, 0))
+    assert abs(pose.x - 100.0) < 1e-9 and abs(pose.y) < 1e-9 and pose.heading == 0.0
+
+
+def test_reset_after_rebase_uses_the_reset_pose():
+    odometry = Odometry()
+    odometry.update(Sip(0.0, 200.0, 0.0, 0.0, 0, 0))
+    odometry.rebase()
+    odometry.reset(50.0, 60.0, 0.0)
+    pose = odometry.update(Sip(1.0, 7000.0, 10.0, 0.0, 0, 0))
+    assert pose[1:4] == (50.0, 60.0, 0.0)
+
+
+def test_no_reset_keeps_the_controller_frame():
+    odometry = Odometry()
+    pose = odometry.update(Sip(0.0, 1000.0, 500.0, 90.0, 0, 0))
+    assert pose[1:4] == (1000.0, 500.0, 90.0)
@@ -0,0 +1,36 @@
+"""Orchestra: one robot going away must not take the others with it."""
+
+import os
+import tty
+
+import pytest
+
+from handshake import HandshakeError
+from orchestra import Orchestra
+from simulator import P2OSSimulator
+
+
+def test_unplug_during_handshake():
+    # robot 0 answers, robot 1 is a bare pty that never does
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    unplugged = os.ttyname(slave)
+    with P2OSSimulator() as sim:
+        orchestra = Orchestra([sim.port, unplugged])
+        orchestra.start()
+        try:
+            # unplugged while still waiting for its SYNC0 echo
+            os.close(master)
+            with pytest.raises(HandshakeError, match=unplugged):
+                orchestra.wait_connected(timeout=5)
+            assert orchestra._thread.is_alive()
+            assert orchestra[0].connected
+            assert orchestra[1].fd is None and orchestra[1].handshake.failed
+
+            # the survivor is still served
+            orchestra[0].move(100)
+            assert orchestra[0].command_scheduler.wait_empty(timeout=1)
+            assert orchestra._thread.is_alive()
+        finally:
+            orchestra.close()
+            os.close(slave)
@@ -0,0 +1,23 @@
+"""Robots on the same port share one connected Motor."""
+
+from comms import Comms
+from rerobot import Robot
+from simulator import P2OSSimulator
+
+
+def test_robots_share_one_session():
+    with P2OSSimulator() as sim:
+        first = Robot(sim.port, max_baud=None)
+        second = Robot(sim.port, max_baud=None)
+        try:
+            assert first.motor is second.motor
+            # one handshake (motors are enabled once, in the connect codes)
+            enables = [pkt for _, pkt in sim.received if pkt[3] == Comms.ENABLE]
+            assert len(enables) == 1
+
+            # the first to leave doesn't close the session for the other
+            first.terminate()
+            assert sim.connected and not second.motor.closed
+        finally:
+            second.terminate()
+        assert second.motor.closed
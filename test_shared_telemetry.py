@@ -0,0 +1,84 @@
+"""Shared telemetry: torn copies are never returned, live blocks never replaced."""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from shared_telemetry import SharedTelemetry, TelemetryReader, HEADER_DTYPE
+from simulator import P2OSSimulator
+from sip_record import decode_standard_sip
+
+
+def records(n):
+    sim = P2OSSimulator()
+    sim.vel = 300.0
+    out = []
+    for i in range(n):
+        sim._integrate(0.1)
+        out.append(decode_standard_sip(sim.standard_sip(), float(i)))
+    return out
+
+
+def test_latest_and_history():
+    writer = SharedTelemetry('rerobot_test_rw', history=4)
+    reader = TelemetryReader('rerobot_test_rw')
+    try:
+        assert reader.latest() is None and len(reader.history()) == 0
+        sent = records(6)
+        for record in sent:
+            writer.publish(record)
+        latest = reader.latest()
+        assert latest['time'] == 5.0 and latest['x'] == sent[5].x
+        assert list(reader.history()['time']) == [2.0, 3.0, 4.0, 5.0]
+        assert reader.seq == 12
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_torn_copy_is_never_returned():
+    writer = SharedTelemetry('rerobot_test_torn', history=2)
+    reader = TelemetryReader('rerobot_test_torn')
+    reader.STUCK = 0.01
+    try:
+        for record in records(2):
+            writer.publish(record)
+        # as if the header's store became visible before the record's
+        writer._latest[0]['record']['x'] += 1
+        with pytest.raises(TimeoutError):
+            reader.latest()
+        writer._history[1]['record']['x'] += 1
+        with pytest.raises(TimeoutError):
+            reader.history()
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_live_block_is_not_replaced():
+    writer = SharedTelemetry('rerobot_test_live')
+    try:
+        with pytest.raises(FileExistsError, match='in use'):
+            SharedTelemetry('rerobot_test_live')
+    finally:
+        writer.close()
+
+
+def test_stale_block_is_replaced():
+    writer = SharedTelemetry('rerobot_test_stale')
+    # left behind by a process that has gone
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    np.ndarray(1, HEADER_DTYPE, writer.shm.buf)['pid'] = dead.pid
+    replacement = SharedTelemetry('rerobot_test_stale')
+    try:
+        header = np.ndarray(1, HEADER_DTYPE, replacement.shm.buf)
+        assert header['pid'][0] == os.getpid()
+        del header
+    finally:
+        replacement.close()
+        writer._header = writer._latest = writer._history = writer._seq = None
+        writer.shm.close()
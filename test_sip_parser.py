@@ -0,0 +1,85 @@
+"""SIPParser: resyncs past garbage and bad checksums, and packets
+split across feeds come out whole."""
+
+from comms import Comms
+from frame_encoder import FrameEncoder
+from simulator import P2OSSimulator, packet
+from sip_parser import SIPParser
+
+encoder = FrameEncoder()
+
+
+def sips(n):
+    sim = P2OSSimulator(seed=1)
+    sim.vel = 200.0
+    out = []
+    for _ in range(n):
+        sim._integrate(0.1)
+        out.append(sim.standard_sip())
+    return out
+
+
+def test_whole_packets():
+    frames = sips(3)
+    parser = SIPParser()
+    assert parser.feed(b''.join(frames)) == frames
+    assert parser.frames == 3 and len(parser) == 0
+
+
+def test_resync_after_garbage():
+    frames = sips(2)
+    parser = SIPParser()
+    # noise, a stray header byte and a header with an impossible byte count
+    garbage = b'\x00\x13\xfa\x42\xfa\xfb\xff\x01'
+    assert parser.feed(garbage + frames[0] + garbage + frames[1]) == frames
+    assert parser.resyncs > 0 and parser.checksum_errors == 0
+
+
+def test_resync_after_bad_checksum():
+    frames = sips(3)
+    bad = bytearray(frames[1])
+    bad[-1] ^= 0xFF
+    parser = SIPParser()
+    assert parser.feed(frames[0] + bytes(bad) + frames[2]) == [frames[0], frames[2]]
+    assert parser.checksum_errors == 1
+
+
+def test_truncated_packet_is_skipped():
+    # a packet cut short by a dropped byte: its byte count swallows the
+    # start of the next one, which the checksum catches
+    frames = sips(2)
+    parser = SIPParser()
+    assert parser.feed(frames[0][:-3] + frames[1] + frames[1]) == [frames[1], frames[1]]
+
+
+def test_split_across_feeds():
+    frames = sips(4)
+    stream = b''.join(frames)
+    for size in (1, 2, 5, 17):
+        parser = SIPParser()
+        out = []
+        for i in range(0, len(stream), size):
+            out += parser.feed(stream[i:i + size])
+        assert out == frames
+
+
+def test_partial_packet_waits_for_the_rest():
+    frame = packet(bytes([Comms.SYNC2]) + b'ReRoSim\x00Pioneer\x00p3dx\x00')
+    parser = SIPParser()
+    assert parser.feed(frame[:7]) == []
+    assert len(parser) == 7
+    assert parser.feed(frame[7:]) == [frame]
+
+
+def test_wraps_around_the_ring():
+    frames = sips(20)
+    parser = SIPParser(capacity=64)
+    out = []
+    for frame in frames:
+        out += parser.feed(frame)
+    assert out == frames and parser.overflows == 0
+
+
+def test_command_frames_parse_back():
+    frame = encoder.encode(Comms.VEL, -300)
+    assert SIPParser().feed(frame) == [frame]
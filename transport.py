@@ -0,0 +1,373 @@
+"""Byte transports Comms talks to the controller through.
+Every transport has the small part of the pyserial API Comms uses
+(read, write, in_waiting, flush, reset_input_buffer, close, is_open,
+port, baudrate) with the same semantics: read(size) waits up to timeout
+for the first byte and returns what has arrived, write sends it all.
+
+    open_transport('/dev/ttyUSB0')           # SerialTransport
+    open_transport('tcp://venue-bridge:4001') # TCPTransport (ser2net style bridge)
+    host, robot = loopback_pair()             # in memory, for tests and benchmarks
+
+TCP connections set TCP_NODELAY (a 6 byte command must not wait for
+Nagle), and reconnect with jittered exponential backoff when dropped;
+a write blocks until the link is back, so commands stay queued (and
+coalesced) in the CommandScheduler meanwhile. A transport carries one
+session (one handshake, one reader), so several Robots on the same
+bridge share the connected Motor instead (Motor.acquire), not the
+socket. Every transport keeps its own write latency and throughput stats.
+"""
+
+import logging
+import random
+import select
+import socket
+from collections import deque
+from threading import Condition, Lock, Event
+from time import monotonic
+
+import serial
+
+from metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+TCP_SCHEME = 'tcp://'
+LOOP_SCHEME = 'loop://'
+
+
+class Transport:
+    """Base class: subclasses implement _write, _read, in_waiting,
+    is_open and close"""
+    adjustable_baud = False  # only a local serial port can follow HOSTBAUD
+
+    def __init__(self, port, timeout):
+        self.port = port
+        self.timeout = timeout
+        self.bytes_out = Counter()
+        self.bytes_in = Counter()
+        self.writes = Counter()
+        self.write_time = Histogram()  # secs spent in each write call
+        self.opened_at = monotonic()
+
+    # pyserial names Comms (and baud_rate) use
+    def isOpen(self):
+        return self.is_open
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def write(self, data):
+        started = monotonic()
+        self._write(data)
+        self.write_time.observe(monotonic() - started)
+        self.writes.inc()
+        self.bytes_out.inc(len(data))
+        return len(data)
+
+    def read(self, size=1):
+        data = self._read(size)
+        self.bytes_in.inc(len(data))
+        return data
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        waiting = self.in_waiting
+        if waiting:
+            self._read(waiting)
+
+    def stats(self):
+        """Throughput since opening and write latency (millisecs)"""
+        elapsed = max(monotonic() - self.opened_at, 1e-9)
+        return {'port': self.port,
+                'bytes_out': self.bytes_out.value,
+                'bytes_in': self.bytes_in.value,
+                'writes': self.writes.value,
+                'out_per_sec': self.bytes_out.value / elapsed,
+                'in_per_sec': self.bytes_in.value / elapsed,
+                'write_ms': self.write_time.summary(scale=1000)}
+
+
+class SerialTransport(Transport):
+    adjustable_baud = True
+
+    def __init__(self, port, baudrate=9600, timeout=0.1):
+        super().__init__(port, timeout)
+        self.ser = serial.Serial(port=port,
+                                 baudrate=baudrate,
+                                 parity=serial.PARITY_NONE,
+                                 stopbits=serial.STOPBITS_ONE,
+                                 bytesize=serial.EIGHTBITS,
+                                 timeout=timeout)
+
+    @property
+    def is_open(self):
+        return self.ser.is_open
+
+    @property
+    def in_waiting(self):
+        return self.ser.in_waiting
+
+    @property
+    def baudrate(self):
+        return self.ser.baudrate
+
+    @baudrate.setter
+    def baudrate(self, rate):
+        self.ser.baudrate = rate
+
+    def fileno(self):
+        return self.ser.fileno()
+
+    def _write(self, data):
+        self.ser.write(data)
+
+    def _read(self, size):
+        return self.ser.read(size)
+
+    def flush(self):
+        self.ser.flush()
+
+    def reset_input_buffer(self):
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        self.ser.close()
+
+
+class TCPTransport(Transport):
+    CONNECT_TIMEOUT = 3.0
+    BACKOFF_MIN = 0.1  # secs before the first reconnect attempt
+    BACKOFF_MAX = 5.0  # also how long a connection must last to reset the backoff
+
+    def __init__(self, host, port, baudrate=9600, timeout=0.1):
+        super().__init__(f'{TCP_SCHEME}{host}:{port}', timeout)
+        self.address = (host, port)
+        self.baudrate = baudrate  # the bridge's serial side, fixed
+        self.reconnects = Counter()
+        self.sock = None
+        self._closed = False
+        self._buffer = bytearray()
+        self._read_lock = Lock()
+        self._connected = Condition()
+        self._backoff = self.BACKOFF_MIN
+        self._next_attempt = 0.0
+        self._connected_at = 0.0
+        self._connecting = False
+        self._connect()
+        if self.sock is None:
+            raise serial.SerialException(f'could not connect to {self.port}')
+
+    @property
+    def is_open(self):
+        return not self._closed
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def _connect(self):
+        # one thread connects at a time; the others wait on _connected
+        with self._connected:
+            if self.sock is not None or self._closed or self._connecting:
+                return
+            if monotonic() < self._next_attempt:
+                return
+            self._connecting = True
+        sock = None
+        try:
+            sock = socket.create_connection(self.address, self.CONNECT_TIMEOUT)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.settimeout(None)
+        except OSError as e:
+            sock = None
+            log.warning('%s: connect failed (%s), retrying in %.1f secs', self.port, e, self._backoff)
+        with self._connected:
+            self._connecting = False
+            if sock is not None:
+                self.sock = sock
+                self._connected_at = monotonic()
+                log.info('%s connected', self.port)
+            else:
+                self._back_off()
+            self._connected.notify_all()
+
+    def _back_off(self):
+        # jittered so several robots don't all retry together
+        self._next_attempt = monotonic() + self._backoff * random.uniform(0.5, 1.0)
+        self._backoff = min(self._backoff * 2, self.BACKOFF_MAX)
+
+    def _dropped(self, sock, error):
+        with self._connected:
+            if self.sock is not sock:
+                return  # already handled by the other thread
+            self.sock = None
+            # a bridge that accepts then drops straight away keeps backing off
+            if monotonic() - self._connected_at > self.BACKOFF_MAX:
+                self._backoff = self.BACKOFF_MIN
+            self._back_off()
+        self.reconnects.inc()
+        log.warning('%s dropped (%s), reconnecting', self.port, error)
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def _wait_connected(self, timeout):
+        # returns the socket, or None if still down after timeout
+        end = None if timeout is None else monotonic() + timeout
+        while not self._closed:
+            sock = self.sock
+            if sock is not None:
+                return sock
+            self._connect()
+            with self._connected:
+                if self.sock is None and not self._closed:
+                    wait = max(self._next_attempt - monotonic(), 0.01)
+                    if end is not None:
+                        wait = min(wait, end - monotonic())
+                        if wait <= 0:
+                            return None
+                    self._connected.wait(wait)
+        return None
+
+    def _write(self, data):
+        # waits out a reconnect, so nothing queued behind it is lost
+        while True:
+            sock = self._wait_connected(None)
+            if sock is None:
+                raise serial.SerialException(f'{self.port} is closed')
+            try:
+                sock.sendall(data)
+                return
+            except OSError as e:
+                self._dropped(sock, e)
+
+    @property
+    def in_waiting(self):
+        with self._read_lock:
+            self._fill(0)
+            return len(self._buffer)
+
+    def _fill(self, timeout):
+        # moves whatever the socket has into the buffer, waiting up to timeout
+        sock = self.sock
+        if sock is None:
+            return
+        try:
+            ready, _, _ = select.select([sock], [], [], timeout)
+            if ready:
+                data = sock.recv(65536)
+                if not data:
+                    raise ConnectionResetError('closed by the bridge')
+                self._buffer += data
+        except (OSError, ValueError) as e:
+            self._dropped(sock, e)
+
+    def _read(self, size):
+        end = monotonic() + self.timeout
+        with self._read_lock:
+            while not self._buffer and not self._closed:
+                left = end - monotonic()
+                if left <= 0:
+                    break
+                if self.sock is None:
+                    self._wait_connected(left)
+                else:
+                    self._fill(left)
+            self._fill(0)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def reset_input_buffer(self):
+        with self._read_lock:
+            self._fill(0)
+            self._buffer.clear()
+
+    def stats(self):
+        stats = super().stats()
+        stats['reconnects'] = self.reconnects.value
+        stats['connected'] = self.connected
+        return stats
+
+    def close(self):
+        with self._connected:
+            self._closed = True
+            sock, self.sock = self.sock, None
+            self._connected.notify_all()
+        if sock is not None:
+            sock.close()
+
+
+class LoopbackTransport(Transport):
+    """One end of an in-memory link (see loopback_pair)"""
+
+    def __init__(self, port=LOOP_SCHEME, baudrate=9600, timeout=0.1):
+        super().__init__(port, timeout)
+        self.baudrate = baudrate
+        self.peer = None
+        self._inbox = deque()  # chunks written by the peer
+        self._waiting = 0
+        self._ready = Condition()
+        self._closed = Event()
+
+    @property
+    def is_open(self):
+        return not self._closed.is_set()
+
+    @property
+    def in_waiting(self):
+        return self._waiting
+
+    def _deliver(self, data):
+        with self._ready:
+            self._inbox.append(bytes(data))
+            self._waiting += len(data)
+            self._ready.notify()
+
+    def _write(self, data):
+        if self._closed.is_set() or self.peer is None:
+            raise serial.SerialException(f'{self.port} is closed')
+        self.peer._deliver(data)
+
+    def _read(self, size):
+        with self._ready:
+            if not self._inbox:
+                self._ready.wait(self.timeout)
+            chunks = []
+            while self._inbox and size > 0:
+                chunk = self._inbox.popleft()
+                if len(chunk) > size:
+                    self._inbox.appendleft(chunk[size:])
+                    chunk = chunk[:size]
+                chunks.append(chunk)
+                size -= len(chunk)
+                self._waiting -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self._closed.set()
+        with self._ready:
+            self._ready.notify_all()
+
+
+def loopback_pair(timeout=0.1):
+    """Two connected LoopbackTransports, e.g. (host side, robot side)"""
+    a = LoopbackTransport(LOOP_SCHEME + 'a', timeout=timeout)
+    b = LoopbackTransport(LOOP_SCHEME + 'b', timeout=timeout)
+    a.peer, b.peer = b, a
+    return a, b
+
+
+def open_transport(port, baudrate=9600, timeout=0.1):
+    """Transport for a port string: tcp://host:port is a TCP bridge,
+    anything else a local serial port"""
+    if port.startswith(TCP_SCHEME):
+        host, _, tcp_port = port[len(TCP_SCHEME):].rpartition(':')
+        if not host or not tcp_port.isdigit():
+            raise ValueError(f'expected tcp://host:port, got {port!r}')
+        return TCPTransport(host.strip('[]'), int(tcp_port), baudrate, timeout)
+    return SerialTransport(port, baudrate, timeout)